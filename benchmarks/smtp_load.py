@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+SMTP load benchmark
+
+Starts a hermes server in a child process, along with a stand-in relay
+server for the proxy scenario, and drives concurrent SMTP sessions
+against it with a mix of message sizes:
+
+    $ python benchmarks/smtp_load.py --engine smtpd asyncio --sessions 50 \\
+        --messages 5000 --sizes 1024:80 65536:15 1048576:5 --output results.json
+
+Every scenario (no hooks, printer hook, relay to a proxy) is run on every
+engine, and reports messages per second, p50/p99 message latency (from
+MAIL to the final reply) and the peak RSS of the server process. Results
+are written as JSON, and can be checked against a previous run:
+
+    $ python benchmarks/smtp_load.py --baseline results.json --tolerance 0.1
+
+which exits with status 1 when throughput drops or p99 latency grows by
+more than the tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hermes.cli import server_class  # noqa: E402
+from hermes.extensions.printer import Printer  # noqa: E402
+
+SCENARIOS = ('bare', 'printer', 'proxy')
+ENGINES = ('smtpd', 'asyncio')
+LINE = b'x' * 76 + b'\r\n'
+
+
+def serve(engine, hooks, proxy_address, ready, results):
+    """Child process running a server until SIGTERM, then reporting its peak RSS"""
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    logger = logging.getLogger('hermes')
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    server = server_class(engine).create(('127.0.0.1', 0), hooks, proxy_address)
+    address = server.socket.getsockname()
+
+    def stop(signum, frame):
+        if hasattr(server, 'stop'):
+            server.stop()
+        else:
+            raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+    ready.send(address)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        results.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+class ServerProcess(object):
+    def __init__(self, engine, hooks=(), proxy_address=None):
+        context = multiprocessing.get_context('fork')
+        ready, self.ready = context.Pipe(duplex=False)
+        self.results, results = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=serve, args=(engine, list(hooks), proxy_address, self.ready, results))
+        self.process.start()
+        if not ready.poll(10):
+            self.process.terminate()
+            raise RuntimeError('{} server did not start'.format(engine))
+        self.address = ready.recv()
+
+    def stop(self):
+        """Stop the server and return its peak RSS in KB"""
+        self.process.terminate()
+        peak_rss = self.results.recv() if self.results.poll(30) else None
+        self.process.join()
+        return peak_rss
+
+
+def message_body(size, index):
+    head = u'From: bench@hermes.test\r\nTo: sink@hermes.test\r\nSubject: Benchmark {}\r\n\r\n' \
+        .format(index).encode('ascii')
+    lines = max(0, size - len(head)) // len(LINE)
+    return head + LINE * lines
+
+
+def parse_sizes(values):
+    """['1024:80', '65536:20'] -> [(1024, 80), (65536, 20)]"""
+    sizes = []
+    for value in values:
+        size, _, weight = value.partition(':')
+        sizes.append((int(size), int(weight or 1)))
+    return sizes
+
+
+async def read_reply(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        if line[3:4] != b'-':
+            return int(line[:3])
+
+
+async def command(reader, writer, line, expected):
+    writer.write(line + b'\r\n')
+    code = await read_reply(reader)
+    if code != expected:
+        raise ValueError('{} replied to {}'.format(code, line.split(b' ')[0].decode('ascii')))
+
+
+async def session(address, bodies, pending, latencies, errors):
+    reader, writer = await asyncio.open_connection(*address, limit=2 ** 20)
+    try:
+        if await read_reply(reader) != 220:
+            raise ValueError('No greeting')
+        await command(reader, writer, b'EHLO bench.hermes.test', 250)
+
+        while pending:
+            body = bodies[pending.pop() % len(bodies)]
+            started = time.perf_counter()
+            try:
+                await command(reader, writer, b'MAIL FROM:<bench@hermes.test>', 250)
+                await command(reader, writer, b'RCPT TO:<sink@hermes.test>', 250)
+                await command(reader, writer, b'DATA', 354)
+                writer.write(body)
+                await command(reader, writer, b'.', 250)
+                latencies.append(time.perf_counter() - started)
+            except ValueError:
+                errors.append(1)
+                await command(reader, writer, b'RSET', 250)
+
+        await command(reader, writer, b'QUIT', 221)
+    finally:
+        writer.close()
+
+
+async def drive(address, sessions, messages, bodies):
+    pending = list(range(messages))
+    latencies, errors = [], []
+    results = await asyncio.gather(
+        *[session(address, bodies, pending, latencies, errors) for _ in range(sessions)],
+        return_exceptions=True)
+    errors.extend(result for result in results if isinstance(result, Exception))
+    return latencies, len(errors)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_scenario(scenario, engine, args, sizes):
+    random.seed(args.seed)
+    population = [size for size, weight in sizes for _ in range(weight)]
+    bodies = [message_body(random.choice(population), index) for index in range(256)]
+
+    relay = ServerProcess('asyncio') if scenario == 'proxy' else None
+    hooks = [Printer()] if scenario == 'printer' else []
+    server = ServerProcess(engine, hooks, relay.address if relay else None)
+
+    try:
+        started = time.perf_counter()
+        latencies, errors = asyncio.run(drive(server.address, args.sessions, args.messages, bodies))
+        elapsed = time.perf_counter() - started
+    finally:
+        peak_rss = server.stop()
+        if relay is not None:
+            relay.stop()
+
+    return dict(scenario=scenario, engine=engine, sessions=args.sessions,
+                messages=len(latencies), errors=errors, seconds=elapsed,
+                messages_per_second=len(latencies) / elapsed,
+                mean_bytes=sum(len(body) for body in bodies) // len(bodies),
+                p50_ms=percentile(latencies, 0.5) * 1000 if latencies else None,
+                p99_ms=percentile(latencies, 0.99) * 1000 if latencies else None,
+                peak_rss_kb=peak_rss)
+
+
+def regressions(results, baseline, tolerance):
+    """Results slower than the baseline by more than tolerance"""
+    previous = dict(((run['scenario'], run['engine']), run) for run in baseline['results'])
+    found = []
+    for run in results:
+        before = previous.get((run['scenario'], run['engine']))
+        if before is None:
+            continue
+        if run['messages_per_second'] < before['messages_per_second'] * (1 - tolerance):
+            found.append('{scenario}/{engine}: {0:.0f} messages/s, was {1:.0f}'.format(
+                run['messages_per_second'], before['messages_per_second'], **run))
+        if run['p99_ms'] and before['p99_ms'] and run['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            found.append('{scenario}/{engine}: p99 {0:.2f}ms, was {1:.2f}ms'.format(
+                run['p99_ms'], before['p99_ms'], **run))
+    return found
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=u'Hermes SMTP load benchmark')
+    parser.add_argument('--engine', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--sessions', type=int, default=20, help=u'Concurrent SMTP sessions (default: 20)')
+    parser.add_argument('--messages', type=int, default=2000, help=u'Messages per run (default: 2000)')
+    parser.add_argument('--sizes', nargs='+', default=['1024:80', '16384:15', '262144:5'],
+                        metavar='BYTES[:WEIGHT]', help=u'Message size mix (default: 1024:80 16384:15 262144:5)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, metavar='PATH', help=u'Write results as JSON')
+    parser.add_argument('--baseline', default=None, metavar='PATH', help=u'Compare to previous results')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help=u'Allowed slowdown against the baseline (default: 0.1)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = parse_sizes(args.sizes)
+
+    results = []
+    for scenario in args.scenario:
+        for engine in args.engine:
+            result = run_scenario(scenario, engine, args, sizes)
+            results.append(result)
+            print(u'{scenario:<8} {engine:<8} {messages_per_second:>8.0f} msg/s  p50 {0:>7.2f}ms  '
+                  u'p99 {1:>7.2f}ms  rss {peak_rss_kb}KB  errors {errors}'.format(
+                      result['p50_ms'] or 0, result['p99_ms'] or 0, **result))
+
+    report = dict(python=platform.python_version(), platform=platform.platform(),
+                  timestamp=time.time(), sizes=args.sizes, results=results)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as stream:
+            found = regressions(results, json.load(stream), args.tolerance)
+        for regression in found:
+            print(u'REGRESSION {}'.format(regression))
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio based SMTP server engine
+
+Every SMTP session is a coroutine on a single event loop, while
+process_message (hooks and relay) runs on a thread pool, so a slow hook
+or relay server only holds back its own session.
+
+    server = AsyncServer.create(('127.0.0.1', 2525), hooks=[])
+    server.run()
+"""
+
+import time
+import socket
+import asyncio
+import logging
+import functools
+from concurrent import futures
+
+from .smtp import BaseServer, nodelay
+from .message import Message
+
+log = logging.getLogger('hermes')
+
+__version__ = 'Hermes asyncio SMTP'
+
+
+class Session(object):
+    """A single SMTP conversation.
+
+    Speaks the same dialect as smtpd.SMTPChannel so both engines
+    reply identically to clients.
+    """
+
+    command_size_limit = 512
+    data_size_limit = 33554432
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.fqdn = server.fqdn
+        self.seen_greeting = ''
+        self.closing = False
+        self.started = time.perf_counter()
+        self.loop = None
+        self.watchdog = None
+        self.reading_since = None
+        self.timed_out = False
+        self.drained = False  # processed a message while the server shuts down
+        self.abandoned = False
+        self.replies = []
+        self.reset()
+
+    def reset(self):
+        self.mailfrom = None
+        self.rcpttos = []
+        self.mail_options = []
+        self.rcpt_options = []
+
+    def push(self, reply):
+        self.replies.append(reply)
+
+    async def flush(self):
+        # replies are written together: a multiline reply sent line by line
+        # is held back by Nagle's algorithm until the client acknowledges
+        if self.replies:
+            self.writer.write(u''.join(reply + u'\r\n' for reply in self.replies).encode('utf-8'))
+            self.replies = []
+        await self.writer.drain()
+
+    async def readline(self):
+        """Read a line, raising asyncio.TimeoutError after server.timeout
+        seconds without one"""
+        self.reading_since = self.loop.time()
+        try:
+            line = await self.reader.readline()
+        finally:
+            self.reading_since = None
+
+        if not line and self.timed_out:
+            raise asyncio.TimeoutError()
+        return line
+
+    def close_gracefully(self):
+        self.push('421 {} Service closing transmission channel'.format(self.fqdn))
+        self.closing = True
+        if self.reading_since is not None:
+            self.reader.feed_eof()
+
+    def check_idle(self):
+        # a single timer per session, as wrapping every line read in
+        # wait_for costs a task per line
+        idle = 0 if self.reading_since is None else self.loop.time() - self.reading_since
+        if idle >= self.server.timeout:
+            self.timed_out = True
+            self.reader.feed_eof()
+        else:
+            self.watchdog = self.loop.call_later(self.server.timeout - idle, self.check_idle)
+
+    async def handle(self):
+        self.loop = asyncio.get_running_loop()
+        self.watchdog = self.loop.call_later(self.server.timeout, self.check_idle)
+        try:
+            await self.converse()
+        finally:
+            self.watchdog.cancel()
+
+    async def converse(self):
+        self.push('220 {} {}'.format(self.fqdn, __version__))
+        await self.flush()
+        self.server.metrics.observe('accept', time.perf_counter() - self.started)
+
+        while not self.closing:
+            await self.flush()
+
+            if self.server.draining and self.mailfrom is None:
+                self.close_gracefully()
+                break
+
+            try:
+                line = await self.readline()
+            except asyncio.TimeoutError:
+                self.push('421 Error: timeout exceeded')
+                break
+            except ValueError:
+                self.push('500 Error: line too long')
+                break
+
+            if not line or self.closing:
+                break
+
+            await self.dispatch(line.rstrip(b'\r\n'))
+
+        await self.flush()
+
+    async def dispatch(self, line):
+        if len(line) > self.command_size_limit:
+            self.push('500 Error: line too long')
+            return
+
+        line = line.decode('utf-8', 'replace')
+        command, _, arg = line.strip().partition(' ')
+        method = getattr(self, 'smtp_' + command.upper(), None)
+
+        if not command:
+            self.push('500 Error: bad syntax')
+        elif method is None:
+            self.push('500 Error: command "{}" not recognized'.format(command))
+        else:
+            await method(arg.strip())
+
+    async def smtp_HELO(self, arg):
+        if not arg:
+            self.push('501 Syntax: HELO hostname')
+        elif self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+        else:
+            self.seen_greeting = arg
+            self.push('250 {}'.format(self.fqdn))
+
+    async def smtp_EHLO(self, arg):
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+        elif self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+        else:
+            self.seen_greeting = arg
+            self.push('250-{}'.format(self.fqdn))
+            self.push('250-SIZE {}'.format(self.data_size_limit))
+            self.push('250-8BITMIME')
+            self.push('250-PIPELINING')
+            self.push('250 HELP')
+
+    async def smtp_NOOP(self, arg):
+        self.push('501 Syntax: NOOP' if arg else '250 OK')
+
+    async def smtp_QUIT(self, arg):
+        self.push('221 Bye')
+        self.closing = True
+
+    async def smtp_RSET(self, arg):
+        if arg:
+            self.push('501 Syntax: RSET')
+        else:
+            self.reset()
+            self.push('250 OK')
+
+    async def smtp_VRFY(self, arg):
+        if arg:
+            self.push('252 Cannot VRFY user, but will accept message '
+                      'and attempt delivery')
+        else:
+            self.push('501 Syntax: VRFY <address>')
+
+    async def smtp_MAIL(self, arg):
+        address, options = parse_address('FROM:', arg)
+
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+        elif address is None:
+            self.push('501 Syntax: MAIL FROM: <address>')
+        elif self.mailfrom is not None:
+            self.push('503 Error: nested MAIL command')
+        else:
+            self.mailfrom = address
+            self.mail_options = options
+            self.push('250 OK')
+
+    async def smtp_RCPT(self, arg):
+        address, options = parse_address('TO:', arg)
+
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+        elif self.mailfrom is None:
+            self.push('503 Error: need MAIL command')
+        elif not address:
+            self.push('501 Syntax: RCPT TO: <address>')
+        else:
+            self.rcpttos.append(address)
+            self.rcpt_options.extend(options)
+            self.push('250 OK')
+
+    async def smtp_DATA(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+        elif not self.rcpttos:
+            self.push('503 Error: need RCPT command')
+        elif arg:
+            self.push('501 Syntax: DATA')
+        else:
+            self.push('354 End data with <CR><LF>.<CR><LF>')
+            await self.flush()
+
+            started = time.perf_counter()
+            data, refusal = await self.read_data()
+            self.server.metrics.observe('data', time.perf_counter() - started)
+            if refusal is not None:
+                self.push(refusal)
+            else:
+                status = await self.server.dispatch_message(
+                    self.peer, self.mailfrom, self.rcpttos, data,
+                    mail_options=self.mail_options,
+                    rcpt_options=self.rcpt_options)
+                self.push(status or '250 OK')
+                self.drained = self.server.draining
+
+            self.reset()
+
+    async def read_data(self):
+        """Read the DATA section into a Message, undoing dot-stuffing.
+
+        Returns the message and None, or None and the reply refusing it when
+        the message exceeds data_size_limit or has a line longer than the
+        stream limit, once the whole section has been consumed.
+        """
+        message = Message(**self.server.spool_options)
+        separator, refusal = b'', None
+
+        while True:
+            try:
+                line = await self.readline()
+            except ValueError:
+                # the reader drops the long line, the rest of the section
+                # still has to be read up to its terminator
+                refusal = refusal or '500 Error: line too long'
+                continue
+            if not line:
+                raise ConnectionResetError('Connection closed during DATA')
+
+            if line.endswith(b'\r\n'):
+                line = line[:-2]
+            elif line.endswith(b'\n'):
+                line = line[:-1]
+            if line == b'.':
+                break
+
+            if line.startswith(b'.'):
+                line = line[1:]
+
+            if message.size + len(separator) + len(line) > self.data_size_limit:
+                refusal = refusal or '552 Error: Too much mail data'
+            elif refusal is None:
+                message.write(separator + line)
+            separator = b'\n'
+
+        if refusal is not None:
+            return None, refusal
+        return message.finish(), None
+
+
+def parse_address(keyword, arg):
+    """Split a MAIL/RCPT argument into its address and ESMTP options"""
+    if not arg[:len(keyword)].upper() == keyword:
+        return None, []
+
+    arg = arg[len(keyword):].strip()
+    if arg.startswith('<'):
+        address, _, options = arg[1:].partition('>')
+    else:
+        address, _, options = arg.partition(' ')
+
+    return address.strip(), options.split()
+
+
+class AsyncServer(BaseServer):
+    backlog = 1024
+    timeout = 300
+    max_workers = 64
+    stream_limit = 2 ** 20
+
+    def __init__(self, local_address, remote_address, relay_options=None, queue_options=None,
+                 reuse_port=False, spool_options=None, stats_file=None, rules=None, retry_options=None,
+                 throttle_options=None):
+        BaseServer.__init__(self, local_address, remote_address, relay_options, queue_options,
+                            reuse_port, spool_options, stats_file, rules, retry_options,
+                            throttle_options)
+        self.fqdn = socket.getfqdn()
+        self.reuse_port = reuse_port
+        self.socket = self.bind(local_address)
+        self.loop = None
+        self.task = None
+        self.executor = None
+        self.services = []
+        self.sessions = {}  # session -> task
+        self.listener = None
+        self.stopping = None
+
+    def bind(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(tuple(address))
+            sock.listen(self.backlog)
+            sock.setblocking(False)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def run(self):
+        log.info('Starting server at {}'.format(self._localaddr))
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = futures.ThreadPoolExecutor(self.max_workers)
+        self.stopping = self.loop.create_future()
+        self.start_relay()
+        self.start_stats()
+
+        self.task = self.loop.create_task(self.serve())
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.close()
+
+    def stop(self):
+        """Stop serving. Safe to call from any thread"""
+        self.loop.call_soon_threadsafe(self.task.cancel)
+
+    def add_service(self, service):
+        """Run a service on the server loop.
+
+        Services are objects with an async start(loop) method and a close()
+        method, like hermes.api.Api.
+        """
+        self.services.append(service)
+
+    async def serve(self):
+        for service in self.services:
+            await service.start(self.loop)
+
+        self.listener = await asyncio.start_server(
+            self.handle, sock=self.socket, limit=self.stream_limit)
+        if not self.draining:
+            await self.stopping
+        await self.drain_sessions()
+
+    def drain(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set_result, None)
+
+    async def drain_sessions(self):
+        self.listener.close()  # stop accepting, sessions go on
+
+        # sessions out of a transaction are closed now when waiting for a
+        # command, or by converse before they read the next one
+        for session in list(self.sessions):
+            if session.mailfrom is None and session.reading_since is not None:
+                session.close_gracefully()
+
+        if not self.sessions:
+            return
+        done, pending = await asyncio.wait(list(self.sessions.values()), timeout=self.drain_timeout())
+        for session, task in list(self.sessions.items()):
+            if task in pending:
+                if not session.closing:
+                    log.warning('Session with {} abandoned on shutdown'.format(session.peer))
+                    session.abandoned = True
+                session.writer.transport.abort()
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=1)
+        for task in pending:
+            task.cancel()  # still waiting on its hooks or relay
+
+    async def handle(self, reader, writer):
+        self.metrics.increment('sessions')
+        nodelay(writer.get_extra_info('socket'))
+        session = Session(self, reader, writer)
+        self.sessions[session] = asyncio.current_task()
+        try:
+            await session.handle()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception as error:
+            log.error('Session with {} failed. {}: {}'.format(
+                session.peer, type(error), error), exc_info=True)
+        finally:
+            del self.sessions[session]
+            self.count_drained_session(session.drained, session.abandoned)
+            writer.close()
+
+    async def dispatch_message(self, *args, **kwargs):
+        """Run process_message off the event loop and return its reply"""
+        try:
+            return await self.loop.run_in_executor(
+                self.executor,
+                functools.partial(self.process_message, *args, **kwargs))
+        except Exception as error:
+            log.error('Failed to process message. {}: {}'.format(
+                type(error), error), exc_info=True)
+            return '451 Requested action aborted: local error in processing'
+
+    def close(self):
+        self.socket.close()
+
+        for service in self.services:
+            service.close()
+        self.close_stats()
+        self.close_relay()
+        self.close_hooks()
+        self.close_report()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP API over the mailbox and server metrics
+
+Served by the asyncio engine on the same event loop as SMTP sessions.
+
+    GET /messages?recipient=&sender=&subject=&since=&until=&after=&limit=
+        Matching messages, newest first. Pass the returned "next" value as
+        "after" to get the following page.
+    GET /messages/<id>
+        Message envelope
+    GET /messages/<id>/raw
+        Message as received, streamed
+    GET /wait?recipient=&sender=&subject=&since=&timeout=
+        Long poll: replies with the first matching message received since
+        the given time (default: now), or 404 after timeout seconds.
+    GET /metrics
+        Counters and per stage latency summaries, see hermes.metrics.
+        Add ?raw=1 to get the histograms.
+
+Mailbox routes reply 404 when the server has neither a mailbox nor a ring hook.
+"""
+
+import json
+import time
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+from . import metrics as metrics_summary
+
+log = logging.getLogger('hermes')
+
+FILTERS = ('sender', 'recipient', 'subject')
+RANGES = ('since', 'until')
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or REASONS[status])
+        self.status = status
+
+
+def envelope(message):
+    return dict(id=message.id, timestamp=message.timestamp, sender=message.sender,
+                recipients=message.recipients, size=message.size)
+
+
+def query_filters(params):
+    filters = dict((name, params[name]) for name in FILTERS if name in params)
+    try:
+        for name in RANGES:
+            if name in params:
+                filters[name] = float(params[name])
+    except ValueError:
+        raise HttpError(400, 'since and until should be timestamps')
+    return filters
+
+
+class Api(object):
+    max_page_size = 1000
+    max_wait = 300
+    chunk_size = 2 ** 16
+    header_size_limit = 2 ** 14
+
+    def __init__(self, address, mailbox=None, metrics=None):
+        self.address = address
+        self.mailbox = mailbox
+        self.metrics = metrics
+        self.waiters = {}  # future -> query filters
+        self.loop = None
+        self.server = None
+
+    @property
+    def store(self):
+        if self.mailbox is None:
+            raise HttpError(404, 'No mailbox')
+        return self.mailbox.open()
+
+    async def start(self, loop):
+        self.loop = loop
+        if self.mailbox is not None:
+            self.store.listeners.append(self.message_stored)
+        self.server = await asyncio.start_server(self.handle, *self.address)
+        log.info('Serving HTTP API at {}'.format(self.address))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for future in list(self.waiters):
+            future.cancel()
+
+    def message_stored(self, id):
+        # called from the thread which stored the message
+        self.loop.call_soon_threadsafe(self.wake_waiters)
+
+    def wake_waiters(self):
+        for future, filters in list(self.waiters.items()):
+            if future.done():
+                continue
+            ids = self.store.query(limit=1, **filters)
+            if ids:
+                future.set_result(ids[0])
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, params = await self.read_request(reader)
+            if method != 'GET':
+                raise HttpError(405)
+            await self.route(writer, path, params)
+        except HttpError as error:
+            self.respond(writer, error.status, dict(error=str(error)))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except Exception as error:
+            log.error('HTTP API request failed. {}: {}'.format(type(error), error), exc_info=True)
+            self.respond(writer, 500, dict(error='Internal error'))
+        finally:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def read_request(self, reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        if len(head) > self.header_size_limit:
+            raise HttpError(400)
+
+        try:
+            method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HttpError(400)
+
+        url = urlsplit(target)
+        params = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        return method, url.path.rstrip('/'), params
+
+    async def route(self, writer, path, params):
+        parts = path.strip('/').split('/')
+
+        if parts == ['messages']:
+            self.list_messages(writer, params)
+        elif len(parts) == 2 and parts[0] == 'messages':
+            self.respond(writer, 200, envelope(self.get_message(parts[1])))
+        elif len(parts) == 3 and parts[0] == 'messages' and parts[2] == 'raw':
+            await self.stream_message(writer, self.get_message(parts[1]))
+        elif parts == ['wait']:
+            await self.wait_message(writer, params)
+        elif parts == ['metrics'] and self.metrics is not None:
+            self.show_metrics(writer, params)
+        else:
+            raise HttpError(404)
+
+    def get_message(self, id):
+        try:
+            message = self.store.get(int(id))
+        except ValueError:
+            message = None
+        if message is None:
+            raise HttpError(404, 'No message {}'.format(id))
+        return message
+
+    def list_messages(self, writer, params):
+        try:
+            limit = min(int(params.get('limit', 100)), self.max_page_size)
+            after = int(params['after']) if 'after' in params else None
+        except ValueError:
+            raise HttpError(400, 'limit and after should be integers')
+
+        ids = self.store.query(limit=limit, after=after, reverse=True, **query_filters(params))
+        self.respond(writer, 200, dict(
+            messages=[envelope(self.store.get(id)) for id in ids],
+            next=ids[-1] if len(ids) == limit else None))
+
+    async def stream_message(self, writer, message):
+        body = message.body
+        self.write_head(writer, 200, 'message/rfc822', len(body))
+        for start in range(0, len(body), self.chunk_size):
+            writer.write(bytes(body[start:start + self.chunk_size]))
+            await writer.drain()
+
+    async def wait_message(self, writer, params):
+        filters = query_filters(params)
+        filters.setdefault('since', time.time())
+        try:
+            timeout = min(float(params.get('timeout', 30)), self.max_wait)
+        except ValueError:
+            raise HttpError(400, 'timeout should be a number of seconds')
+
+        ids = self.store.query(limit=1, **filters)
+        if ids:
+            return self.respond(writer, 200, envelope(self.store.get(ids[0])))
+
+        future = self.loop.create_future()
+        self.waiters[future] = filters
+        try:
+            id = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(404, 'No matching message after {} seconds'.format(timeout))
+        finally:
+            self.waiters.pop(future, None)
+
+        self.respond(writer, 200, envelope(self.store.get(id)))
+
+    def show_metrics(self, writer, params):
+        snapshot = self.metrics.snapshot()
+        if not params.get('raw'):
+            snapshot['stages'] = metrics_summary.summary(snapshot)
+        self.respond(writer, 200, snapshot)
+
+    def respond(self, writer, status, document):
+        body = json.dumps(document).encode('utf-8')
+        self.write_head(writer, status, 'application/json', len(body))
+        writer.write(body)
+
+    def write_head(self, writer, status, content_type, length):
+        writer.write(u'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                     u'Connection: close\r\n\r\n'
+                     .format(status, REASONS[status], content_type, length).encode('latin-1'))
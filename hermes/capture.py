@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Traffic capture files
+
+A capture is a magic string followed by one record per accepted message:
+a header (record length, arrival timestamp, sender and recipients sizes)
+then the sender, the recipients separated by newlines and the message:
+
+    writer = CaptureWriter('traffic.hcap')
+    writer.append(time.time(), 'me@example.com', ['you@example.com'], message)
+
+    for captured in read_capture('traffic.hcap'):
+        captured.timestamp, captured.sender, captured.recipients, captured.body
+
+Each record is appended with a single writev on a file opened with
+O_APPEND, so worker processes can capture to the same file. Captures are
+read back one record at a time and never held in memory as a whole.
+"""
+
+import os
+import fcntl
+import struct
+import logging
+import threading
+
+log = logging.getLogger('hermes')
+
+MAGIC = b'HERMESC1'
+RECORD = struct.Struct('>IdHI')  # record length, arrival timestamp, sender size, recipients size
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CapturedMessage(object):
+    __slots__ = ('timestamp', 'sender', 'recipients', 'body')
+
+    def __init__(self, timestamp, sender, recipients, body):
+        self.timestamp = timestamp
+        self.sender = sender
+        self.recipients = recipients
+        self.body = body
+
+    def __repr__(self):
+        return '<CapturedMessage at {} from {}>'.format(self.timestamp, self.sender)
+
+
+def body_of(message):
+    if hasattr(message, 'getbuffer'):
+        return message.getbuffer()
+    if isinstance(message, str):
+        return message.encode('utf-8')
+    return message
+
+
+class CaptureWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.lock = threading.Lock()
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)  # another worker may be creating it too
+        try:
+            if not os.fstat(self.fd).st_size:
+                os.write(self.fd, MAGIC)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def append(self, timestamp, sender, recipients, message):
+        sender = sender.encode('utf-8')
+        recipients = u'\n'.join(recipients).encode('utf-8')
+        body = body_of(message)
+        length = RECORD.size + len(sender) + len(recipients) + len(body)
+        header = RECORD.pack(length, timestamp, len(sender), len(recipients))
+
+        with self.lock:
+            written = os.writev(self.fd, [header, sender, recipients, body])
+        if written != length:
+            raise CaptureError('Short write to {}, {} of {} bytes'.format(self.path, written, length))
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+def read_capture(path):
+    """Iterate over the messages of a capture, oldest first"""
+    with open(path, 'rb') as stream:
+        if stream.read(len(MAGIC)) != MAGIC:
+            raise CaptureError('{} is not a hermes capture'.format(path))
+
+        while True:
+            header = stream.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                break
+            length, timestamp, sender_size, recipients_size = RECORD.unpack(header)
+            data = stream.read(length - RECORD.size)
+            if len(data) < length - RECORD.size:
+                break
+            recipients = data[sender_size:sender_size + recipients_size].decode('utf-8')
+            yield CapturedMessage(timestamp, data[:sender_size].decode('utf-8'),
+                                  recipients.split('\n') if recipients else [],
+                                  data[sender_size + recipients_size:])
+
+    log.warning('Incomplete last record in {}, skipped'.format(path))
@@ -2,102 +2,544 @@
 
 import os
 import sys
+import glob
+import time
+import signal
 import json
 import logging
-import logging.config
 import argparse
 
-from stevedore import extension
-
+from . import plugins
 from .daemon import Daemon
-from .smtp import Server
+from .daemons import Supervisor, read_pids, signal_pids
 
 log = logging.getLogger('hermes')
 
+# control commands (stop, status, stats, hooks) import neither the
+# server nor the extensions, so they return right away
+SERVER_ACTIONS = ('run', 'start', 'restart')
+
+# settings bound to the listening socket or the processes, which SIGHUP
+# does not reload
+RESTART_SETTINGS = ('ip', 'port', 'engine', 'workers', 'api_address', 'spool_threshold',
+                    'spool_directory', 'stdout', 'stderr', 'log_queue_size', 'shutdown_timeout',
+                    'relay_retry_directory', 'relay_retry_attempts', 'relay_retry_delay',
+                    'relay_retry_max_delay', 'relay_retry_batch_size', 'relay_retry_compress',
+                    'sender_rate', 'sender_burst', 'recipient_rate', 'recipient_burst', 'duplicate_window',
+                    'throttle_table_size')
+
+# hooks whose messages the HTTP API serves, the first one set wins
+MAILBOX_HOOKS = ('mailbox', 'ring')
+
 _LOGGING_FMT_ = '%(asctime)s %(levelname)-8s %(message)s'
 
 
 class MailDaemon(Daemon):
-    def initialize(self, server_instance):
+    def initialize(self, server_instance, server_factory=None, workers=1):
         self.server_instance = server_instance
+        self.server_factory = server_factory
+        self.workers = workers
+
+    @property
+    def workers_pidsfile(self):
+        return os.path.splitext(self.pidfile)[0] + '.workers'
 
     def run(self):
         try:
-            self.server_instance.run()
+            if self.workers > 1:
+                Supervisor(self.serve, self.workers, self.workers_pidsfile).run()
+            else:
+                serve(self.server_instance)
         except Exception as error:
             log.error((Exception, error))
 
+    def serve(self):
+        serve(self.server_factory())
+
+    def status(self):
+        status = Daemon.status(self)
+        workers = read_pids(self.workers_pidsfile)
+        if workers:
+            status += u' workers: {}'.format(u', '.join(str(pid) for pid in workers))
+        return status
+
+    def reload(self):
+        """Ask the daemon to reload its hooks and configuration"""
+        self.send_signal(signal.SIGHUP)
+
+    def profile(self):
+        """Ask the daemon to start profiling, or to stop and write the profile"""
+        self.send_signal(signal.SIGUSR1)
+
+    def send_signal(self, signum):
+        pid = self.read_pid()
+        if pid is None:
+            sys.stderr.write(u"pidfile {} does not exist. Daemon not running?\n".format(self.pidfile))
+            sys.exit(1)
+        os.kill(pid, signum)
+
+    def stop(self, timeout=None):
+        Daemon.stop(self, timeout)
+
+        # workers left behind by a master which did not exit cleanly
+        if signal_pids(read_pids(self.workers_pidsfile)):
+            time.sleep(0.1)
+        if os.path.exists(self.workers_pidsfile):
+            os.remove(self.workers_pidsfile)
+
 
 def public_ip():
+    """Address of the interface routing to the outside world.
+
+    Connecting an UDP socket only picks the route, no packet is sent.
+    """
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        import subprocess
-        return subprocess.call("/sbin/ifconfig").split("\n")[1].split()[1][5:]
-    except Exception:
-        import socket
-        return socket.gethostbyname(socket.gethostname())
+        sock.connect(('8.8.8.8', 53))
+        return sock.getsockname()[0]
+    except (IOError, OSError):
+        try:
+            return socket.gethostbyname(socket.gethostname())
+        except (IOError, OSError):
+            return '127.0.0.1'
+    finally:
+        sock.close()
+
+
+def server_class(engine):
+    if engine == 'asyncio':
+        from .aiosmtp import AsyncServer
+        return AsyncServer
+    from .smtp import Server
+    return Server
+
 
+def configure_extensions(extensions, hook_options):
+    """Raises ValueError on invalid hook options"""
+    for name, obj in extensions.items():
+        if hasattr(obj, 'configure'):
+            obj.configure(hook_options.get(name, {}))
+
+
+def bind_metrics(extensions, metrics):
+    for obj in extensions.values():
+        if getattr(obj, 'accepts_metrics', False):
+            obj.metrics = metrics
+
+
+def api_mailbox(args):
+    """Name of the hook whose messages the HTTP API serves, if any"""
+    return next((name for name in MAILBOX_HOOKS if name in args.hooks), None)
+
+
+def create_hooks(args, extensions):
+    from . import hooks as hook_policies
 
-def create_server(args):
     # restrict extensions to the ones listed in hooks
-    hooks = [obj for name, obj in args.extensions.items() if name in args.hooks]
+    executors = hook_policies.Executors()
+    return [hook_policies.create_hook(name, obj, args.hook_options.get(name, {}), executors)
+            for name, obj in extensions.items() if name in args.hooks]
+
+
+def create_server(args, reuse_port=False):
+    try:
+        configure_extensions(args.extensions, args.hook_options)
+    except ValueError as error:
+        print(u'Invalid hook options:\n {}'.format(error))
+        sys.exit(1)
+    hooks = create_hooks(args, args.extensions)
 
     try:
         print(u'Starting SMTP server at {}:{}'.format(args.ip, args.port))
-        return Server.create((args.ip, args.port), hooks, args.proxy_address)
+        server = server_class(args.engine).create(
+            (args.ip, args.port), hooks, args.proxy_address,
+            relay_options=relay_options(args),
+            queue_options=queue_options(args),
+            spool_options=spool_options(args),
+            stats_file=stats_file(args),
+            rules=args.rules,
+            retry_options=retry_options(args),
+            throttle_options=throttle_options(args),
+            reuse_port=reuse_port)
+    except (IOError, OSError) as error:
+        print(u'Could not run daemon on {}:{}. {}'
+              .format(args.ip, args.port, error))
+        sys.exit(1)
+
+    bind_metrics(args.extensions, server.metrics)
+    if args.api_address:
+        from .api import Api
+        print(u'Serving HTTP API at {}:{}'.format(*args.api_address))
+        mailbox = args.extensions[api_mailbox(args)] if api_mailbox(args) else None
+        server.add_service(Api(args.api_address, mailbox, server.metrics))
+
+    if args.action != 'run':
+        server.shutdown_file = shutdown_file(args)  # read by `hermes stop`
+    watch_reload(server, args)
+    watch_shutdown(server, args)
+    watch_profile(server, args)
+    return server
+
+
+def watch_profile(server, args):
+    """Toggle profiling on SIGUSR1"""
+    path = profile_file(args)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: server.toggle_profiling(path.format(pid=os.getpid())))
+
+
+def watch_shutdown(server, args):
+    """Shut down gracefully on SIGTERM"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown(args.shutdown_timeout))
+
+
+def watch_reload(server, args):
+    """Reload hooks, rules and relay settings on SIGHUP"""
+    import threading
+
+    lock = threading.Lock()
+
+    def reload_once():
+        with lock:
+            reload_server(server, args)
+
+    def reload(signum, frame):
+        # off the signal handler, which interrupts the server thread
+        threading.Thread(target=reload_once, name='hermes-reload').start()
+
+    signal.signal(signal.SIGHUP, reload)
+
+
+def reload_server(server, args):
+    """Read the command line and --config again, and swap the new hooks,
+    rules and relay settings in for the next messages"""
+    log.info('Reloading configuration')
+    try:
+        reloaded = parse_args(plugins.entry_points(), config=args.config)
+    except (SystemExit, IOError, OSError, ValueError) as error:
+        log.error('Invalid configuration, keeping the current one. {}'.format(error))
+        return
+
+    reloaded.ip = args.ip if reloaded.ip is None else reloaded.ip
+    ignored = [name for name in RESTART_SETTINGS if getattr(reloaded, name) != getattr(args, name)]
+    if ignored:
+        log.warning('Changing {} needs a restart, ignored'.format(', '.join(ignored)))
+    for name in ignored:
+        setattr(reloaded, name, getattr(args, name))
+
+    # hooks whose options did not change keep their instance, and its state
+    kept = dict((name, obj) for name, obj in args.extensions.items()
+                if name in reloaded.hooks and
+                reloaded.hook_options.get(name, {}) == args.hook_options.get(name, {}))
+    mailbox = api_mailbox(args) if args.api_address else None
+    if mailbox and mailbox not in kept:
+        log.warning('The HTTP API serves the {} hook it started with, its options ignored'.format(mailbox))
+        kept[mailbox] = args.extensions[mailbox]
+        reloaded.hooks.add(mailbox)
+        reloaded.hook_options[mailbox] = args.hook_options.get(mailbox, {})
+
+    try:
+        loaded = load_extensions(set(reloaded.hooks) - set(kept))
+        configure_extensions(loaded, reloaded.hook_options)
+        bind_metrics(loaded, server.metrics)
+    except Exception as error:
+        log.error('Could not load hooks, keeping the current ones. {}: {}'.format(type(error), error))
+        return
+    loaded.update(kept)
+    broken_hook_names = set(reloaded.hooks) - set(loaded)
+    if broken_hook_names:
+        log.error('Could not load hooks {}, keeping the current ones'
+                  .format(', '.join(sorted(broken_hook_names))))
+        return
+
+    extensions = dict((name, loaded[name]) for name in sorted(loaded))
+    server.reconfigure(create_hooks(reloaded, extensions), reloaded.proxy_address,
+                       relay_options=relay_options(reloaded), queue_options=queue_options(reloaded),
+                       rules=reloaded.rules)
+
+    reloaded.extensions = extensions
+    vars(args).update(vars(reloaded))
+    log.info('Configuration reloaded, hooks: {}'.format(', '.join(extensions)))
+
+
+def check_shared_address(args):
+    """Exit early if workers will not be able to bind the address"""
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((args.ip, args.port))
     except (IOError, OSError) as error:
         print(u'Could not run daemon on {}:{}. {}'
               .format(args.ip, args.port, error))
         sys.exit(1)
+    finally:
+        sock.close()
 
 
-def load_extensions():
-    manager = extension.ExtensionManager(namespace='hermes.extensions.processors', invoke_on_load=True)
+def relay_options(args):
+    options = dict(
+        pool_size=args.relay_pool_size,
+        idle_timeout=args.relay_idle_timeout,
+        max_messages=args.relay_max_messages
+    )
+    if args.proxy_address and len(args.proxy_address) > 1:
+        options.update(
+            balance=args.relay_balance,
+            max_failures=args.relay_max_failures,
+            eject_time=args.relay_eject_time,
+            check_interval=args.relay_check_interval
+        )
+    return options
+
+
+def queue_options(args):
+    return dict(
+        size=args.relay_queue_size,
+        workers=args.relay_workers,
+        drain_timeout=args.relay_drain_timeout,
+        batch_size=args.relay_batch_size,
+        batch_wait=args.relay_batch_wait
+    )
+
+
+def retry_options(args):
+    return dict(
+        directory=args.relay_retry_directory,
+        max_attempts=args.relay_retry_attempts,
+        delay=args.relay_retry_delay,
+        max_delay=args.relay_retry_max_delay,
+        batch_size=args.relay_retry_batch_size,
+        compress=args.relay_retry_compress
+    )
+
+
+def throttle_options(args):
+    return dict(
+        sender_rate=args.sender_rate / 60.0,
+        sender_burst=args.sender_burst,
+        recipient_rate=args.recipient_rate / 60.0,
+        recipient_burst=args.recipient_burst,
+        window=args.duplicate_window,
+        size=args.throttle_table_size
+    )
+
+
+def spool_options(args):
+    return dict(
+        spool_threshold=args.spool_threshold,
+        spool_directory=args.spool_directory
+    )
+
+
+def load_extensions(names):
+    """Import and instantiate the named extensions only"""
+    from stevedore import named
+    from .extensions.base import Extension
+
+    manager = named.NamedExtensionManager(namespace=plugins.NAMESPACE, names=sorted(names),
+                                          invoke_on_load=True)
+    for loaded in manager.extensions:
+        if isinstance(loaded.obj, Extension):
+            loaded.obj.name = loaded.name
     return {extension.name: extension.obj for extension in manager.extensions}
 
 
-def parse_args(extensions):
+def parse_args(extension_names, config=None):
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("action", choices=['run', 'start', 'stop', 'restart', 'status', 'hooks'])
+    parser.add_argument("action", choices=['run', 'start', 'stop', 'restart', 'reload', 'profile', 'status',
+                                           'stats', 'replay', 'hooks'])
     parser.add_argument("--ip", default=None, help=u"Server public ip")
     parser.add_argument("--port", default=None, type=int, help=u"Server specific port (default: 25)")
     parser.add_argument("--stdout", default=None, help=u"Redirect standar output to a file")
     parser.add_argument("--stderr", default=None, help=u"Redirect standar error output to a file")
     parser.add_argument("--config", default=None, help=u"Loads configuration from JSON file")
-    parser.add_argument("--proxy", default=None, metavar='IP:PORT',
-                        help=u"Proxy messages to another SMPT server (ip:port)")
-    parser.add_argument("--hook", action='append', dest='hooks', default=[],
+    parser.add_argument("--proxy", default=None, metavar='IP:PORT[:WEIGHT],...',
+                        help=u"Proxy messages to another SMPT server (ip:port), or balance them across "
+                        "several ones")
+    parser.add_argument("--relay-balance", default=None,
+                        choices=['least-outstanding', 'round-robin', 'domain'],
+                        help=u"How messages are spread across several relay servers "
+                        "(default: least-outstanding)")
+    parser.add_argument("--relay-max-failures", default=None, type=int, metavar='N',
+                        help=u"Eject a relay server after N failed sessions in a row (default: 3)")
+    parser.add_argument("--relay-eject-time", default=None, type=float, metavar='SECONDS',
+                        help=u"Time an ejected relay server is left alone (default: 30)")
+    parser.add_argument("--relay-check-interval", default=None, type=float, metavar='SECONDS',
+                        help=u"Probe relay servers with NOOP every SECONDS, 0 to never (default: 10)")
+    parser.add_argument("--relay-pool-size", default=None, type=int, metavar='N',
+                        help=u"Keep up to N relay connections open, and no more (default: 0)")
+    parser.add_argument("--relay-idle-timeout", default=None, type=float, metavar='SECONDS',
+                        help=u"Close pooled relay connections idle for longer (default: 30)")
+    parser.add_argument("--relay-max-messages", default=None, type=int, metavar='N',
+                        help=u"Reopen a pooled relay connection after N messages (default: 100)")
+    parser.add_argument("--relay-queue-size", default=None, type=int, metavar='N',
+                        help=u"Relay in the background, queueing up to N messages (default: 0, relay inline)")
+    parser.add_argument("--relay-workers", default=None, type=int, metavar='N',
+                        help=u"Number of background relay workers (default: 4)")
+    parser.add_argument("--relay-drain-timeout", default=None, type=float, metavar='SECONDS',
+                        help=u"Time allowed to relay queued messages on shutdown (default: 30)")
+    parser.add_argument("--relay-batch-size", default=None, type=int, metavar='N',
+                        help=u"Relay up to N queued messages for a domain over one session (default: 1)")
+    parser.add_argument("--relay-batch-wait", default=None, type=float, metavar='SECONDS',
+                        help=u"Longest time a queued message waits for its batch to fill (default: 0)")
+    parser.add_argument("--relay-retry-directory", default=None, metavar='PATH',
+                        help=u"Keep messages the relay server did not take in PATH and relay them again "
+                        "(default: none, they are dropped)")
+    parser.add_argument("--relay-retry-attempts", default=None, type=int, metavar='N',
+                        help=u"Drop a deferred message after N failed relays (default: 10)")
+    parser.add_argument("--relay-retry-delay", default=None, type=float, metavar='SECONDS',
+                        help=u"Wait before relaying a deferred message again, doubled every attempt "
+                        "(default: 30)")
+    parser.add_argument("--relay-retry-max-delay", default=None, type=float, metavar='SECONDS',
+                        help=u"Longest wait between attempts (default: 3600)")
+    parser.add_argument("--relay-retry-batch-size", default=None, type=int, metavar='N',
+                        help=u"Relay up to N deferred messages over one session (default: 50)")
+    parser.add_argument("--relay-retry-compress", action="store_true", default=None,
+                        help=u"Compress deferred messages with dictionaries trained on them")
+    parser.add_argument("--sender-rate", default=None, type=float, metavar='N',
+                        help=u"Accept up to N messages a minute from a sender (default: 0, no limit)")
+    parser.add_argument("--sender-burst", default=None, type=int, metavar='N',
+                        help=u"Messages a sender may send at once before --sender-rate applies (default: 10)")
+    parser.add_argument("--recipient-rate", default=None, type=float, metavar='N',
+                        help=u"Accept up to N messages a minute for a recipient (default: 0, no limit)")
+    parser.add_argument("--recipient-burst", default=None, type=int, metavar='N',
+                        help=u"Messages a recipient may get at once before --recipient-rate applies "
+                        "(default: 10)")
+    parser.add_argument("--duplicate-window", default=None, type=float, metavar='SECONDS',
+                        help=u"Refuse messages repeating one accepted less than SECONDS ago (default: 0)")
+    parser.add_argument("--throttle-table-size", default=None, type=int, metavar='N',
+                        help=u"Senders, recipients and messages remembered by the throttle (default: 10000)")
+    parser.add_argument("--shutdown-timeout", default=None, type=float, metavar='SECONDS',
+                        help=u"Time allowed on stop to finish open sessions and relay queued messages "
+                        "(default: 30)")
+    parser.add_argument("--hook-options", default=None, type=json.loads, metavar='JSON',
+                        help=u"Per hook execution options, eg: "
+                        "'{\"printer\": {\"executor\": \"thread\", \"timeout\": 5}}'")
+    parser.add_argument("--rules", default=None, type=json.loads, metavar='JSON',
+                        help=u"Recipient routing rules, eg: "
+                        "'[{\"match\": \"*.example.com\", \"action\": \"drop\"}]'")
+    parser.add_argument("--workers", default=None, type=int, metavar='N',
+                        help=u"Serve from N processes sharing the port (default: 1)")
+    parser.add_argument("--spool-threshold", default=None, type=int, metavar='BYTES',
+                        help=u"Spool bigger messages to disk, asyncio engine only (default: 1048576)")
+    parser.add_argument("--spool-directory", default=None, metavar='PATH',
+                        help=u"Directory for spooled messages (default: system temporary directory)")
+    parser.add_argument("--api", default=None, metavar='IP:PORT',
+                        help=u"Serve the HTTP API, with metrics and the mailbox (asyncio engine only)")
+    parser.add_argument("--log-queue-size", default=None, type=int, metavar='N',
+                        help=u"Log from a background thread, dropping records beyond N queued ones "
+                        "(default: 10000, 0 to log synchronously)")
+    parser.add_argument("--engine", default=None, choices=['smtpd', 'asyncio'],
+                        help=u"SMTP server implementation (default: smtpd)")
+    parser.add_argument("--hook", action='append', dest='hooks', default=None,
                         help=u"Load message processor by name. Can be used multiple times."
-                        " the 'printer' processor is always attached".format(extensions))
+                        " the 'printer' processor is always attached")
+
+    parser.add_argument("--capture", default=None, metavar='PATH',
+                        help=u"Capture file to replay, written by the capture hook")
+    parser.add_argument("--speed", default=None, type=speed, metavar='N',
+                        help=u"Replay N times faster than captured, or 'max' (default: 1)")
+    parser.add_argument("--connections", default=None, type=int, metavar='N',
+                        help=u"Replay over N concurrent SMTP connections (default: 10)")
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--verbose", action="store_true", default=None, help="Verbose output")
     group.add_argument("--silent", action="store_true", default=None, help="Less verbose output")
 
     args = parser.parse_args()
+    if config is not None:
+        args.config = config
     update_args_from_config(args)
     set_args_default_values(args)
 
-    args.extensions = extensions
+    args.extension_names = extension_names
+    args.extensions = {}
 
-    validate_args(args)
+    if args.action in SERVER_ACTIONS:
+        validate_args(args)
 
     return args
 
 
+def address(value):
+    ip, _, port = value.rpartition(':')
+    return ip or '127.0.0.1', int(port)
+
+
+def speed(value):
+    return 0 if value == 'max' else float(value)
+
+
+def upstreams(value):
+    """[(ip, port, weight)] from ip:port[:weight] separated by commas"""
+    found = []
+    for upstream in value.split(','):
+        fields = upstream.strip().split(':')
+        if len(fields) not in (2, 3) or not fields[0]:
+            raise ValueError(upstream)
+        weight = int(fields[2]) if len(fields) == 3 else 1
+        if weight < 1:
+            raise ValueError(upstream)
+        found.append((fields[0], int(fields[1]), weight))
+    return found
+
+
 def set_args_default_values(args):
-    args.hooks = set(['printer'] + args.hooks)
+    args.hooks = set(['printer'] + (args.hooks or []))
     args.port = 25 if args.port is None else args.port
-    args.ip = public_ip() if args.ip is None else args.ip
+    args.engine = 'smtpd' if args.engine is None else args.engine
+    args.workers = 1 if args.workers is None else args.workers
+    args.spool_threshold = 2 ** 20 if args.spool_threshold is None else args.spool_threshold
+    args.hook_options = {} if args.hook_options is None else args.hook_options
     args.stderr = 'error.log' if args.stderr is None else args.stderr
-    args.proxy_address = args.proxy.split(':') if args.proxy else None
+    try:
+        args.proxy_address = upstreams(args.proxy) if args.proxy else None
+    except ValueError:
+        print(u'Invalid --proxy {}, should be ip:port[:weight] separated by commas'.format(args.proxy))
+        sys.exit(1)
+    args.relay_balance = 'least-outstanding' if args.relay_balance is None else args.relay_balance
+    args.relay_max_failures = 3 if args.relay_max_failures is None else args.relay_max_failures
+    args.relay_eject_time = 30 if args.relay_eject_time is None else args.relay_eject_time
+    args.relay_check_interval = 10 if args.relay_check_interval is None else args.relay_check_interval
+    args.api_address = address(args.api) if args.api else None
     args.stdout = 'output.log' if args.stdout is None else args.stdout
+    args.relay_pool_size = 0 if args.relay_pool_size is None else args.relay_pool_size
+    args.relay_idle_timeout = 30 if args.relay_idle_timeout is None else args.relay_idle_timeout
+    args.relay_max_messages = 100 if args.relay_max_messages is None else args.relay_max_messages
+    args.relay_queue_size = 0 if args.relay_queue_size is None else args.relay_queue_size
+    args.relay_workers = 4 if args.relay_workers is None else args.relay_workers
+    args.relay_drain_timeout = 30 if args.relay_drain_timeout is None else args.relay_drain_timeout
+    args.relay_batch_size = 1 if args.relay_batch_size is None else args.relay_batch_size
+    args.relay_batch_wait = 0 if args.relay_batch_wait is None else args.relay_batch_wait
+    if args.relay_retry_directory:
+        args.relay_retry_directory = os.path.abspath(args.relay_retry_directory)  # daemons chdir to /
+    args.relay_retry_attempts = 10 if args.relay_retry_attempts is None else args.relay_retry_attempts
+    args.relay_retry_delay = 30 if args.relay_retry_delay is None else args.relay_retry_delay
+    args.relay_retry_max_delay = 3600 if args.relay_retry_max_delay is None else args.relay_retry_max_delay
+    args.relay_retry_batch_size = 50 if args.relay_retry_batch_size is None else args.relay_retry_batch_size
+    args.relay_retry_compress = bool(args.relay_retry_compress)
+    args.sender_rate = 0 if args.sender_rate is None else args.sender_rate
+    args.sender_burst = 10 if args.sender_burst is None else args.sender_burst
+    args.recipient_rate = 0 if args.recipient_rate is None else args.recipient_rate
+    args.recipient_burst = 10 if args.recipient_burst is None else args.recipient_burst
+    args.duplicate_window = 0 if args.duplicate_window is None else args.duplicate_window
+    args.throttle_table_size = 10000 if args.throttle_table_size is None else args.throttle_table_size
+    args.speed = 1 if args.speed is None else args.speed
+    args.connections = 10 if args.connections is None else args.connections
+    args.log_queue_size = 10000 if args.log_queue_size is None else args.log_queue_size
+    args.shutdown_timeout = 30 if args.shutdown_timeout is None else args.shutdown_timeout
+    args.rules = [] if args.rules is None else args.rules
 
     return args
 
 
 def update_args_from_config(args):
     if args.config is not None:
+        # read again on reload, after daemons chdir to /
+        args.config = os.path.realpath(args.config)
         with open(args.config, 'r') as stream:
             config = json.load(stream)
 
@@ -107,16 +549,40 @@ def update_args_from_config(args):
 
 
 def validate_args(args):
-    unknown_hook_names = set(args.hooks) - set(args.extensions)
+    from . import hooks as hook_policies
+    from . import rules as routing
+
+    unknown_hook_names = set(args.hooks) - set(args.extension_names)
     if unknown_hook_names:
         print('Unknown hook names:\n {}'.format(", ".join(unknown_hook_names)))
-        print('Should be one of:\n {}'.format(", ".join(args.extensions)))
+        print('Should be one of:\n {}'.format(", ".join(args.extension_names)))
+        sys.exit(1)
+
+    if args.api_address and (args.engine != 'asyncio' or args.workers > 1):
+        print('The HTTP API needs --engine asyncio and a single worker')
+        sys.exit(1)
+
+    if 'mailbox' in args.hooks and args.workers > 1:
+        print('The mailbox hook needs a single worker, a mailbox directory is used by one process')
+        sys.exit(1)
+
+    hook_option_errors = hook_policies.validate_options(args.hook_options)
+    if hook_option_errors:
+        print('Invalid hook options:\n {}'.format("\n ".join(hook_option_errors)))
+        sys.exit(1)
+
+    rule_errors = routing.validate(args.rules, args.hooks)
+    if rule_errors:
+        print('Invalid rules:\n {}'.format("\n ".join(rule_errors)))
         sys.exit(1)
 
     return args
 
 
 def configure_logging(args):
+    import logging.config
+    from . import logs
+
     verbosity = 'DEBUG' if args.verbose else 'INFO'
     verbosity = 'WARNING' if args.silent else verbosity
 
@@ -143,6 +609,11 @@ def configure_logging(args):
         }
     })
 
+    if args.log_queue_size:
+        logger = logging.getLogger('hermes')
+        handlers, logger.handlers = logger.handlers, []
+        logger.addHandler(logs.QueueHandler(handlers, args.log_queue_size))
+
 
 def daemon_arguments(args):
     return dict(
@@ -152,23 +623,72 @@ def daemon_arguments(args):
     )
 
 
-def run(args):
-    server = create_server(args)
+def serve(server):
     try:
         server.run()
     except KeyboardInterrupt:
         pass
+    finally:
+        server.close()
+
+
+def run(args):
+    if args.workers > 1:
+        check_shared_address(args)
+        Supervisor(lambda: serve(create_server(args, reuse_port=True)), args.workers).run()
+    else:
+        serve(create_server(args))
 
 
 def start(args):
     daemon = MailDaemon.create(**daemon_arguments(args))
-    daemon.initialize(create_server(args))
+    if args.workers > 1:
+        check_shared_address(args)
+        daemon.initialize(None, lambda: create_server(args, reuse_port=True), args.workers)
+    else:
+        daemon.initialize(create_server(args))
     daemon.start()
 
 
 def stop(args):
     daemon = MailDaemon.create(**daemon_arguments(args))
-    daemon.stop()
+    pids = [daemon.read_pid()] + read_pids(daemon.workers_pidsfile)
+    # killed when it did not exit a while after its deadline
+    daemon.stop(timeout=args.shutdown_timeout + 10)
+
+    pattern = shutdown_file(args)
+    report = read_shutdown_reports([pattern.format(pid=pid) for pid in pids if pid is not None])
+    if report:
+        print(format_shutdown_report(report))
+
+
+def shutdown_file(args):
+    """Every serving process reports its shutdown in <pidfile>.<pid>.shutdown"""
+    return os.path.splitext(stats_file(args))[0] + '.shutdown'
+
+
+def read_shutdown_reports(paths):
+    """Sum of the shutdown reports, which are removed once read"""
+    report = {}
+    for path in paths:
+        try:
+            with open(path) as stream:
+                found = json.load(stream)
+            os.remove(path)
+        except (IOError, OSError, ValueError):
+            continue
+        for key, value in found.items():
+            if key == 'seconds':
+                report[key] = max(report.get(key, 0), value)
+            elif key != 'pid':
+                report[key] = report.get(key, 0) + value
+    return report
+
+
+def format_shutdown_report(report):
+    return (u'Drained in {seconds:.1f}s: {sessions_finished} sessions finished, {sessions_closed} idle '
+            u'sessions closed, {relay_drained} queued messages relayed\n'
+            u'Abandoned: {sessions_abandoned} sessions, {relay_abandoned} queued messages'.format(**report))
 
 
 def restart(args):
@@ -176,22 +696,104 @@ def restart(args):
     start(args)
 
 
+def reload(args):
+    daemon = MailDaemon.create(**daemon_arguments(args))
+    daemon.reload()
+
+
+def profile(args):
+    daemon = MailDaemon.create(**daemon_arguments(args))
+    daemon.profile()
+    print(u'Profiling toggled, profiles are written to {}'.format(profile_file(args).format(pid='<pid>')))
+
+
 def status(args):
     daemon = MailDaemon.create(**daemon_arguments(args))
     print(daemon.status())
 
 
-def list_hooks(args):
-    if args.extensions:
-        print("\n".join(args.extensions))
+def stats_file(args):
+    """Every serving process writes its metrics to <pidfile>.<pid>.stats"""
+    pidfile = MailDaemon.create(**daemon_arguments(args)).pidfile
+    return os.path.splitext(pidfile)[0] + '.{pid}.stats'
 
 
-def main():
-    args = parse_args(load_extensions())
+def profile_file(args):
+    """Every serving process writes its profile to <pidfile>.<pid>.prof"""
+    return os.path.splitext(stats_file(args))[0] + '.prof'
+
+
+def read_stats(pattern):
+    snapshots = []
+    for path in glob.glob(pattern.format(pid='*')):
+        pid = path[:-len('.stats')].rpartition('.')[2]
+        if not pid.isdigit() or not running(int(pid)):
+            continue  # left behind by a process which did not exit cleanly
+        try:
+            with open(path) as stream:
+                snapshots.append(json.load(stream))
+        except (IOError, OSError, ValueError):
+            continue
+    return snapshots
+
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def stats(args):
+    from . import metrics
+
+    snapshots = read_stats(stats_file(args))
+    if not snapshots:
+        print(u'No stats found, is the server running?')
+        sys.exit(1)
+    print(metrics.format_snapshot(metrics.merge(snapshots)))
+
+
+def replay(args):
+    from .capture import CaptureError
+    from .replay import Replay, format_report
+
+    if not args.capture:
+        print(u'replay needs --capture PATH')
+        sys.exit(1)
+
+    target = (args.ip or '127.0.0.1', args.port)
+    print(u'Replaying {} to {}:{}'.format(args.capture, *target))
+    try:
+        report = Replay(args.capture, target, speed=args.speed, connections=args.connections).run()
+    except (IOError, OSError, CaptureError) as error:
+        print(u'Could not replay {}. {}'.format(args.capture, error))
+        sys.exit(1)
+    print(format_report(report))
 
-    configure_logging(args)
 
-    actions = dict(run=run, stop=stop, start=start, restart=restart, status=status, hooks=list_hooks)
+def list_hooks(args):
+    if args.extension_names:
+        print("\n".join(sorted(args.extension_names)))
+
+
+def main():
+    args = parse_args(plugins.entry_points())
+
+    if args.action in SERVER_ACTIONS:
+        args.ip = public_ip() if args.ip is None else args.ip
+        args.extensions = load_extensions(args.hooks)
+        broken_hook_names = set(args.hooks) - set(args.extensions)
+        if broken_hook_names:
+            print('Could not load hooks:\n {}'.format(", ".join(sorted(broken_hook_names))))
+            sys.exit(1)
+        configure_logging(args)
+
+    actions = dict(run=run, stop=stop, start=start, restart=restart, reload=reload, profile=profile,
+                   status=status, stats=stats, replay=replay, hooks=list_hooks)
     action = actions[args.action]
     action(args)
 
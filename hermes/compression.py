@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Message compression with shared dictionaries
+
+Messages are compressed one by one, so any of them is read back alone,
+with deflate primed with a preset dictionary. Trapped mail repeats the
+same templates and boilerplate, which the dictionary holds once instead
+of every message:
+
+    codec = Codec('/var/lib/hermes')
+    codec.sample(body)  # trains the first dictionary once enough is sampled
+    dictionary, data = codec.compress([body])
+    codec.decompress(dictionary, data)
+
+A dictionary is trained from the pieces of lines repeated across the
+sampled messages, cut at digits as ids and dates change from a message
+to the next, the ones saving the most bytes last, where deflate finds
+them closest. Dictionaries are saved as numbered files next to the data and
+every compressed message names the one it was compressed with, so a new
+dictionary leaves older messages readable. Dictionary 0 is none at all.
+"""
+
+import os
+import re
+import zlib
+import logging
+import threading
+import collections
+
+log = logging.getLogger('hermes')
+
+DICTIONARY_SIZE = 32 * 1024  # deflate looks back 32KB at most
+DICTIONARY_SUFFIX = '.dict'
+SAMPLE_SIZE = 2 ** 16  # of each message
+WBITS = -15  # raw deflate, no header nor checksum
+FRAGMENT = re.compile(br'[^\d\r\n]{8,}[\r\n]*')
+
+
+class CompressionError(Exception):
+    pass
+
+
+def train(samples, size=DICTIONARY_SIZE):
+    """A dictionary of the fragments found in more than one sample"""
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(FRAGMENT.findall(sample)))
+
+    chosen, total = [], 0
+    for saving, line in sorted(((count * len(line), line) for line, count in counts.items()
+                                if count > 1), reverse=True):
+        if total + len(line) <= size:
+            chosen.append(line)
+            total += len(line)
+    return b''.join(reversed(chosen))
+
+
+class Codec(object):
+    def __init__(self, directory, level=6, sample_size=2 ** 20):
+        self.directory = directory
+        self.level = level
+        self.sample_size = sample_size
+        self.samples = collections.deque()
+        self.sampled = 0
+        self.fresh = 0  # samples taken since the last dictionary
+        self.dictionaries = {0: None}
+        self.current = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(DICTIONARY_SUFFIX):
+                with open(os.path.join(self.directory, name), 'rb') as stream:
+                    self.dictionaries[int(name[:-len(DICTIONARY_SUFFIX)])] = stream.read()
+        self.current = max(self.dictionaries)
+
+    def sample(self, body):
+        """Keep the start of a message to train dictionaries on"""
+        data = bytes(body[:SAMPLE_SIZE])
+        with self.lock:
+            self.samples.append(data)
+            self.sampled += len(data)
+            self.fresh += 1
+            while self.sampled - len(self.samples[0]) >= self.sample_size:
+                self.sampled -= len(self.samples.popleft())
+            untrained = not self.current and self.sampled >= self.sample_size
+        if untrained:
+            self.retrain()
+
+    def retrain(self):
+        """Train a dictionary on the recent samples and use it from now on"""
+        with self.lock:
+            if not self.fresh:
+                return
+            samples = list(self.samples)
+            self.fresh = 0
+        dictionary = train(samples)
+        if not dictionary:
+            return
+
+        with self.lock:
+            id = max(self.dictionaries) + 1
+            path = os.path.join(self.directory, '{:05d}{}'.format(id, DICTIONARY_SUFFIX))
+            temporary = path + '.tmp'
+            with open(temporary, 'wb') as stream:
+                stream.write(dictionary)
+                stream.flush()
+                os.fsync(stream.fileno())  # before any message needs it
+            os.rename(temporary, path)
+            self.dictionaries[id] = dictionary
+            self.current = id
+        log.info('Trained compression dictionary {} ({} bytes) from {} messages'
+                 .format(path, len(dictionary), len(samples)))
+
+    def compress(self, chunks):
+        """(dictionary id, compressed data) of a message given as chunks"""
+        id = self.current
+        dictionary = self.dictionaries[id]
+        if dictionary is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS, zdict=dictionary)
+        data = [compressor.compress(chunk) for chunk in chunks]
+        data.append(compressor.flush())
+        return id, b''.join(data)
+
+    def decompress(self, id, data):
+        dictionary = self.dictionaries.get(id, False)
+        if dictionary is False:
+            raise CompressionError('Compression dictionary {} missing from {}'.format(id, self.directory))
+        if dictionary is None:
+            decompressor = zlib.decompressobj(WBITS)
+        else:
+            decompressor = zlib.decompressobj(WBITS, zdict=dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
@@ -140,12 +140,20 @@ class Daemon(object):
         pid = self.read_pid()
         return u'running pid: {}'.format(pid) if pid is not None else u'stopped'
 
-    def kill(self, pid):
-        """Finish the daemon"""
-        # Try killing the daemon process
+    def kill(self, pid, timeout=None):
+        """Finish the daemon.
+
+        Sends SIGTERM once, so the daemon can shut down gracefully, and
+        waits for it to exit. It is sent SIGKILL after timeout seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        signum = signal.SIGTERM
         try:
             while 1:
-                os.kill(pid, signal.SIGTERM)
+                os.kill(pid, signum)
+                signum = 0
+                if deadline is not None and time.time() > deadline:
+                    signum = signal.SIGKILL
                 time.sleep(0.1)
         except OSError as err:
             err = str(err)
@@ -156,7 +164,7 @@ class Daemon(object):
                 print(err)
                 sys.exit(1)
 
-    def stop(self):
+    def stop(self, timeout=None):
         """Stop the daemon"""
         pid = self.read_pid()
 
@@ -165,7 +173,7 @@ class Daemon(object):
             sys.stderr.write(message.format(self.pidfile))
             return  # not an error in a restart
 
-        self.kill(pid)
+        self.kill(pid, timeout)
 
     def restart(self):
         """Restart the daemon """
@@ -1,4 +1,123 @@
 # -*- coding: utf-8 -*-
+"""
+Prefork process supervision
 
+The Supervisor forks a number of workers running the same target and
+restarts them when they die. Worker pids are listed in a file, one per
+line, so other processes can report on and signal the whole group.
 
+    supervisor = Supervisor(serve, workers=4, pidsfile='/tmp/hermes-25.workers')
+    supervisor.run()
+"""
 
+import os
+import time
+import signal
+import logging
+
+log = logging.getLogger('hermes')
+
+
+def read_pids(path):
+    try:
+        with open(path, 'r') as stream:
+            return [int(line) for line in stream.read().split()]
+    except (IOError, OSError, ValueError):
+        return []
+
+
+def signal_pids(pids, signum=signal.SIGTERM):
+    """Send a signal to every pid. Returns the ones still alive"""
+    alive = []
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+            alive.append(pid)
+        except OSError:
+            pass
+    return alive
+
+
+class Supervisor(object):
+    restart_delay = 1
+
+    def __init__(self, target, workers, pidsfile=None):
+        self.target = target
+        self.workers = workers
+        self.pidsfile = pidsfile
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.forward)
+        signal.signal(signal.SIGUSR1, self.forward)
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        try:
+            self.supervise()
+        finally:
+            self.remove_pids()
+
+    def supervise(self):
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            slot = self.children.pop(pid, None)
+            if slot is None or self.stopping:
+                self.write_pids()
+                continue
+
+            log.warning('Worker {} (pid {}) exited with status {}. Restarting'
+                        .format(slot, pid, status))
+            time.sleep(self.restart_delay)
+            if not self.stopping:
+                self.spawn(slot)
+
+    def spawn(self, slot):
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)  # until the worker handles them
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+            code = 0
+            try:
+                self.target()
+            except SystemExit as error:
+                code = error.code if isinstance(error.code, int) else 1
+            except BaseException:
+                log.exception('Worker {} failed'.format(slot))
+                code = 1
+            finally:
+                os._exit(code)
+
+        self.children[pid] = slot
+        self.write_pids()
+        return pid
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        signal_pids(list(self.children), signum)
+
+    def forward(self, signum, frame):
+        signal_pids(list(self.children), signum)
+
+    def write_pids(self):
+        if self.pidsfile is None:
+            return
+
+        with open(self.pidsfile, 'w+') as stream:
+            stream.write(u''.join(u'{}\n'.format(pid) for pid in sorted(self.children)))
+
+    def remove_pids(self):
+        if self.pidsfile is not None and os.path.exists(self.pidsfile):
+            os.remove(self.pidsfile)
@@ -2,5 +2,28 @@
 
 
 class Extension(object):
+    # Set to True to receive a hermes.message.Message instead of the whole
+    # message as bytes. It can be read as a stream, and its parsed headers
+    # and MIME parts (message.headers, message.email) are shared by every
+    # hook instead of being parsed again by each one
+    accepts_message = False
+
+    # Name the extension is registered with, set when it is loaded
+    name = None
+
+    # Set to True to be given the server Metrics before the first message, to
+    # count events of the extension along with the server ones. They stay in
+    # the server process, an extension run on a process pool goes without
+    accepts_metrics = False
+    metrics = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('metrics', None)  # holds thread locals, which cannot be pickled
+        return state
+
+    def configure(self, options):
+        """Receives the hook options given in --hook-options"""
+
     def __call__(self, address, sender, recipients, message):
         raise NotImplementedError('Not implemented')
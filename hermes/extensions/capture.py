@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+
+from .base import Extension
+from ..capture import CaptureWriter
+
+log = logging.getLogger('hermes')
+
+
+class Capture(Extension):
+    """Writes every message, with its envelope and arrival time, to a
+    capture file for `hermes replay`.
+
+    Hook options: path (default: ./capture.hcap). The file is opened on the
+    first message, once the daemon has forked.
+    """
+
+    accepts_message = True
+
+    def __init__(self):
+        self.path = os.path.realpath('capture.hcap')
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def configure(self, options):
+        # daemons chdir to / so relative paths are resolved now
+        self.path = os.path.realpath(options.get('path', self.path))
+
+    def open(self):
+        with self.lock:
+            if self.writer is None:
+                log.info('Capturing messages to {}'.format(self.path))
+                self.writer = CaptureWriter(self.path)
+            return self.writer
+
+    def __call__(self, address, sender, recipients, message):
+        self.open().append(time.time(), sender, recipients, message)
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import threading
+
+from .base import Extension
+from ..store import Store
+
+log = logging.getLogger('hermes')
+
+
+class Mailbox(Extension):
+    """Keeps every message in an append-only Store.
+
+    Hook options: directory (default: ./mailbox), segment_size, segment_age,
+    sync_interval, sync_batch, indexed, compress and compress_level. The store is opened on the first message,
+    once the daemon has forked.
+    """
+
+    accepts_message = True
+    store_options = ('segment_size', 'segment_age', 'sync_interval', 'sync_batch', 'indexed',
+                     'compress', 'compress_level')
+
+    def __init__(self):
+        self.directory = os.path.realpath('mailbox')
+        self.options = {}
+        self.store = None
+        self.lock = threading.Lock()
+
+    def configure(self, options):
+        # daemons chdir to / so relative paths are resolved now
+        self.directory = os.path.realpath(options.get('directory', self.directory))
+        self.options = dict((key, options[key]) for key in self.store_options if key in options)
+
+    def open(self):
+        with self.lock:
+            if self.store is None:
+                log.info('Opening mailbox at {}'.format(self.directory))
+                self.store = Store(self.directory, **self.options)
+            return self.store
+
+    def __call__(self, address, sender, recipients, message):
+        id = self.open().append(sender, recipients, message)
+        log.debug('Stored message {} in mailbox'.format(id))
+
+    def close(self):
+        with self.lock:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
@@ -3,12 +3,25 @@
 import logging
 
 from .base import Extension
+from ..message import Message
 
 log = logging.getLogger('hermes')
 
+BODY_MODES = ('full', 'truncate', 'summary')
+
 
-# TODO: Test this
 class Printer(Extension):
+    """Logs every message.
+
+    Hook options: body is one of 'truncate' (default) to log the first
+    max_body bytes only, 'full' to log the whole body, or 'summary' to log
+    the size and subject instead of the body.
+    """
+
+    accepts_message = True
+
+    body = 'truncate'
+    max_body = 4096
 
     template = u"""
 FROM: {sender}
@@ -18,6 +31,26 @@ MESSAGE: ----------
 {message}
 -------------------"""
 
+    def configure(self, options):
+        self.body = options.get('body', self.body)
+        self.max_body = options.get('max_body', self.max_body)
+        if self.body not in BODY_MODES:
+            raise ValueError('printer: body should be one of {}'.format(', '.join(BODY_MODES)))
+
     def __call__(self, address, sender, recipients, message):
         log.info(self.template.format(address=address, sender=sender,
-                                      recipients=recipients, message=message))
+                                      recipients=recipients, message=self.format_body(message)))
+
+    def format_body(self, message):
+        if not isinstance(message, Message):
+            # run on a process pool, the message comes as bytes
+            message = Message.from_bytes(message)
+
+        if self.body == 'summary':
+            return u'{} bytes, subject: {}'.format(len(message), message.subject)
+
+        if self.body == 'truncate' and len(message) > self.max_body:
+            head = bytes(message.getbuffer()[:self.max_body]).decode('utf-8', 'replace')
+            return u'{}\n[... {} more bytes]'.format(head, len(message) - self.max_body)
+
+        return message.as_string()
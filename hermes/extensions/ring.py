@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from .base import Extension
+from ..ring import Ring
+
+log = logging.getLogger('hermes')
+
+
+class RingMailbox(Extension):
+    """Keeps the most recent messages in memory, without writing anything
+    to disk.
+
+    Hook options: budget, in bytes (default: 64MB). The oldest messages are
+    evicted once the ones kept take more than that.
+    """
+
+    accepts_message = True
+    accepts_metrics = True
+
+    def __init__(self):
+        self.budget = 64 * 2 ** 20
+        self.ring = None
+        self.lock = threading.Lock()
+
+    def configure(self, options):
+        self.budget = options.get('budget', self.budget)
+        if not isinstance(self.budget, int) or self.budget <= 0:
+            raise ValueError('ring: budget should be a positive number of bytes')
+
+    def open(self):
+        with self.lock:
+            if self.ring is None:
+                log.info('Keeping up to {} bytes of messages in memory'.format(self.budget))
+                self.ring = Ring(self.budget, metrics=self.metrics)
+            return self.ring
+
+    def __call__(self, address, sender, recipients, message):
+        id = self.open().append(sender, recipients, message)
+        log.debug('Kept message {} in memory'.format(id))
@@ -1,3 +1,149 @@
 # -*- coding: utf-8 -*-
+"""
+Hook execution policies
 
+Hooks run inline by default. A hook can instead be configured to run on a
+thread pool (for blocking I/O) or a process pool (for CPU heavy work) with
+a timeout:
 
+    {"scanner": {"executor": "process", "timeout": 10, "on_timeout": "reject"}}
+
+A call that times out is cancelled if it has not started yet. Running calls
+cannot be interrupted, their result is just discarded. Closing the hook
+waits up to close_timeout seconds for the calls still running, then
+closes the hook it runs.
+"""
+
+import logging
+import threading
+from concurrent import futures
+
+log = logging.getLogger('hermes')
+
+EXECUTORS = ('inline', 'thread', 'process')
+TIMEOUT_POLICIES = ('continue', 'reject')
+
+
+class HookTimeout(Exception):
+    pass
+
+
+class RejectMessage(Exception):
+    """Raised from a hook to refuse the message with an SMTP reply"""
+
+    def __init__(self, reply='451 Requested action aborted: local error in processing'):
+        Exception.__init__(self, reply)
+        self.reply = reply
+
+
+def hook_name(hook):
+    return getattr(hook, 'name', None) or type(hook).__name__
+
+
+class Executors(object):
+    """Pools shared by every hook running off the server thread.
+
+    Pools are created on first use, so no worker is started before the
+    daemon forks.
+    """
+
+    def __init__(self, threads=32, processes=None):
+        self.sizes = dict(thread=threads, process=processes)
+        self.pools = {}
+
+    def get(self, kind):
+        if kind not in self.pools:
+            pool_class = futures.ProcessPoolExecutor if kind == 'process' else futures.ThreadPoolExecutor
+            self.pools[kind] = pool_class(self.sizes[kind])
+        return self.pools[kind]
+
+    def shutdown(self):
+        pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ExecutorHook(object):
+    close_timeout = 30
+
+    def __init__(self, name, hook, executors, kind='thread', timeout=None, on_timeout='continue'):
+        self.name = name
+        self.hook = hook
+        self.executors = executors
+        self.kind = kind
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.running = set()  # futures of the calls not done yet, timed out ones included
+        self.lock = threading.Lock()
+
+    def __call__(self, address, sender, recipients, message):
+        future = self.executors.get(self.kind).submit(
+            self.hook, address, sender, recipients, message)
+        with self.lock:
+            self.running.add(future)
+        future.add_done_callback(self.done)
+
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            future.cancel()
+
+            if self.on_timeout == 'reject':
+                log.error('Hook {} timed out after {} seconds. Message rejected'
+                          .format(self.name, self.timeout))
+                raise RejectMessage()
+            raise HookTimeout('Hook {} timed out after {} seconds'.format(self.name, self.timeout))
+
+    @property
+    def accepts_message(self):
+        # a Message cannot be sent to another process
+        return self.kind != 'process' and getattr(self.hook, 'accepts_message', False)
+
+    def done(self, future):
+        with self.lock:
+            self.running.discard(future)
+
+    def close(self, close_hook=True):
+        """Wait for the running calls, shut the pools down and close the
+        hook, unless close_hook is False because another pipeline keeps it"""
+        with self.lock:
+            running = list(self.running)
+        if running:
+            _, left = futures.wait(running, self.close_timeout)
+            if left:
+                log.warning('Closing hook {} with {} calls still running'.format(self.name, len(left)))
+        self.executors.shutdown()
+        if close_hook and hasattr(self.hook, 'close'):
+            self.hook.close()
+
+    def __repr__(self):
+        return '<ExecutorHook {} on {} pool>'.format(self.name, self.kind)
+
+
+def unwrapped(hook):
+    """The hook an ExecutorHook runs, or the hook itself"""
+    return hook.hook if isinstance(hook, ExecutorHook) else hook
+
+
+def create_hook(name, hook, options, executors):
+    """Wrap a hook according to its options, or return it as is to run inline"""
+    options = options or {}
+    kind = options.get('executor', 'inline')
+
+    if kind == 'inline':
+        return hook
+
+    return ExecutorHook(name, hook, executors, kind,
+                        timeout=options.get('timeout'),
+                        on_timeout=options.get('on_timeout', 'continue'))
+
+
+def validate_options(hook_options):
+    """Returns a list of problems found in the hook options"""
+    errors = []
+    for name, options in (hook_options or {}).items():
+        if options.get('executor', 'inline') not in EXECUTORS:
+            errors.append('{}: executor should be one of {}'.format(name, ', '.join(EXECUTORS)))
+        if options.get('on_timeout', 'continue') not in TIMEOUT_POLICIES:
+            errors.append('{}: on_timeout should be one of {}'.format(name, ', '.join(TIMEOUT_POLICIES)))
+    return errors
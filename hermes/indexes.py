@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Secondary indexes over a Store
+
+Message ids are kept in sorted arrays per sender, per recipient and per
+subject token, plus an array of timestamps by id, so queries are a few
+bisections and never touch the segments.
+
+Every indexed message is appended to a log next to the segments, which
+is replayed on startup. Messages missing from the log (after a crash for
+instance) are indexed again from the segments, and the whole log can be
+rebuilt from them with Indexes.rebuild.
+"""
+
+import re
+import json
+import array
+import bisect
+import logging
+import threading
+
+from .message import Message
+
+log = logging.getLogger('hermes')
+
+TOKENS = re.compile(r'\w+', re.UNICODE)
+MAX_HEADERS_SIZE = 2 ** 16
+
+
+def subject_of(message):
+    """Decoded subject of a Message, whose headers are parsed once for every
+    hook, or of a raw message"""
+    if not isinstance(message, Message):
+        message = Message.from_bytes(bytes(message[:MAX_HEADERS_SIZE]))
+    return str(message.subject)
+
+
+def tokenize(text):
+    return sorted(set(token.lower() for token in TOKENS.findall(text or u'')))
+
+
+def normalize(address):
+    return address.strip().strip('<>').lower()
+
+
+class Indexes(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.reset()
+        self.load()
+        self.stream = open(path, 'a')
+
+    def reset(self):
+        self.senders = {}
+        self.recipients = {}
+        self.subjects = {}
+        self.timestamps = array.array('d')
+        self.last_id = 0
+
+    def load(self):
+        """Replay the log, cutting it after the last valid entry"""
+        valid = 0
+        try:
+            with open(self.path, 'rb') as stream:
+                for line in stream:
+                    try:
+                        self.index(*json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        log.warning('Ignoring damaged entries at the end of {}'.format(self.path))
+                        break
+                    valid += len(line)
+
+            with open(self.path, 'r+b') as stream:
+                stream.truncate(valid)
+        except (IOError, OSError):
+            pass
+
+    def catch_up(self, store):
+        """Index the stored messages missing from the log"""
+        if self.last_id > store.last_id:
+            log.warning('Index log {} is ahead of the store. Rebuilding'.format(self.path))
+            return self.rebuild(store)
+
+        indexed = 0
+        for message in store.scan(start=self.last_id + 1):
+            self.add(message.id, message.timestamp, message.sender, message.recipients, message.body)
+            indexed += 1
+
+        if indexed:
+            log.info('Indexed {} stored messages missing from {}'.format(indexed, self.path))
+            self.flush()
+
+    def rebuild(self, store):
+        with self.lock:
+            self.stream.close()
+            self.stream = open(self.path, 'w')
+            self.reset()
+        self.catch_up(store)
+
+    def add(self, id, timestamp, sender, recipients, message):
+        entry = [id, timestamp, normalize(sender), [normalize(r) for r in recipients],
+                 tokenize(subject_of(message))]
+        with self.lock:
+            self.index(*entry)
+            self.stream.write(json.dumps(entry) + '\n')
+
+    def index(self, id, timestamp, sender, recipients, tokens):
+        if id != self.last_id + 1:
+            raise ValueError('Index entries out of order')
+
+        # keep timestamps sorted so time ranges map to id ranges
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            timestamp = self.timestamps[-1]
+        self.timestamps.append(timestamp)
+
+        add_id(self.senders, sender, id)
+        for recipient in set(recipients):
+            add_id(self.recipients, recipient, id)
+        for token in tokens:
+            add_id(self.subjects, token, id)
+        self.last_id = id
+
+    def query(self, sender=None, recipient=None, subject=None, since=None, until=None,
+              after=None, limit=None, reverse=False):
+        """Ids of the messages matching every given filter, oldest first
+        unless reverse is set.
+
+        since and until are timestamps (until excluded), subject matches
+        messages having all its words, after skips ids up to the given one
+        (or from it, when reverse is set).
+        """
+        with self.lock:
+            low, high = 1, self.last_id + 1
+            if since is not None:
+                low = max(low, bisect.bisect_left(self.timestamps, since) + 1)
+            if until is not None:
+                high = min(high, bisect.bisect_left(self.timestamps, until) + 1)
+            if after is not None and reverse:
+                high = min(high, after)
+            elif after is not None:
+                low = max(low, after + 1)
+
+            candidates = []
+            if sender is not None:
+                candidates.append(self.senders.get(normalize(sender), EMPTY))
+            if recipient is not None:
+                candidates.append(self.recipients.get(normalize(recipient), EMPTY))
+            if subject is not None:
+                tokens = tokenize(subject)
+                if not tokens:
+                    return []
+                candidates.extend(self.subjects.get(token, EMPTY) for token in tokens)
+
+            if not candidates:
+                ids = range(high - 1, low - 1, -1) if reverse else range(low, high)
+                return list(ids if limit is None else ids[:limit])
+
+            return intersect(candidates, low, high, limit, reverse)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+
+
+EMPTY = array.array('Q')
+
+
+def add_id(index, key, id):
+    ids = index.get(key)
+    if ids is None:
+        ids = index[key] = array.array('Q')
+    ids.append(id)
+
+
+def intersect(candidates, low, high, limit, reverse):
+    """Ids within [low, high) present in every sorted array of candidates"""
+    candidates = sorted(candidates, key=len)
+    smallest, others = candidates[0], candidates[1:]
+    start, end = bisect.bisect_left(smallest, low), bisect.bisect_left(smallest, high)
+    positions = range(end - 1, start - 1, -1) if reverse else range(start, end)
+
+    ids = []
+    for position in positions:
+        id = smallest[position]
+        if all(contains(other, id) for other in others):
+            ids.append(id)
+            if limit is not None and len(ids) >= limit:
+                break
+    return ids
+
+
+def contains(ids, id):
+    position = bisect.bisect_left(ids, id)
+    return position < len(ids) and ids[position] == id
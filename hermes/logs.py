@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking logging
+
+Records are put on a bounded queue and written by a background thread, so
+a slow stdout never holds back SMTP sessions. When the queue is full new
+records are dropped and counted, and the writer reports how many were
+lost once it catches up.
+
+    handler = QueueHandler([logging.StreamHandler()], size=10000)
+    logging.getLogger('hermes').addHandler(handler)
+
+The writer thread is started again in forked children, daemons and
+workers, since threads do not survive a fork.
+"""
+
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, handlers, size=10000):
+        logging.handlers.QueueHandler.__init__(self, queue.Queue(maxsize=size))
+        self.handlers = handlers
+        self.size = size
+        self.dropped = 0
+        self.reported = 0
+        self.listener = None
+        self.start()
+
+        os.register_at_fork(after_in_child=self.restart)
+        atexit.register(self.stop)
+
+    def start(self):
+        self.listener = Listener(self, self.queue, *self.handlers)
+        self.listener.start()
+
+    def restart(self):
+        # the parent's writer thread and queue lock are gone in a child
+        self.queue = queue.Queue(maxsize=self.size)
+        self.dropped = self.reported = 0
+        self.start()
+
+    def stop(self):
+        """Write the queued records and stop the writer thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def overflow(self):
+        """A record reporting the records dropped since the last report"""
+        dropped = self.dropped - self.reported
+        if not dropped:
+            return None
+        self.reported += dropped
+        return logging.makeLogRecord(dict(
+            name='hermes', levelno=logging.WARNING, levelname='WARNING',
+            msg='Log queue full, dropped {} records ({} in total)'.format(dropped, self.reported)))
+
+
+class Listener(logging.handlers.QueueListener):
+    def __init__(self, handler, queue, *handlers):
+        logging.handlers.QueueListener.__init__(self, queue, *handlers, respect_handler_level=True)
+        self.handler = handler
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        overflow = self.handler.overflow()
+        if overflow is not None:
+            logging.handlers.QueueListener.handle(self, overflow)
+        logging.handlers.QueueListener.handle(self, record)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Received message bodies
+
+Small messages are kept in memory. Once a message grows over the spool
+threshold it is written to an anonymous temporary file and mapped back
+into memory, so its pages can be dropped by the kernel instead of living
+on the heap.
+
+    message = Message(spool_threshold=2 ** 20)
+    message.write(b'Subject: hello')
+    message.finish()
+
+    message.getbuffer()  # memoryview over the whole message
+    message.open()       # independent file-like reader
+
+Hooks accepting a Message share its parsed forms, which are built on first
+access and cached, so a message is parsed once whatever the number of hooks:
+
+    message.headers      # headers only, the body is not parsed
+    message.subject      # decoded Subject header
+    message.email        # email.message.EmailMessage with every MIME part
+"""
+
+import io
+import os
+import re
+import mmap
+import tempfile
+from email import policy
+from email.parser import BytesParser, BytesHeaderParser
+
+NEWLINE = b'\n'
+HEADERS_END = re.compile(br'\r?\n\r?\n')
+
+
+class Message(object):
+    spool_threshold = 2 ** 20
+
+    def __init__(self, spool_threshold=None, spool_directory=None):
+        if spool_threshold is not None:
+            self.spool_threshold = spool_threshold
+        self.spool_directory = spool_directory
+        self.size = 0
+        self.chunks = []
+        self.file = None
+        self.view = None
+        self.parsed_headers = None
+        self.parsed_email = None
+
+    @classmethod
+    def from_bytes(cls, data):
+        message = cls()
+        message.size = len(data)
+        message.view = memoryview(data)
+        return message
+
+    @property
+    def spooled(self):
+        return self.file is not None
+
+    def write(self, data):
+        self.size += len(data)
+
+        if self.file is not None:
+            self.file.write(data)
+        elif self.size > self.spool_threshold:
+            self.file = tempfile.TemporaryFile(dir=self.spool_directory)
+            self.file.writelines(self.chunks)
+            self.file.write(data)
+            self.chunks = None
+        else:
+            self.chunks.append(bytes(data))
+
+    def finish(self):
+        """Make the message readable once it has been fully written"""
+        if self.file is None:
+            self.view = memoryview(b''.join(self.chunks))
+        else:
+            self.file.flush()
+            self.view = memoryview(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+        self.chunks = None
+        return self
+
+    def getbuffer(self):
+        return self.view
+
+    def open(self):
+        return io.BufferedReader(ViewReader(self.view))
+
+    def iter_chunks(self, size=2 ** 16):
+        """Yield chunks of about size bytes, split after a newline when possible"""
+        start = 0
+
+        while start < self.size:
+            chunk = bytes(self.view[start:start + size])
+            if start + len(chunk) < self.size:
+                newline = chunk.rfind(NEWLINE)
+                if newline >= 0:
+                    chunk = chunk[:newline + 1]
+            yield chunk
+            start += len(chunk)
+
+    @property
+    def headers(self):
+        """Headers parsed on first access, without reading the body"""
+        if self.parsed_email is not None:
+            return self.parsed_email
+        if self.parsed_headers is None:
+            head = self.view[:self.size]
+            end = HEADERS_END.search(head)
+            self.parsed_headers = BytesHeaderParser(policy=policy.default).parsebytes(
+                bytes(head[:end.start()] if end else head))
+        return self.parsed_headers
+
+    @property
+    def email(self):
+        """Whole message parsed on first access, with decoded headers and MIME parts"""
+        if self.parsed_email is None:
+            with self.open() as stream:
+                self.parsed_email = BytesParser(policy=policy.default).parse(stream)
+        return self.parsed_email
+
+    def get(self, name, default=None):
+        return self.headers.get(name, default)
+
+    @property
+    def subject(self):
+        return self.get('subject', u'')
+
+    def as_bytes(self):
+        if isinstance(self.view.obj, bytes) and len(self.view.obj) == self.size:
+            return self.view.obj  # no need to copy in memory messages
+        return bytes(self.view)
+
+    def as_string(self):
+        return self.as_bytes().decode('utf-8', 'replace')
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.as_string()
+
+    def __repr__(self):
+        return '<Message {} bytes{}>'.format(self.size, ' spooled' if self.spooled else '')
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            return self.view == other.view
+        return self.view == other
+
+    __hash__ = None
+
+
+class ViewReader(io.RawIOBase):
+    """Raw reader over a memoryview with its own position"""
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.view[self.position:self.position + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
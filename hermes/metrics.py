@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms
+
+Every thread updates its own shard, so recording a value takes no lock:
+it is a dictionary lookup and a few integer increments. Shards are only
+merged when a snapshot is taken.
+
+    metrics = Metrics()
+    started = time.perf_counter()
+    ...
+    metrics.observe('relay', time.perf_counter() - started)
+    metrics.increment('relayed')
+
+    metrics.gauge('relay_queue_depth', relay.depth)  # read on every snapshot
+
+    metrics.snapshot()
+    {'uptime': 12.5, 'counters': {'relayed': 1}, 'gauges': {'relay_queue_depth': 0},
+     'stages': {'relay': {...}}}
+
+Snapshots of several processes are combined with merge, and summarized
+per stage (count, rate, mean and percentiles) with summary.
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+
+log = logging.getLogger('hermes')
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class Histogram(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def as_dict(self):
+        return dict(count=self.count, total=self.total, max=self.max, buckets=list(self.buckets))
+
+
+class Shard(object):
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.time()
+        self.local = threading.local()
+        self.shards = []
+        self.gauges = {}  # name -> function returning the current value
+        self.lock = threading.Lock()  # only taken to register a new thread
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def increment(self, name, value=1):
+        counters = self.shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def gauge(self, name, read):
+        """Report the value returned by read in every snapshot"""
+        with self.lock:
+            self.gauges[name] = read
+
+    def observe(self, stage, seconds):
+        histograms = self.shard().histograms
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            shards = list(self.shards)
+            gauges = list(self.gauges.items())
+
+        snapshot = merge([dict(counters=shard.counters.copy(),
+                               stages=dict((stage, histogram.as_dict())
+                                           for stage, histogram in list(shard.histograms.items())))
+                          for shard in shards], uptime=time.time() - self.started)
+        snapshot['gauges'] = dict((name, read()) for name, read in gauges)
+        return snapshot
+
+
+def merge(snapshots, uptime=None):
+    """Combine snapshots, of several shards or processes, into one"""
+    counters, gauges, stages = {}, {}, {}
+
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, value in snapshot.get('gauges', {}).items():
+            gauges[name] = gauges.get(name, 0) + value
+
+        for stage, histogram in snapshot['stages'].items():
+            merged = stages.setdefault(stage, dict(count=0, total=0.0, max=0.0,
+                                                   buckets=[0] * len(BUCKETS)))
+            merged['count'] += histogram['count']
+            merged['total'] += histogram['total']
+            merged['max'] = max(merged['max'], histogram['max'])
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+
+    if uptime is None:
+        uptime = max([snapshot.get('uptime', 0) for snapshot in snapshots] or [0])
+    return dict(uptime=uptime, counters=counters, gauges=gauges, stages=stages)
+
+
+def quantile(histogram, q):
+    """Upper bound of the bucket holding the q quantile, capped by the max"""
+    rank = q * histogram['count']
+    seen = 0
+    for bound, count in zip(BUCKETS, histogram['buckets']):
+        seen += count
+        if seen >= rank and count:
+            return min(bound, histogram['max'])
+    return histogram['max']
+
+
+def summary(snapshot):
+    """Per stage count, rate per second, mean, p50, p99 and max in seconds"""
+    uptime = snapshot['uptime'] or 1
+    stages = {}
+    for stage, histogram in snapshot['stages'].items():
+        count = histogram['count']
+        stages[stage] = dict(count=count, rate=count / uptime,
+                             mean=histogram['total'] / count if count else 0.0,
+                             p50=quantile(histogram, 0.5), p99=quantile(histogram, 0.99),
+                             max=histogram['max'])
+    return stages
+
+
+def format_snapshot(snapshot):
+    lines = [u'uptime: {:.0f}s'.format(snapshot['uptime'])]
+
+    for name, value in sorted(list(snapshot['counters'].items()) + list(snapshot.get('gauges', {}).items())):
+        lines.append(u'{:<24} {:>10}'.format(name, value))
+
+    stages = summary(snapshot)
+    if stages:
+        lines.append(u'{:<24} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            u'stage', u'count', u'rate/s', u'mean ms', u'p50 ms', u'p99 ms', u'max ms'))
+    for stage, values in sorted(stages.items()):
+        lines.append(u'{:<24} {:>10} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            stage, values['count'], values['rate'], values['mean'] * 1000,
+            values['p50'] * 1000, values['p99'] * 1000, values['max'] * 1000))
+
+    return u'\n'.join(lines)
+
+
+class StatsWriter(object):
+    """Writes snapshots of metrics to a file every interval seconds, for
+    the `hermes stats` command"""
+
+    def __init__(self, metrics, path, interval=5):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, name='hermes-stats')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        temporary = '{}.tmp'.format(self.path)
+        try:
+            with open(temporary, 'w') as stream:
+                json.dump(self.metrics.snapshot(), stream)
+            os.rename(temporary, self.path)
+        except (IOError, OSError) as error:
+            log.warning('Could not write stats to {}. {}'.format(self.path, error))
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Cached entry point scan
+
+Listing the installed extensions means reading the metadata of every
+distribution on sys.path, which costs more than the rest of a control
+command like `hermes status`. The entry points of a namespace are saved
+to a cache file, keyed by the paths on sys.path and their modification
+times, so they are only scanned again after packages are installed or
+removed:
+
+    entry_points('hermes.extensions.processors')
+    {'printer': 'hermes.extensions.printer:Printer', ...}
+
+Nothing is imported: extensions are only loaded by the commands serving
+mail.
+"""
+
+import os
+import sys
+import json
+
+NAMESPACE = 'hermes.extensions.processors'
+
+
+def cache_path():
+    directory = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(directory, 'hermes', 'entry_points.json')
+
+
+def fingerprint(paths=None):
+    """Changes whenever a distribution is added to or removed from sys.path"""
+    found = []
+    for path in sys.path if paths is None else paths:
+        try:
+            found.append([path, os.stat(path or '.').st_mtime])
+        except OSError:
+            found.append([path, None])
+    return found
+
+
+def scan(namespace):
+    from importlib import metadata
+    return dict((entry_point.name, entry_point.value)
+                for entry_point in metadata.entry_points(group=namespace))
+
+
+def entry_points(namespace=NAMESPACE, path=None):
+    """{name: 'module:attribute'} of the entry points in a namespace"""
+    path = cache_path() if path is None else path
+    key = fingerprint()
+
+    try:
+        with open(path) as stream:
+            cache = json.load(stream)
+        if cache.get('fingerprint') == key and namespace in cache['namespaces']:
+            return cache['namespaces'][namespace]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        cache = {}
+
+    found = scan(namespace)
+
+    namespaces = cache.get('namespaces', {}) if cache.get('fingerprint') == key else {}
+    namespaces[namespace] = found
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'w') as stream:
+            json.dump(dict(fingerprint=key, namespaces=namespaces), stream)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        pass  # read-only home, scan again next time
+
+    return found
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+On demand profiling
+
+A server turns profiling on and off on SIGUSR1. While on, process_message
+and run_hook are replaced on the server instance by wrappers running them
+under cProfile, one profile per thread, and every hook is called through
+a function named after it, so the profile shows each one as hook.<name>.
+Turned off, the wrappers are removed and the class methods run again
+untouched, so profiling costs nothing until it is asked for.
+
+    profiler = Profiler('/tmp/hermes-25.1234.prof')
+    profiler.call(server.process_message, address, sender, recipients, message)
+    profiler.stop()  # written once the calls in progress are done
+
+    $ python -m pstats /tmp/hermes-25.1234.prof
+"""
+
+import time
+import pstats
+import cProfile
+import logging
+import threading
+
+log = logging.getLogger('hermes')
+
+
+def named(name):
+    """A function calling its arguments, shown as name in profiles"""
+    def call(function, *args):
+        return function(*args)
+    call.__code__ = call.__code__.replace(co_name=name)
+    return call
+
+
+class Profiler(object):
+    def __init__(self, path, stop_timeout=10):
+        self.path = path
+        self.stop_timeout = stop_timeout
+        self.local = threading.local()
+        self.profiles = []
+        self.names = {}
+        self.running = 0  # calls being profiled
+        self.idle = threading.Condition()
+        self.started = time.time()
+
+    def call(self, function, *args, **kwargs):
+        """Run function under the profile of the current thread, unless
+        a call of this thread is already profiled"""
+        local = self.local
+        if getattr(local, 'active', False):
+            return function(*args, **kwargs)
+
+        profile = getattr(local, 'profile', None)
+        if profile is None:
+            profile = local.profile = cProfile.Profile()
+            with self.idle:
+                self.profiles.append(profile)
+
+        with self.idle:
+            self.running += 1
+        local.active = True
+        profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            local.active = False
+            with self.idle:
+                self.running -= 1
+                self.idle.notify_all()
+
+    def named(self, name):
+        call = self.names.get(name)
+        if call is None:
+            call = self.names[name] = named(name)
+        return call
+
+    def stop(self):
+        """Write the profile in the background, once the calls in progress
+        are done. No new call should be profiled"""
+        thread = threading.Thread(target=self.write, name='hermes-profile')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def write(self):
+        with self.idle:
+            done = self.idle.wait_for(lambda: not self.running, self.stop_timeout)
+            profiles = list(self.profiles)
+        if not done:
+            return log.error('Profile not written to {}, profiled calls still running after {}s'
+                             .format(self.path, self.stop_timeout))
+        if not profiles:
+            return log.info('Profiling stopped, nothing was profiled')
+
+        pstats.Stats(*profiles).dump_stats(self.path)
+        log.info('Profile of {:.1f}s written to {}, read it with python -m pstats {}'
+                 .format(time.time() - self.started, self.path, self.path))
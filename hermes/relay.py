@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Background relay of accepted messages
+
+Messages are queued once the hooks have run, and a pool of worker threads
+hands them to the Sender, so clients get their reply without waiting on
+the relay server.
+
+Workers can group queued messages by recipient domain and relay each group
+over a single session, once it holds batch_size messages or its first
+message has waited batch_wait seconds.
+"""
+
+import time
+import queue
+import logging
+import threading
+import collections
+
+log = logging.getLogger('hermes')
+
+
+class RelayQueue(object):
+    """Bounded queue of messages waiting to be relayed"""
+
+    def __init__(self, sender, size=1000, workers=4, drain_timeout=30, batch_size=1, batch_wait=0):
+        self.sender = sender
+        self.size = size
+        self.drain_timeout = drain_timeout
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue(maxsize=size)
+        self.workers = [None] * workers
+        self.lock = threading.Lock()  # guards the counters, updated by every worker
+        self.closed = False
+        self.relayed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.abandoned = 0  # left queued when closed
+        self.batches = 0
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    @property
+    def dropped(self):
+        """Messages refused by a full or closed queue, or left queued when closed"""
+        return self.rejected + self.abandoned
+
+    def stats(self):
+        return dict(depth=self.depth, size=self.size, relayed=self.relayed,
+                    failed=self.failed, rejected=self.rejected, dropped=self.dropped,
+                    batches=self.batches)
+
+    def start(self):
+        for index in range(len(self.workers)):
+            worker = threading.Thread(target=self.work, name='hermes-relay-{}'.format(index))
+            worker.daemon = True
+            worker.start()
+            self.workers[index] = worker
+
+    def put(self, sender, recipients, message):
+        """Queue a message. Returns False when the queue is full or closed"""
+        if not self.closed:
+            try:
+                self.queue.put_nowait((sender, recipients, message))
+                return True
+            except queue.Full:
+                pass
+
+        with self.lock:
+            self.rejected += 1
+        return False
+
+    def work(self):
+        batches = collections.OrderedDict()  # domain -> (deadline, messages), oldest first
+
+        while True:
+            try:
+                item = self.queue.get(timeout=self.next_deadline(batches))
+            except queue.Empty:
+                item = ()
+            else:
+                self.queue.task_done()
+
+            if item is None:
+                for _, messages in batches.values():
+                    self.relay_batch(messages)
+                return
+
+            if item:
+                domain = domain_of(item[1])
+                if domain not in batches:
+                    batches[domain] = (time.time() + self.batch_wait, [])
+                batches[domain][1].append(item)
+                if len(batches[domain][1]) >= self.batch_size:
+                    self.relay_batch(batches.pop(domain)[1])
+
+            now = time.time()
+            while batches and next(iter(batches.values()))[0] <= now:
+                self.relay_batch(batches.popitem(last=False)[1][1])
+
+    def next_deadline(self, batches):
+        if not batches:
+            return None
+        return max(0, next(iter(batches.values()))[0] - time.time())
+
+    def relay_batch(self, messages):
+        # whatever goes wrong with these messages, the worker keeps going
+        try:
+            if len(messages) == 1:
+                sent = [self.sender.send(*messages[0])]
+            else:
+                sent = self.sender.send_batch(messages)
+        except Exception as error:
+            log.error('Could not relay {} messages. {}: {}'.format(len(messages), type(error), error),
+                      exc_info=True)
+            sent = [False] * len(messages)
+
+        relayed = sum(1 for accepted in sent if accepted)
+        with self.lock:
+            if len(messages) > 1:
+                self.batches += 1
+            self.relayed += relayed
+            self.failed += len(messages) - relayed
+
+    def close(self, timeout=None):
+        """Stop accepting messages and relay the queued ones.
+
+        Waits up to timeout (default drain_timeout) seconds for the queue
+        to drain and returns the number of messages left behind.
+        """
+        if self.closed:
+            return self.depth
+        self.closed = True
+
+        deadline = time.time() + (self.drain_timeout if timeout is None else timeout)
+        workers = [worker for worker in self.workers if worker is not None]
+        try:
+            for _ in workers:
+                self.queue.put(None, timeout=max(0.01, deadline - time.time()))
+        except queue.Full:
+            pass
+
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+
+        self.abandoned = sum(1 for item in list(self.queue.queue) if item is not None)
+        if self.abandoned:
+            log.warning('Relay queue closed with {} messages not relayed'.format(self.abandoned))
+        return self.abandoned
+
+
+def domain_of(recipients):
+    """Domain of the first recipient, used to group messages in batches"""
+    if not recipients:
+        return ''
+    return recipients[0].rpartition('@')[2].strip('>').lower()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Capture replay
+
+Sends the messages of a capture to an SMTP server, keeping the intervals
+between their arrivals divided by speed, or as fast as possible with a
+speed of 0. Messages are read from the capture as they are due and handed
+to a pool of connections workers through a short queue, so a capture of
+any size is replayed in constant memory:
+
+    report = Replay('traffic.hcap', ('staging', 25), speed=10, connections=50).run()
+"""
+
+import time
+import queue
+import threading
+
+from .capture import read_capture
+from .message import Message
+from .smtp import Sender
+
+
+class Replay(object):
+    def __init__(self, path, address, speed=1, connections=10):
+        self.path = path
+        self.speed = speed
+        self.connections = connections
+        self.sender = Sender(address, pool_size=connections, idle_timeout=3600, max_messages=2 ** 31)
+        self.queue = queue.Queue(maxsize=connections * 4)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.late = 0.0  # longest delay of a message behind its schedule
+
+    def run(self):
+        """Replay the capture and return a report of it"""
+        workers = [threading.Thread(target=self.work, name='hermes-replay-{}'.format(index))
+                   for index in range(self.connections)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        started = time.time()
+        first = None
+        try:
+            for captured in read_capture(self.path):
+                due = None
+                if self.speed:
+                    first = captured.timestamp if first is None else first
+                    due = started + (captured.timestamp - first) / self.speed
+                    if due > time.time():
+                        time.sleep(due - time.time())
+                self.queue.put((due, captured))
+        finally:
+            for _ in workers:
+                self.queue.put(None)
+            for worker in workers:
+                worker.join()
+            self.sender.close()
+
+        seconds = time.time() - started
+        return dict(sent=self.sent, failed=self.failed, seconds=seconds,
+                    rate=(self.sent + self.failed) / seconds if seconds else 0.0, late=self.late)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            due, captured = item
+            late = time.time() - due if due is not None else 0.0
+            sent = self.sender.send(captured.sender, captured.recipients,
+                                    Message.from_bytes(captured.body))
+            with self.lock:
+                if sent:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self.late = max(self.late, late)
+
+
+def format_report(report):
+    return (u'Replayed {sent} messages in {seconds:.1f}s ({rate:.1f}/s), {failed} failed, '
+            u'at most {late:.3f}s behind schedule'.format(**report))
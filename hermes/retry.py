@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Durable retry of failed relays
+
+Messages the relay server could not take, because it was unreachable or
+answered with a temporary (4xx) error, are appended to a log on disk and
+relayed again later, backing off exponentially with jitter:
+
+    directory/
+        0/LOCK
+        0/retry.log      messages and their retry state
+        0/retry.cursor   offset of the oldest record still needed
+
+A record is a header (length, crc32, kind, message id) followed by the
+envelope and body of a deferred message, its attempts and next attempt
+time after another failure, or nothing once the message is done with.
+Every server process claims the first free slot directory, so workers do
+not share a log and a restarted worker picks up the one left behind.
+
+Only the records after the cursor are read back on start, and only the
+retry state is kept in memory: bodies are read from the log once their
+message is due. The log is rewritten with the pending messages once it
+is compact_size bytes long and at least half of it is done with. The
+cursor is moved back to the start of the log before the rewritten log
+replaces it, so a crash in between reads the old log again from its
+start rather than the new one from a stale offset. With compress=True the bodies of new
+messages are compressed with the shared dictionaries of the slot
+directory (see hermes.compression), trained again on every rewrite.
+
+Due messages are relayed in batches over a single session. While the
+relay server keeps failing a single batch is tried per backoff period,
+and once one goes through the others follow back to back.
+
+    retry = RetryLog('/var/spool/hermes')
+    retry.open(sender.attempt)
+    retry.defer([('me@example.com', ['you@example.com'], b'Subject: hi')])
+"""
+
+import os
+import time
+import zlib
+import fcntl
+import heapq
+import random
+import struct
+import logging
+import itertools
+import threading
+
+from .compression import Codec
+from .store import body_chunks, headers_of, ZBODY
+
+log = logging.getLogger('hermes')
+
+HEADER = struct.Struct('>IIBQ')  # length, crc32, kind, message id
+DEFERRED = struct.Struct('>IddHI')  # attempts, next attempt, deferred at, sender size, recipients size
+RETRIED = struct.Struct('>Id')  # attempts, next attempt
+CURSOR = struct.Struct('>QQI')  # offset, next message id, crc32
+
+ADD, RETRY, DONE, ADD_COMPRESSED = 1, 2, 3, 4
+LOG_NAME = 'retry.log'
+CURSOR_NAME = 'retry.cursor'
+
+
+class Pending(object):
+    __slots__ = ('id', 'offset', 'length', 'attempts', 'due')
+
+    def __init__(self, id, offset, length, attempts, due):
+        self.id = id
+        self.offset = offset
+        self.length = length
+        self.attempts = attempts
+        self.due = due
+
+
+def encode_record(kind, id, data=b'', message=None):
+    """Header and data of a record, plus the size and chunks of its body"""
+    body_size, chunks = body_chunks(message if message is not None else b'')
+    length = HEADER.size + len(data) + body_size
+    crc = zlib.crc32(data, zlib.crc32(struct.pack('>BQ', kind, id)))
+    for chunk in chunks():
+        crc = zlib.crc32(chunk, crc)
+    return HEADER.pack(length, crc, kind, id) + data, chunks
+
+
+def encode_cursor(offset, next_id):
+    return CURSOR.pack(offset, next_id, zlib.crc32(struct.pack('>QQ', offset, next_id)))
+
+
+def decode_cursor(data):
+    """(offset, next message id), (0, 1) when missing or torn"""
+    if len(data) != CURSOR.size:
+        return 0, 1
+    offset, next_id, crc = CURSOR.unpack(data)
+    if zlib.crc32(struct.pack('>QQ', offset, next_id)) != crc:
+        return 0, 1
+    return offset, next_id
+
+
+class RetryLog(object):
+    def __init__(self, directory, max_attempts=10, delay=30, max_delay=3600, batch_size=50,
+                 compact_size=16 * 2 ** 20, compress=False, metrics=None):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.compact_size = compact_size
+        self.compress = compress
+        self.codec = None
+        self.metrics = metrics
+        self.pending = {}  # id -> Pending, oldest first
+        self.schedule = []  # heap of (due, id), entries of retried or done messages are skipped
+        self.hold = 0  # no batch before then, the relay server is failing
+        self.failures = 0  # batches failed in a row
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.deliver = None
+        self.thread = None
+        self.closed = True
+        self.path = None
+        self.fd = None
+        self.cursor_fd = None
+        self.lockfile = None
+        self.size = self.cursor = 0
+        self.live = 0  # bytes of the records of pending messages
+        self.next_id = 1
+
+    def __len__(self):
+        return len(self.pending)
+
+    def backoff(self, attempts):
+        """Seconds until the next attempt: doubling every attempt up to
+        max_delay, the second half of it picked at random"""
+        delay = min(self.max_delay, self.delay * 2 ** (max(1, attempts) - 1))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def open(self, deliver):
+        """Read back the pending messages and start relaying them again.
+
+        deliver is called with a batch of (sender, recipients, message)
+        tuples and returns for each of them True once relayed, False when
+        refused for good and None when it should be retried.
+        """
+        self.deliver = deliver
+        self.path, self.lockfile = self.claim()
+        self.codec = Codec(self.path)
+        self.fd = os.open(os.path.join(self.path, LOG_NAME), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.cursor_fd = os.open(os.path.join(self.path, CURSOR_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        self.recover()
+        self.closed = False
+
+        if self.pending:
+            log.info('{} messages to relay again from {}'.format(len(self.pending), self.path))
+        self.thread = threading.Thread(target=self.work, name='hermes-retry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def claim(self):
+        """The first slot directory not used by another process, locked"""
+        for slot in itertools.count():
+            path = os.path.join(self.directory, str(slot))
+            os.makedirs(path, exist_ok=True)
+            lockfile = open(os.path.join(path, 'LOCK'), 'w')
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                lockfile.close()
+                continue
+            return path, lockfile
+
+    def recover(self):
+        """Replay the records after the cursor, dropping a torn last one"""
+        self.size = os.fstat(self.fd).st_size
+        offset, self.next_id = decode_cursor(os.pread(self.cursor_fd, CURSOR.size, 0))
+        if offset > self.size or (0 < offset < self.size and not self.valid_record(offset)):
+            log.warning('Cursor of {} does not point at a record, reading the whole log'
+                        .format(os.path.join(self.path, LOG_NAME)))
+            offset = 0
+        self.cursor = offset
+        self.live = 0
+
+        while offset + HEADER.size <= self.size:
+            length, crc, kind, id = HEADER.unpack(os.pread(self.fd, HEADER.size, offset))
+            record = os.pread(self.fd, length, offset) if length >= HEADER.size else b''
+            if len(record) < HEADER.size or len(record) < length or \
+                    zlib.crc32(memoryview(record)[8:]) != crc:
+                break
+            self.replay(kind, id, offset, record)
+            offset += length
+
+        if offset < self.size:
+            log.warning('Dropping {} bytes of incomplete records from {}'
+                        .format(self.size - offset, os.path.join(self.path, LOG_NAME)))
+            os.ftruncate(self.fd, offset)
+            self.size = offset
+
+        self.schedule = [(entry.due, entry.id) for entry in self.pending.values()]
+        heapq.heapify(self.schedule)
+
+    def valid_record(self, offset):
+        header = os.pread(self.fd, HEADER.size, offset)
+        if len(header) < HEADER.size:
+            return False
+        length, crc = HEADER.unpack(header)[:2]
+        record = os.pread(self.fd, length, offset) if length >= HEADER.size else b''
+        return len(record) == length and zlib.crc32(memoryview(record)[8:]) == crc
+
+    def replay(self, kind, id, offset, record):
+        if kind in (ADD, ADD_COMPRESSED):
+            attempts, due = DEFERRED.unpack_from(record, HEADER.size)[:2]
+            self.pending[id] = Pending(id, offset, len(record), attempts, due)
+            self.live += len(record)
+        elif kind == RETRY and id in self.pending:
+            self.pending[id].attempts, self.pending[id].due = RETRIED.unpack_from(record, HEADER.size)
+        elif kind == DONE and id in self.pending:
+            self.live -= self.pending.pop(id).length
+        self.next_id = max(self.next_id, id + 1)
+
+    def defer(self, messages):
+        """Keep (sender, recipients, message) tuples the relay server did
+        not take, to relay them again later. Returns whether they were kept
+        """
+        with self.wakeup:
+            if self.closed:
+                log.error('Retry log closed, {} messages not kept'.format(len(messages)))
+                return False
+
+            now = time.time()
+            for sender, recipients, message in messages:
+                sender = sender.encode('utf-8')
+                recipients = u'\n'.join(recipients).encode('utf-8')
+                entry = Pending(self.next_id, self.size, 0, 1, now + self.backoff(1))
+                data = DEFERRED.pack(entry.attempts, entry.due, now, len(sender), len(recipients))
+                kind = ADD
+                if self.compress:
+                    kind, message = ADD_COMPRESSED, self.compressed(message)
+                entry.length = self.append(kind, entry.id, data + sender + recipients, message)
+                self.next_id += 1
+                self.pending[entry.id] = entry
+                self.live += entry.length
+                heapq.heappush(self.schedule, (entry.due, entry.id))
+            os.fsync(self.fd)
+            self.wakeup.notify()
+
+        log.warning('{} messages deferred, {} waiting to be relayed again'
+                    .format(len(messages), len(self.pending)))
+        self.increment('relay_deferred', len(messages))
+        return True
+
+    def compressed(self, message):
+        body_size, chunks = body_chunks(message)
+        self.codec.sample(headers_of(message))
+        dictionary, data = self.codec.compress(chunks())
+        return ZBODY.pack(dictionary, body_size) + data
+
+    def append(self, kind, id, data=b'', message=None):
+        header, chunks = encode_record(kind, id, data, message)
+        length = len(header)
+        os.write(self.fd, header)
+        for chunk in chunks():
+            os.write(self.fd, chunk)
+            length += len(chunk)
+        self.size += length
+        return length
+
+    def read(self, entry):
+        """The (sender, recipients, body) of a pending message"""
+        record = os.pread(self.fd, entry.length, entry.offset)
+        kind = HEADER.unpack_from(record)[2]
+        sender_size, recipients_size = DEFERRED.unpack_from(record, HEADER.size)[3:]
+        start = HEADER.size + DEFERRED.size
+        sender = record[start:start + sender_size].decode('utf-8')
+        start += sender_size
+        recipients = record[start:start + recipients_size].decode('utf-8')
+        start += recipients_size
+        body = record[start:]
+        if kind == ADD_COMPRESSED:
+            body = self.codec.decompress(ZBODY.unpack_from(record, start)[0], body[ZBODY.size:])
+        return sender, recipients.split('\n') if recipients else [], body
+
+    def work(self):
+        while True:
+            with self.wakeup:
+                while not self.closed:
+                    due = self.next_due()
+                    if due is not None and due <= time.time():
+                        break
+                    self.wakeup.wait(None if due is None else due - time.time())
+                if self.closed:
+                    return
+                batch = self.due_batch()
+                messages = [self.read(entry) for entry in batch]
+
+            self.attempt(batch, messages)
+
+    def next_due(self):
+        while self.schedule:
+            due, id = self.schedule[0]
+            entry = self.pending.get(id)
+            if entry is not None and entry.due == due:
+                return max(due, self.hold)
+            heapq.heappop(self.schedule)
+        return None
+
+    def due_batch(self):
+        now = time.time()
+        batch = []
+        while self.schedule and len(batch) < self.batch_size and self.schedule[0][0] <= now:
+            due, id = heapq.heappop(self.schedule)
+            entry = self.pending.get(id)
+            if entry is not None and entry.due == due:
+                batch.append(entry)
+        return batch
+
+    def attempt(self, batch, messages):
+        try:
+            outcomes = self.deliver(messages)
+        except Exception as error:
+            log.error('Could not relay deferred messages. {}: {}'.format(type(error), error))
+            outcomes = [None] * len(batch)
+
+        with self.wakeup:
+            if self.fd is None:
+                return  # closed meanwhile, the messages are relayed again next time
+
+            now = time.time()
+            for entry, outcome in zip(batch, outcomes):
+                if outcome is None and entry.attempts + 1 < self.max_attempts:
+                    entry.attempts += 1
+                    entry.due = now + self.backoff(entry.attempts)
+                    self.append(RETRY, entry.id, RETRIED.pack(entry.attempts, entry.due))
+                    heapq.heappush(self.schedule, (entry.due, entry.id))
+                    continue
+
+                if outcome is None:
+                    log.error('Message {} not relayed after {} attempts, dropped'
+                              .format(entry.id, entry.attempts + 1))
+                    self.increment('relay_expired')
+                elif not outcome:
+                    log.error('Message {} refused by the relay server, dropped'.format(entry.id))
+                self.append(DONE, entry.id)
+                del self.pending[entry.id]
+                self.live -= entry.length
+            os.fsync(self.fd)
+
+            relayed = sum(1 for outcome in outcomes if outcome)
+            self.increment('relay_retried', relayed)
+            if relayed or None not in outcomes:
+                self.failures, self.hold = 0, 0
+            else:
+                self.failures += 1
+                self.hold = now + self.backoff(self.failures)
+            self.move_cursor()
+
+    def recovered(self):
+        """The relay server took a message: stop backing off and relay the
+        pending messages now"""
+        if not self.failures:
+            return
+        with self.wakeup:
+            if not self.failures:
+                return
+            self.failures, self.hold = 0, 0
+            now = time.time()
+            for entry in self.pending.values():
+                entry.due = min(entry.due, now)
+            self.schedule = [(entry.due, entry.id) for entry in self.pending.values()]
+            heapq.heapify(self.schedule)
+            self.wakeup.notify()
+        log.info('Relay server is back, relaying {} deferred messages'.format(len(self.pending)))
+
+    def move_cursor(self):
+        """Point the cursor at the oldest pending message, and rewrite the
+        log once it is big enough and mostly done with"""
+        if self.size >= self.compact_size and self.size - self.live >= self.live:
+            self.compact()
+        oldest = next(iter(self.pending.values()), None)
+        offset = self.size if oldest is None else oldest.offset
+        if offset != self.cursor:
+            os.pwrite(self.cursor_fd, encode_cursor(offset, self.next_id), 0)
+            self.cursor = offset
+
+    def compact(self):
+        """Rewrite the log with the pending messages only"""
+        path = os.path.join(self.path, LOG_NAME)
+        temporary = path + '.tmp'
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        offset = 0
+        for entry in self.pending.values():
+            record = bytearray(os.pread(self.fd, entry.length, entry.offset))
+            DEFERRED.pack_into(record, HEADER.size, entry.attempts, entry.due,
+                               *DEFERRED.unpack_from(record, HEADER.size)[2:])
+            HEADER.pack_into(record, 0, entry.length, zlib.crc32(memoryview(record)[8:]),
+                             HEADER.unpack_from(record)[2], entry.id)
+            os.write(fd, record)
+            entry.offset = offset
+            offset += entry.length
+        os.fsync(fd)
+        # the old log read again from its start gives the same pending
+        # messages, so the cursor goes back first
+        self.reset_cursor()
+        os.rename(temporary, path)
+        self.sync_directory()
+        os.close(self.fd)
+
+        log.info('Compacted {}, {} messages pending'.format(path, len(self.pending)))
+        if self.compress:
+            self.codec.retrain()
+        self.fd, self.size, self.live = fd, offset, offset
+
+    def reset_cursor(self):
+        """Replace the cursor with one pointing at the start of the log"""
+        path = os.path.join(self.path, CURSOR_NAME)
+        temporary = path + '.tmp'
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(fd, encode_cursor(0, self.next_id))
+        os.fsync(fd)
+        os.rename(temporary, path)
+        self.sync_directory()
+        os.close(self.cursor_fd)
+        self.cursor_fd, self.cursor = fd, 0
+
+    def sync_directory(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def increment(self, name, value=1):
+        if self.metrics is not None and value:
+            self.metrics.increment(name, value)
+
+    def close(self, timeout=10):
+        """Stop relaying. Pending messages are relayed again once opened"""
+        with self.wakeup:
+            if self.closed:
+                return
+            self.closed = True
+            self.wakeup.notify_all()
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+        with self.wakeup:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            os.close(self.cursor_fd)
+            self.fd = self.cursor_fd = None
+            self.lockfile.close()
+        if self.pending:
+            log.info('{} messages left to relay again in {}'.format(len(self.pending), self.path))
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory mailbox with a byte budget
+
+Keeps the most recent messages in memory only, evicting the oldest ones
+once the messages kept take more than budget bytes, so a trap running
+for days in CI stays within a fixed amount of memory:
+
+    ring = Ring(budget=64 * 2 ** 20)
+    id = ring.append('me@example.com', ['you@example.com'], b'Subject: hi')
+    ring.get(id).body
+    ring.query(recipient='you@example.com')
+
+Messages are slotted records holding their body as bytes. Like Indexes,
+ids are kept in sorted arrays per sender, per recipient and per subject
+token, which are dropped from the front as messages are evicted, so
+appending, evicting and looking a recipient up take constant time and
+queries are the same as over a Store.
+"""
+
+import time
+import array
+import bisect
+import logging
+import threading
+import collections
+
+from .indexes import subject_of, tokenize, normalize, intersect
+from .message import Message
+from .store import StoredMessage, body_chunks
+
+log = logging.getLogger('hermes')
+
+# estimated memory taken by a record besides its body: the record, its
+# envelope strings, its entry in the ring and in the indexes
+RECORD_OVERHEAD = 1024
+
+
+class RingMessage(StoredMessage):
+    __slots__ = ('cost', 'tokens')  # bytes taken from the budget, subject tokens
+
+
+class Window(object):
+    """Array dropping values from the front in amortized constant time"""
+    __slots__ = ('values', 'start')
+
+    def __init__(self, typecode='Q'):
+        self.values = array.array(typecode)
+        self.start = 0
+
+    def __len__(self):
+        return len(self.values) - self.start
+
+    def __getitem__(self, position):
+        return self.values[self.start + position]
+
+    def append(self, value):
+        self.values.append(value)
+
+    def popleft(self):
+        self.start += 1
+        if self.start * 2 >= len(self.values):
+            del self.values[:self.start]
+            self.start = 0
+
+
+EMPTY = Window()
+
+
+def add_id(index, key, id):
+    ids = index.get(key)
+    if ids is None:
+        ids = index[key] = Window()
+    ids.append(id)
+
+
+def drop_id(index, key):
+    ids = index[key]
+    ids.popleft()
+    if not ids:
+        del index[key]
+
+
+class Ring(object):
+    def __init__(self, budget=64 * 2 ** 20, metrics=None):
+        self.budget = budget
+        self.metrics = metrics
+        self.lock = threading.RLock()
+        self.messages = collections.OrderedDict()  # id -> RingMessage, oldest first
+        self.timestamps = Window('d')  # by id, from first_id
+        self.senders = {}
+        self.recipients = {}
+        self.subjects = {}
+        self.first_id = 1
+        self.last_id = 0
+        self.latest = 0.0  # timestamp of the last message
+        self.size = 0
+        self.evicted = 0
+        self.listeners = []  # called with the id of every appended message
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, sender, recipients, message, timestamp=None):
+        """Keep a message, evicting the oldest ones to make room for it.
+        Returns its id, or None when it is bigger than the whole budget"""
+        body_size, chunks = body_chunks(message)
+        cost = RECORD_OVERHEAD + body_size + len(sender) + sum(len(recipient) for recipient in recipients)
+        if cost > self.budget:
+            log.warning('Message from {} takes {} bytes, more than the ring budget, not kept'
+                        .format(sender, cost))
+            return None
+
+        timestamp = time.time() if timestamp is None else timestamp
+        record = RingMessage(None, timestamp, sender, list(recipients), b''.join(chunks()))
+        record.cost = cost
+        record.tokens = tuple(tokenize(subject_of(message if isinstance(message, Message) else record.body)))
+
+        with self.lock:
+            evicted = 0
+            while self.size + cost > self.budget:
+                self.evict()
+                evicted += 1
+
+            id = record.id = self.last_id + 1
+            # keep timestamps sorted so time ranges map to id ranges
+            self.latest = max(self.latest, timestamp)
+            self.timestamps.append(self.latest)
+            add_id(self.senders, normalize(sender), id)
+            for recipient in set(normalize(recipient) for recipient in recipients):
+                add_id(self.recipients, recipient, id)
+            for token in record.tokens:
+                add_id(self.subjects, token, id)
+            self.messages[id] = record
+            self.last_id = id
+            self.size += cost
+
+        self.increment('ring_messages', 1 - evicted)
+        self.increment('ring_bytes', cost)
+        self.increment('ring_evicted', evicted)
+        for listener in self.listeners:
+            listener(id)
+        return id
+
+    def evict(self):
+        id, record = self.messages.popitem(last=False)
+        self.timestamps.popleft()
+        drop_id(self.senders, normalize(record.sender))
+        for recipient in set(normalize(recipient) for recipient in record.recipients):
+            drop_id(self.recipients, recipient)
+        for token in record.tokens:
+            drop_id(self.subjects, token)
+        self.first_id = id + 1
+        self.size -= record.cost
+        self.evicted += 1
+        self.increment('ring_bytes', -record.cost)
+
+    def get(self, id):
+        """Return the message with this id, or None once evicted"""
+        return self.messages.get(id)
+
+    def scan(self, start=None):
+        """Iterate over the kept messages, oldest first"""
+        with self.lock:
+            records = list(self.messages.values())
+        for record in records:
+            if start is None or record.id >= start:
+                yield record
+
+    def query(self, sender=None, recipient=None, subject=None, since=None, until=None,
+              after=None, limit=None, reverse=False):
+        """Ids of the kept messages matching every given filter, see Indexes.query"""
+        with self.lock:
+            low, high = self.first_id, self.last_id + 1
+            if since is not None:
+                low = max(low, bisect.bisect_left(self.timestamps, since) + self.first_id)
+            if until is not None:
+                high = min(high, bisect.bisect_left(self.timestamps, until) + self.first_id)
+            if after is not None and reverse:
+                high = min(high, after)
+            elif after is not None:
+                low = max(low, after + 1)
+
+            candidates = []
+            if sender is not None:
+                candidates.append(self.senders.get(normalize(sender), EMPTY))
+            if recipient is not None:
+                candidates.append(self.recipients.get(normalize(recipient), EMPTY))
+            if subject is not None:
+                tokens = tokenize(subject)
+                if not tokens:
+                    return []
+                candidates.extend(self.subjects.get(token, EMPTY) for token in tokens)
+
+            if not candidates:
+                ids = range(high - 1, low - 1, -1) if reverse else range(low, high)
+                return list(ids if limit is None else ids[:limit])
+
+            return intersect(candidates, low, high, limit, reverse)
+
+    def increment(self, name, value):
+        if self.metrics is not None and value:
+            self.metrics.increment(name, value)
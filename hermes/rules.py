@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Recipient routing rules
+
+Rules are read from the "rules" list of the JSON configuration and
+matched against every recipient:
+
+    {"match": "bob@example.com", "action": "redirect", "to": "alice@example.com"}
+    {"match": "example.net", "action": "rewrite", "to": "example.com"}
+    {"match": "*.example.org", "action": "drop"}
+    {"match": "spam.example.org", "action": "reject", "reply": "550 No thanks"}
+    {"match": "lists.example.com", "hooks": ["mailbox"]}
+    {"match": "*", "hooks": ["printer"]}
+
+match is an address, a domain, "*.domain" for any of its subdomains or
+"*" for every recipient. The most specific rule wins: address, then
+domain, then the longest wildcard, then "*". Addresses and domains are
+hash lookups and wildcards a walk down a trie of domain labels, so the
+cost of routing a recipient does not depend on the number of rules.
+
+Actions:
+
+    deliver   keep the recipient (default)
+    redirect  replace the recipient by the "to" address
+    rewrite   replace the recipient domain by the "to" domain
+    drop      accept the message but remove the recipient
+    reject    refuse the message with "reply"
+
+"hooks" restricts the hooks run for the message to the given ones. When
+recipients match rules with different hooks, the union of them is run.
+"""
+
+ACTIONS = ('deliver', 'redirect', 'rewrite', 'drop', 'reject')
+DEFAULT_REPLY = '550 Requested action not taken: mailbox unavailable'
+MATCH = object()  # key of the rule stored in a trie node
+
+
+class Rule(object):
+    __slots__ = ('match', 'action', 'to', 'reply', 'hooks')
+
+    def __init__(self, match, action='deliver', to=None, reply=DEFAULT_REPLY, hooks=None):
+        self.match = match
+        self.action = action
+        self.to = to
+        self.reply = reply
+        self.hooks = frozenset(hooks) if hooks is not None else None
+
+    def apply(self, recipient):
+        """The recipient once the rule is applied, or None when dropped"""
+        if self.action == 'redirect':
+            return self.to
+        if self.action == 'rewrite':
+            return u'{}@{}'.format(recipient.rpartition('@')[0], self.to.lstrip('@'))
+        if self.action == 'drop':
+            return None
+        return recipient
+
+    def __repr__(self):
+        return '<Rule {} {}>'.format(self.match, self.action)
+
+
+class Route(object):
+    __slots__ = ('recipients', 'hooks', 'reply')
+
+    def __init__(self, recipients, hooks=None, reply=None):
+        self.recipients = recipients
+        self.hooks = hooks  # names of the hooks to run, None for all of them
+        self.reply = reply
+
+
+def split(address):
+    address = address.strip().strip('<>').lower()
+    return address, address.rpartition('@')[2]
+
+
+class Router(object):
+    def __init__(self, rules):
+        self.addresses = {}
+        self.domains = {}
+        self.wildcards = {}
+        self.default = None
+
+        for options in rules:
+            rule = Rule(**options)
+            match = rule.match.lower()
+            if match == '*':
+                self.default = rule
+            elif match.startswith('*.'):
+                node = self.wildcards
+                for label in reversed(match[2:].split('.')):
+                    node = node.setdefault(label, {})
+                node[MATCH] = rule
+            elif '@' in match.lstrip('@'):
+                self.addresses[match] = rule
+            else:
+                self.domains[match.lstrip('@')] = rule
+
+    def match(self, recipient):
+        """The rule applying to a recipient, or None"""
+        address, domain = split(recipient)
+
+        rule = self.addresses.get(address) or self.domains.get(domain)
+        if rule is not None:
+            return rule
+
+        labels = domain.split('.')
+        node, found = self.wildcards, None
+        for depth in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[depth])
+            if node is None:
+                break
+            found = node.get(MATCH, found)
+        return found or self.default
+
+    def route(self, recipients):
+        routed, hooks = [], set()
+        every_hook = False
+
+        for recipient in recipients:
+            rule = self.match(recipient)
+            if rule is None:
+                routed.append(recipient)
+                every_hook = True
+                continue
+
+            if rule.action == 'reject':
+                return Route([], reply=rule.reply)
+
+            target = rule.apply(recipient)
+            if target is not None and target not in routed:
+                routed.append(target)
+                if rule.hooks is None:
+                    every_hook = True
+                else:
+                    hooks.update(rule.hooks)
+
+        return Route(routed, None if every_hook else frozenset(hooks))
+
+
+def validate(rules, hook_names=()):
+    """Returns a list of problems found in the rules"""
+    errors = []
+    for index, rule in enumerate(rules or []):
+        name = u'rule {} ({})'.format(index, rule.get('match'))
+        unknown = set(rule) - set(Rule.__slots__)
+        if unknown:
+            errors.append(u'{}: unknown keys {}'.format(name, ', '.join(sorted(unknown))))
+        if not rule.get('match'):
+            errors.append(u'{}: match is required'.format(name))
+        action = rule.get('action', 'deliver')
+        if action not in ACTIONS:
+            errors.append(u'{}: action should be one of {}'.format(name, ', '.join(ACTIONS)))
+        if action in ('redirect', 'rewrite') and not rule.get('to'):
+            errors.append(u'{}: {} needs "to"'.format(name, action))
+        for hook in rule.get('hooks') or []:
+            if hook not in hook_names:
+                errors.append(u'{}: hook {} is not loaded'.format(name, hook))
+    return errors
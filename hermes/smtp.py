@@ -1,33 +1,396 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import json
+import math
+import time
+import hashlib
 import smtpd
 import socket
 import smtplib
 import logging
 import asyncore
+import threading
 import contextlib
+import collections
+
+from .hooks import ExecutorHook, RejectMessage, hook_name, unwrapped
+from .relay import RelayQueue, domain_of
+from .retry import RetryLog
+from .throttle import Throttle, DUPLICATE_REPLY
+from .rules import Router
+from .message import Message
+from .metrics import Metrics, StatsWriter
+from .profiling import Profiler
 
 
 log = logging.getLogger('hermes')
 
+CRLF = b'\r\n'
+EOLS = re.compile(br'\r\n|\n|\r(?!\n)')
+LINE_DOTS = re.compile(br'(?<=\n)\.')  # starting a line after the first one
+BALANCE_OPTIONS = ('balance', 'max_failures', 'eject_time', 'check_interval')
+
+
+def sendmessage(connection, sender, recipients, message):
+    """Like SMTP.sendmail, but streams a Message in chunks instead of
+    building the whole DATA section in memory.
+
+    MAIL, RCPT and DATA are sent in one go when the server advertises
+    PIPELINING.
+    """
+    connection.ehlo_or_helo_if_needed()
+    options = mail_options(connection, message)
+    if connection.has_extn('pipelining'):
+        return pipelined_sendmessage(connection, sender, recipients, message, options)
+
+    code, response = connection.mail(sender, options)
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+
+    refused = {}
+    for recipient in recipients:
+        code, response = connection.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+
+    if len(refused) == len(recipients):
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    connection.putcmd('data')
+    code, response = connection.getreply()
+    if code != 354:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    senddata(connection, message)
+    return refused
+
+
+def mail_options(connection, message):
+    """ESMTP MAIL options SMTP.sendmail would send for the message"""
+    options = []
+    if connection.has_extn('size'):
+        options.append('size={}'.format(len(message)))
+    return options
+
+
+def pipelined_sendmessage(connection, sender, recipients, message, options=()):
+    commands = ['mail FROM:{}{}'.format(smtplib.quoteaddr(sender),
+                                        ''.join(' ' + option for option in options))]
+    commands.extend('rcpt TO:{}'.format(smtplib.quoteaddr(recipient)) for recipient in recipients)
+    commands.append('data')
+    connection.send(u''.join(command + u'\r\n' for command in commands))
+
+    sender_reply = connection.getreply()
+    refused = {}
+    for recipient in recipients:
+        code, response = connection.getreply()
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+    code, response = connection.getreply()
+
+    if code == 354 and (sender_reply[0] != 250 or len(refused) == len(recipients)):
+        # the server went on with DATA anyway, end it with an empty message
+        connection.send(b'.' + CRLF)
+        connection.getreply()
+
+    if sender_reply[0] != 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(sender_reply[0], sender_reply[1], sender)
+    if len(refused) == len(recipients):
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if code != 354:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    senddata(connection, message)
+    return refused
+
+
+def transparent(chunks):
+    """Yield chunks with CRLF line ends and the lines starting with a dot
+    doubled, wherever the chunks split lines and CRLF pairs"""
+    line_start, carried = True, b''
+    for chunk in chunks:
+        # a CR may be followed by the LF starting the next chunk
+        chunk = carried + chunk
+        carried = b'\r' if chunk.endswith(b'\r') else b''
+        chunk = EOLS.sub(CRLF, chunk[:-1] if carried else chunk)
+        if not chunk:
+            continue
+        stuffed = LINE_DOTS.sub(b'..', chunk)
+        if line_start and chunk.startswith(b'.'):
+            stuffed = b'.' + stuffed
+        line_start = chunk.endswith(b'\n')
+        yield stuffed
+    if carried:
+        yield CRLF
+
+
+def senddata(connection, message):
+    previous = b''
+    for chunk in transparent(message.iter_chunks()):
+        if previous:
+            connection.send(previous)
+        previous = chunk
+    # the terminator goes out with the last chunk rather than on its own,
+    # after a CRLF unless the message ends with one
+    if not previous.endswith(CRLF):
+        previous += CRLF
+    connection.send(previous + b'.' + CRLF)
+
+    code, response = connection.getreply()
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+
+def nodelay(connection):
+    """Disable Nagle's algorithm on a socket or SMTP connection.
+
+    Otherwise small writes, like a reply following another or the end of
+    DATA, are held back until the peer acknowledges the previous ones.
+    """
+    sock = getattr(connection, 'sock', connection)
+    if hasattr(sock, 'setsockopt'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def retryable(error):
+    """None when a refusal is temporary (4xx) and the message may be
+    accepted later, False otherwise"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+    else:
+        codes = [getattr(error, 'smtp_code', 400)]  # disconnected or unexpected, try again
+    if any(400 <= code < 500 for code in codes):
+        return None
+    return False
+
+
+def as_message(message):
+    if isinstance(message, Message):
+        return message
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    return Message.from_bytes(message)
+
+
+class PooledConnection(object):
+    __slots__ = ('connection', 'messages', 'released')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.messages = 0
+        self.released = time.time()
+
+
+class Pool(object):
+    """Keeps relay sessions open between messages.
+
+    At most size sessions are open at once: acquire waits for one to be
+    released or discarded when they are all in use. Idle sessions are
+    reused last-in first-out. A session is dropped once it has been idle
+    for more than idle_timeout seconds or has carried max_messages
+    messages, and is probed with RSET before reuse when it has been idle
+    for more than check_interval seconds.
+    """
+
+    def __init__(self, factory, size, idle_timeout=30, max_messages=100, check_interval=1):
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.check_interval = check_interval
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.take()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def take(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                entry = self.idle.pop()
+
+            idle_time = time.time() - entry.released
+            if idle_time > self.idle_timeout:
+                self.drop(entry)
+            elif idle_time > self.check_interval and not self.reset(entry):
+                self.drop(entry)
+            else:
+                return entry
+
+        return PooledConnection(self.factory())
+
+    def release(self, entry, reset=False, messages=1):
+        """Give back an acquired session, kept open for reuse when healthy"""
+        try:
+            entry.messages += messages
+
+            if entry.messages >= self.max_messages or (reset and not self.reset(entry)):
+                self.drop(entry)
+                return
+
+            entry.released = time.time()
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(entry)
+                    return
+
+            self.drop(entry)
+        finally:
+            self.slots.release()
+
+    def discard(self, entry):
+        """Give back an acquired session, closing it"""
+        try:
+            self.drop(entry)
+        finally:
+            self.slots.release()
+
+    def reset(self, entry):
+        """Check the session is alive and clear any pending transaction"""
+        try:
+            code, _ = entry.connection.rset()
+            return code == 250
+        except (socket.error, smtplib.SMTPException):
+            return False
+
+    def drop(self, entry):
+        try:
+            entry.connection.quit()
+        except (socket.error, smtplib.SMTPException):
+            entry.connection.close()
+
+    def close(self):
+        with self.lock:
+            entries, self.idle = list(self.idle), collections.deque()
+
+        for entry in entries:
+            self.drop(entry)
+
 
 class Sender(object):
     sender_class = smtplib.SMTP
+    retry = None  # RetryLog keeping the messages to relay again
 
-    def __init__(self, address):
+    def __init__(self, address, pool_size=0, idle_timeout=30, max_messages=100, metrics=None):
         self.address = address
+        self.metrics = metrics
+        self.pool = None
+        if pool_size:
+            self.pool = Pool(self.connect, pool_size, idle_timeout, max_messages)
 
     def send(self, sender, recipients, message):
-        with self.connection() as connection:
-            connection.sendmail(sender, recipients, message)
+        """Relay a message. Returns whether it was accepted by the relay"""
+        started = time.perf_counter()
+        outcome = None
+        try:
+            with self.connection() as connection:
+                try:
+                    if isinstance(message, Message):
+                        sendmessage(connection, sender, recipients, message)
+                    else:
+                        connection.sendmail(sender, recipients, message)
+                    outcome = True
+                except smtplib.SMTPException as error:
+                    outcome = retryable(error)
+                    raise
+        except (socket.error, smtplib.SMTPException) as error:
+            self.unreachable(error)
+        self.measure(started, [outcome])
+        self.settle([(sender, recipients, message)], [outcome])
+        return bool(outcome)
 
-    @contextlib.contextmanager
-    def connection(self):
+    def send_batch(self, messages):
+        """Relay (sender, recipients, message) tuples over a single session.
+
+        Returns whether each message was accepted by the relay.
+        """
+        outcomes = self.attempt(messages)
+        self.settle(messages, outcomes)
+        return [bool(outcome) for outcome in outcomes]
+
+    def attempt(self, messages):
+        """Relay (sender, recipients, message) tuples over a single session.
+
+        Returns for each message True once accepted, False when refused
+        for good and None when it may be accepted later.
+        """
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            with self.connection(len(messages)) as connection:
+                for sender, recipients, message in messages:
+                    try:
+                        sendmessage(connection, sender, recipients, as_message(message))
+                        outcomes.append(True)
+                    except (smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused,
+                            smtplib.SMTPDataError) as error:
+                        log.error(error)
+                        outcomes.append(retryable(error))
+        except (socket.error, smtplib.SMTPException) as error:
+            self.unreachable(error)
+        outcomes += [None] * (len(messages) - len(outcomes))
+        self.measure(started, outcomes)
+        return outcomes
+
+    def unreachable(self, error):
+        log.error('Could not connect to the relay server at {}. {}'.format(self.address, error))
+
+    def settle(self, messages, outcomes):
+        """Hand the messages that may be accepted later to the retry log"""
+        if self.retry is None:
+            return
+        deferred = [message for message, outcome in zip(messages, outcomes) if outcome is None]
+        if deferred:
+            self.retry.defer(deferred)
+        elif any(outcomes):
+            self.retry.recovered()
+
+    def measure(self, started, sent):
+        if self.metrics is None:
+            return
+        self.metrics.observe('relay', time.perf_counter() - started)
+        relayed = sum(1 for accepted in sent if accepted)
+        self.metrics.increment('relayed', relayed)
+        if relayed < len(sent):
+            self.metrics.increment('relay_failed', len(sent) - relayed)
+
+    def connect(self):
+        connection = self.sender_class()
         try:
-            connection = self.sender_class()
+            connection.connect(*self.address)
+            nodelay(connection)
+        except Exception:
+            connection.close()
+            raise
+        return connection
 
+    @contextlib.contextmanager
+    def connection(self, messages=1):
+        if self.pool is not None:
+            with self.pooled_connection(messages) as connection:
+                yield connection
+            return
+
+        connection = self.connect()  # raises when the relay server is unreachable
+        try:
             try:
-                connection.connect(*self.address)
                 yield connection
             finally:
                 connection.quit()
@@ -35,41 +398,799 @@ class Sender(object):
         except (socket.error, smtplib.SMTPException) as error:
             log.error(error)
 
+    @contextlib.contextmanager
+    def pooled_connection(self, messages=1):
+        entry = self.pool.acquire()
+        try:
+            try:
+                yield entry.connection
+            except smtplib.SMTPServerDisconnected:
+                self.pool.discard(entry)
+                raise
+            except smtplib.SMTPException:
+                self.pool.release(entry, reset=True, messages=messages)
+                raise
+            except BaseException:
+                self.pool.discard(entry)
+                raise
+            else:
+                self.pool.release(entry, messages=messages)
 
-class Server(smtpd.SMTPServer):
-    def __init__(self, local_address, remote_address):
-        smtpd.SMTPServer.__init__(self, local_address, remote_address)
-        self.sender = None if remote_address is None else Sender(remote_address)
+        except (socket.error, smtplib.SMTPException) as error:
+            log.error(error)
+
+    def start(self):
+        pass
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+
+class Upstream(object):
+    __slots__ = ('sender', 'weight', 'outstanding', 'current', 'failures', 'ejected_until')
+
+    def __init__(self, sender, weight=1):
+        self.sender = sender
+        self.weight = weight
+        self.outstanding = 0  # sessions in flight
+        self.current = 0  # smooth weighted round-robin counter
+        self.failures = 0  # failed sessions in a row
+        self.ejected_until = 0
+
+    def __repr__(self):
+        return '<Upstream {}>'.format(self.sender.address)
+
+
+class Balancer(Sender):
+    """Relays through several upstream servers.
+
+    Messages go to the upstream with the fewest sessions in flight for its
+    weight (least-outstanding), to each upstream in turn by weight
+    (round-robin), or to the same upstream for a recipient domain
+    (domain). Messages an upstream did not take are tried on the next one.
+
+    An upstream failing max_failures sessions in a row is ejected for
+    eject_time seconds. Every check_interval seconds each upstream is
+    probed with NOOP: ejected ones answering are put back, and others not
+    answering are ejected.
+    """
+
+    balances = ('least-outstanding', 'round-robin', 'domain')
+
+    def __init__(self, upstreams, balance='least-outstanding', max_failures=3, eject_time=30,
+                 check_interval=10, metrics=None, **options):
+        self.upstreams = [Upstream(Sender(address, metrics=metrics, **options), weight)
+                          for address, weight in upstreams]
+        self.address = [upstream.sender.address for upstream in self.upstreams]
+        self.balance = balance
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.check_interval = check_interval
+        self.metrics = metrics
+        self.pool = None
+        self.turn = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.checker = None
+
+    def send(self, sender, recipients, message):
+        return self.send_batch([(sender, recipients, message)])[0]
+
+    def attempt(self, messages):
+        outcomes = [None] * len(messages)
+        waiting = list(range(len(messages)))
+        domain = domain_of(messages[0][1]) if messages else ''
+        tried = set()
+
+        while waiting:
+            upstream = self.choose(domain, tried)
+            if upstream is None:
+                break
+            tried.add(upstream)
+            results = [None] * len(waiting)
+            try:
+                results = upstream.sender.attempt([messages[index] for index in waiting])
+            finally:
+                self.report(upstream, results)
+            for index, outcome in zip(waiting, results):
+                outcomes[index] = outcome
+            waiting = [index for index in waiting if outcomes[index] is None]
+            if waiting:
+                log.warning('{} messages not taken by {}, trying the next upstream'
+                            .format(len(waiting), upstream.sender.address))
+        return outcomes
+
+    def choose(self, domain, tried):
+        """The upstream for the next session, ejected ones only when every
+        other one was tried"""
+        now = time.time()
+        with self.lock:
+            candidates = [upstream for upstream in self.upstreams if upstream not in tried]
+            candidates = [upstream for upstream in candidates if upstream.ejected_until <= now] or candidates
+            if not candidates:
+                return None
+
+            if self.balance == 'domain':
+                upstream = max(candidates, key=lambda upstream: affinity(domain, upstream))
+            elif self.balance == 'round-robin':
+                total = sum(upstream.weight for upstream in candidates)
+                for candidate in candidates:
+                    candidate.current += candidate.weight
+                upstream = max(candidates, key=lambda upstream: upstream.current)
+                upstream.current -= total
+            else:
+                # ties go to each upstream in turn
+                self.turn = (self.turn + 1) % len(candidates)
+                candidates = candidates[self.turn:] + candidates[:self.turn]
+                upstream = min(candidates, key=lambda upstream: upstream.outstanding / upstream.weight)
+
+            upstream.outstanding += 1
+            return upstream
+
+    def report(self, upstream, results):
+        """Count a session failing when the upstream took none of its
+        messages and some may be accepted later"""
+        with self.lock:
+            upstream.outstanding -= 1
+            if any(results) or None not in results:
+                upstream.failures = 0
+                return
+            upstream.failures += 1
+            if upstream.failures >= self.max_failures and upstream.ejected_until <= time.time():
+                self.eject(upstream)
+
+    def eject(self, upstream):
+        upstream.ejected_until = time.time() + self.eject_time
+        log.warning('Relay server at {} ejected for {} seconds'
+                    .format(upstream.sender.address, self.eject_time))
+        if self.metrics is not None:
+            self.metrics.increment('relay_ejected')
+
+    def start(self):
+        if self.check_interval:
+            self.checker = threading.Thread(target=self.check, name='hermes-upstreams')
+            self.checker.daemon = True
+            self.checker.start()
+
+    def check(self):
+        while not self.closed.wait(self.check_interval):
+            for upstream in self.upstreams:
+                healthy = self.probe(upstream)
+                with self.lock:
+                    if healthy and upstream.ejected_until:
+                        upstream.ejected_until = upstream.failures = 0
+                        log.info('Relay server at {} is back'.format(upstream.sender.address))
+                    elif not healthy and upstream.ejected_until <= time.time():
+                        self.eject(upstream)
+
+    def probe(self, upstream):
+        """Whether an upstream answers NOOP"""
+        connection = upstream.sender.sender_class()
+        connection.timeout = self.check_interval
+        try:
+            connection.connect(*upstream.sender.address)
+            code, _ = connection.noop()
+            connection.quit()
+            return code == 250
+        except (socket.error, smtplib.SMTPException):
+            connection.close()
+            return False
 
-    def process_message(self, address, sender, recipients, message):
+    def close(self):
+        self.closed.set()
+        if self.checker is not None:
+            self.checker.join(self.check_interval)
+        for upstream in self.upstreams:
+            upstream.sender.close()
+
+
+def affinity(domain, upstream):
+    """Weighted rendezvous hashing score: a domain goes to the upstream
+    scoring highest, and only moves when that upstream is ejected"""
+    key = u'{}\n{}'.format(domain, upstream.sender.address).encode('utf-8')
+    value = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+    return -upstream.weight / math.log((value + 1) / (2.0 ** 64 + 1))
+
+
+def upstream_list(remote_address):
+    """[(address, weight)] from a (host, port) address or a list of
+    (host, port[, weight]) upstreams"""
+    if isinstance(remote_address[0], (list, tuple)):
+        return [((upstream[0], int(upstream[1])), upstream[2] if len(upstream) > 2 else 1)
+                for upstream in remote_address]
+    return [((remote_address[0], int(remote_address[1])), 1)]
+
+
+def hook_message(hook, message):
+    """Hooks get a Message if they accept one, the raw message otherwise"""
+    return next(hook_messages([hook], message))[1]
+
+
+def hook_messages(hooks, message):
+    """Each hook with the message it gets. The raw message is copied once,
+    when the first hook not accepting a Message runs, and shared by the rest"""
+    raw = None
+    for hook in hooks:
+        if isinstance(message, Message) and not getattr(hook, 'accepts_message', False):
+            if raw is None:
+                raw = message.as_bytes()
+            yield hook, raw
+        else:
+            yield hook, message
+
+
+class Pipeline(object):
+    """Hooks, routing rules and relay a message goes through.
+
+    A server swaps its pipeline as a whole on reload: every message is
+    processed start to end by the pipeline it started with, and the
+    previous pipeline is closed once its last message is done.
+    """
+
+    def __init__(self, hooks=(), router=None, sender=None, relay=None, relay_settings=None):
+        self.hooks = list(hooks)
+        self.router = router
+        self.sender = sender
+        self.relay = relay
+        self.relay_settings = relay_settings  # what sender and relay were created from
+        self.selections = {}
+        self.active = 0
+        self.idle = threading.Condition()
+
+    def enter(self):
+        with self.idle:
+            self.active += 1
+
+    def leave(self):
+        with self.idle:
+            self.active -= 1
+            if not self.active:
+                self.idle.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Wait for the messages being processed. False on timeout"""
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.active, timeout)
+
+    def selected_hooks(self, names):
+        """Hooks named by a route, in their configured order"""
+        if names is None:
+            return self.hooks
+
+        if names not in self.selections:
+            self.selections[names] = [hook for hook in self.hooks if hook_name(hook) in names]
+        return self.selections[names]
+
+    def start(self):
+        if self.sender is not None:
+            self.sender.start()
+        if self.relay is not None:
+            self.relay.start()
+
+    def close(self, keep=None):
+        """Close the relay and hooks, but the ones also used by keep"""
+        self.close_relay(keep)
+        self.close_hooks(keep)
+
+    def close_relay(self, keep=None, timeout=None):
+        """Returns the number of queued messages left behind"""
+        abandoned = 0
+        if self.relay is not None and (keep is None or keep.relay is not self.relay):
+            abandoned = self.relay.close(timeout)
+        if self.sender and (keep is None or keep.sender is not self.sender):
+            self.sender.close()
+        return abandoned
+
+    def close_hooks(self, keep=None):
+        # a kept extension may run on a new executor, whose wrapper is another object
+        kept = [unwrapped(other) for other in keep.hooks] if keep is not None else []
+        for hook in self.hooks:
+            shared = any(unwrapped(hook) is other for other in kept)
+            if isinstance(hook, ExecutorHook):
+                hook.close(close_hook=not shared)
+            elif hasattr(hook, 'close') and not shared:
+                hook.close()
+
+
+class BaseServer(object):
+    """Message processing shared by every server engine.
+
+    Engines are responsible for accepting SMTP sessions and must call
+    process_message once per received message.
+    """
+
+    stats = None
+    pipeline = None
+    retry = None
+    throttle = None
+    profiler = None
+    reload_timeout = 300  # longest wait for messages still using a replaced pipeline
+    draining = False
+    drain_deadline = None
+    report = None  # what a graceful shutdown drained or abandoned
+    shutdown_file = None  # where to write the report, {pid} is replaced by the process id
+
+    def __init__(self, local_address, remote_address, relay_options=None, queue_options=None,
+                 reuse_port=False, spool_options=None, stats_file=None, rules=None, retry_options=None,
+                 throttle_options=None):
+        self._localaddr = local_address
+        self._remoteaddr = remote_address
+        self.spool_options = spool_options or {}
+        self.metrics = Metrics()
+        self.stats_file = stats_file
+        self.retry = self.create_retry(retry_options)
+        self.throttle = self.create_throttle(throttle_options)
+        self.pipeline = self.create_pipeline([], remote_address, relay_options, queue_options, rules)
+        self.watch_relay_queue()
+
+    def watch_relay_queue(self):
+        """Report the depth and drops of the relay queue of the current pipeline"""
+        def relay_stat(name):
+            relay = self.pipeline.relay
+            return 0 if relay is None else getattr(relay, name)
+
+        self.metrics.gauge('relay_queue_depth', lambda: relay_stat('depth'))
+        self.metrics.gauge('relay_queue_dropped', lambda: relay_stat('dropped'))
+
+    def create_sender(self, remote_address, relay_options):
+        if remote_address is None:
+            return None
+        options = dict(relay_options or {})
+        balance = dict((name, options.pop(name)) for name in BALANCE_OPTIONS if name in options)
+        upstreams = upstream_list(remote_address)
+        if len(upstreams) > 1:
+            sender = Balancer(upstreams, metrics=self.metrics, **dict(options, **balance))
+        else:
+            sender = Sender(upstreams[0][0], metrics=self.metrics, **options)
+        sender.retry = self.retry
+        return sender
+
+    def create_retry(self, retry_options):
+        if not retry_options or not retry_options.get('directory'):
+            return None
+        return RetryLog(metrics=self.metrics, **retry_options)
+
+    def create_throttle(self, throttle_options):
+        options = throttle_options or {}
+        if not (options.get('sender_rate') or options.get('recipient_rate') or options.get('window')):
+            return None
+        return Throttle(**options)
+
+    def redeliver(self, messages):
+        """Relay deferred messages with the current sender"""
+        sender = self.pipeline.sender
+        if sender is None:
+            return [None] * len(messages)
+        return sender.attempt(messages)
+
+    def create_router(self, rules):
+        if not rules:
+            return None
+        return Router(rules)
+
+    def create_relay(self, sender, queue_options):
+        if sender is None or not queue_options or not queue_options.get('size'):
+            return None
+        return RelayQueue(sender, **queue_options)
+
+    def create_pipeline(self, hooks, remote_address=None, relay_options=None, queue_options=None,
+                        rules=None, current=None):
+        """A pipeline, sharing the sender and relay of current when their
+        settings did not change"""
+        relay_settings = (remote_address, relay_options, queue_options)
+        if current is not None and current.relay_settings == relay_settings:
+            sender, relay = current.sender, current.relay
+        else:
+            sender = self.create_sender(remote_address, relay_options)
+            relay = self.create_relay(sender, queue_options)
+        return Pipeline(hooks, self.create_router(rules), sender, relay, relay_settings)
+
+    def reconfigure(self, hooks, remote_address=None, relay_options=None, queue_options=None,
+                    rules=None):
+        """Swap in new hooks, rules and relay settings for the next messages.
+
+        Messages being processed finish with the previous pipeline, which
+        is closed in the background once they are done.
+        """
+        current = self.pipeline
+        pipeline = self.create_pipeline(hooks, remote_address, relay_options, queue_options,
+                                        rules, current)
+        if pipeline.sender is not current.sender:
+            pipeline.start()
+        self._remoteaddr = remote_address
+        self.pipeline = pipeline
+
+        retire = threading.Thread(target=self.retire_pipeline, args=(current, pipeline),
+                                  name='hermes-retire')
+        retire.daemon = True
+        retire.start()
+        return pipeline
+
+    def retire_pipeline(self, pipeline, replacement):
+        if not pipeline.wait_idle(self.reload_timeout):
+            log.warning('Closing the previous hooks with {} messages still being processed'
+                        .format(pipeline.active))
+        pipeline.close(keep=replacement)
+
+    def process_message(self, address, sender, recipients, message, **kwargs):
         log.info('Message from {} at {} to {}'.format(
             sender, address, recipients))
+        started = time.perf_counter()
+        self.metrics.increment('messages')
 
-        for hook in self.hooks:
-            log.debug('Running hook {}'.format(type(hook)))
-            self.run_hook(hook, address, sender, recipients, message)
+        pipeline = self.pipeline
+        pipeline.enter()
+        try:
+            return self.run_pipeline(pipeline, address, sender, recipients, message)
+        finally:
+            pipeline.leave()
+            self.metrics.observe('process', time.perf_counter() - started)
 
-        if self.sender:
-            log.info('Proxying message to relay server at {}'
-                     .format(self._remoteaddr))
-            self.sender.send(sender, recipients, message)
+    def run_pipeline(self, pipeline, address, sender, recipients, message):
+        hooks = pipeline.hooks
+        if pipeline.router is not None:
+            route = pipeline.router.route(recipients)
+            if route.reply is not None:
+                self.metrics.increment('rejected')
+                return route.reply
+            if not route.recipients:
+                log.info('Every recipient dropped by the routing rules')
+                self.metrics.increment('dropped')
+                return None
+            recipients = route.recipients
+            hooks = pipeline.selected_hooks(route.hooks)
 
-    def run(self):
-        log.info('Starting server at {}'.format(self._localaddr))
+        if self.throttle is None:
+            return self.deliver(pipeline, hooks, address, sender, recipients, message)
+
+        reply, ticket = self.throttle.check(sender, recipients, message)
+        if reply is not None:
+            log.warning('Message from {} to {} refused. {}'.format(sender, recipients, reply))
+            self.metrics.increment('duplicates' if reply == DUPLICATE_REPLY else 'throttled')
+            return reply
+
+        # the tokens and content of a refused message are given back
         try:
-            asyncore.loop()
+            reply = self.deliver(pipeline, hooks, address, sender, recipients, message)
         except Exception:
-            self.close()
+            self.throttle.release(ticket)
+            raise
+        if reply is not None:
+            self.throttle.release(ticket)
+        return reply
+
+    def deliver(self, pipeline, hooks, address, sender, recipients, message):
+        """Run the hooks and relay a message, None once accepted or the reply refusing it"""
+        try:
+            for hook, hooked in hook_messages(hooks, message):
+                log.debug('Running hook {}'.format(type(hook)))
+                self.run_hook(hook, address, sender, recipients, hooked)
+        except RejectMessage as rejection:
+            self.metrics.increment('rejected')
+            return rejection.reply
+
+        if pipeline.sender:
+            log.info('Proxying message to relay server at {}'
+                     .format(pipeline.sender.address))
+            if pipeline.relay is None:
+                pipeline.sender.send(sender, recipients, message)
+            elif not pipeline.relay.put(sender, recipients, message):
+                log.warning('Relay queue full ({} messages). Message rejected'
+                            .format(pipeline.relay.depth))
+                self.metrics.increment('relay_queue_full')
+                return '451 Relay queue full, try again later'
 
     def run_hook(self, hook, address, sender, recipients, message):
+        started = time.perf_counter()
         try:
             hook(address, sender, recipients, message)
+        except RejectMessage:
+            raise
         except Exception as error:
+            self.metrics.increment('hook_errors')
             log.error('Failed to run {}. {}: {}'.format(
                 repr(type(hook)), type(error), error), exc_info=True)
+        finally:
+            self.metrics.observe('hook.' + hook_name(hook), time.perf_counter() - started)
+
+    def start_relay(self):
+        self.pipeline.start()
+        if self.retry is not None:
+            self.retry.open(self.redeliver)
+
+    def start_stats(self):
+        """Periodically write metrics to stats_file, where {pid} is replaced
+        by the process id"""
+        if self.stats_file:
+            self.stats = StatsWriter(self.metrics, self.stats_file.format(pid=os.getpid()))
+            self.stats.start()
+
+    def toggle_profiling(self, path):
+        """Start profiling messages and hooks, or stop and return the thread
+        writing the profile to path. Safe to call from a signal handler"""
+        if self.profiler is None:
+            profiler = self.profiler = Profiler(path)
+            process_message, run_hook = self.process_message, self.run_hook
+            # instance attributes shadowing the methods while profiling only
+            self.process_message = lambda *args, **kwargs: profiler.call(process_message, *args, **kwargs)
+            self.run_hook = lambda hook, *args: profiler.call(
+                profiler.named('hook.' + hook_name(hook)), run_hook, hook, *args)
+            log.info('Profiling started, send the same signal again to write it to {}'.format(path))
+        else:
+            profiler, self.profiler = self.profiler, None
+            del self.process_message, self.run_hook
+            return profiler.stop()
+
+    def close_stats(self):
+        if self.stats is not None:
+            self.stats.close()
+            self.stats = None
+
+    def shutdown(self, timeout=30):
+        """Stop gracefully: stop accepting sessions, close idle ones, let
+        the others finish their message and drain the relay queue, all
+        within timeout seconds. Safe to call from a signal handler.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        self.drain_deadline = time.time() + timeout
+        self.report = dict(pid=os.getpid(), started=time.time(), sessions_closed=0,
+                           sessions_finished=0, sessions_abandoned=0,
+                           relay_drained=0, relay_abandoned=0)
+        log.info('Shutting down, draining for up to {} seconds'.format(timeout))
+        self.drain()
+
+    def drain(self):
+        """Stop accepting sessions and end the open ones, engine specific"""
+        raise NotImplementedError()
+
+    def count_drained_session(self, drained, abandoned=False):
+        """Count a session ending during a graceful shutdown"""
+        if self.report is None:
+            return
+        if abandoned:
+            self.report['sessions_abandoned'] += 1
+        elif drained:
+            self.report['sessions_finished'] += 1
+        else:
+            self.report['sessions_closed'] += 1
+
+    def drain_timeout(self):
+        """Seconds left to drain, None when not shutting down gracefully"""
+        if self.drain_deadline is None:
+            return None
+        return max(0, self.drain_deadline - time.time())
+
+    def close_relay(self):
+        relay = self.pipeline.relay
+        queued = relay.depth if relay is not None else 0
+        abandoned = self.pipeline.close_relay(timeout=self.drain_timeout())
+        if self.report is not None:
+            self.report.update(relay_drained=max(0, queued - abandoned), relay_abandoned=abandoned)
+        if self.retry is not None:
+            self.retry.close()  # after the relay queue, whose failures it keeps
+
+    def close_report(self):
+        """Log the shutdown report, and write it to shutdown_file for
+        `hermes stop`"""
+        report, self.report = self.report, None
+        if report is None:
+            return
+
+        report['seconds'] = time.time() - report.pop('started')
+        log.info('Shut down in {seconds:.1f}s. Sessions: {sessions_finished} finished, '
+                 '{sessions_closed} idle closed, {sessions_abandoned} abandoned. '
+                 'Relay queue: {relay_drained} drained, {relay_abandoned} abandoned'.format(**report))
+        if self.shutdown_file:
+            path = self.shutdown_file.format(pid=report['pid'])
+            try:
+                with open(path, 'w') as stream:
+                    json.dump(report, stream)
+            except (IOError, OSError) as error:
+                log.warning('Could not write shutdown report to {}. {}'.format(path, error))
+
+    def close_hooks(self):
+        self.pipeline.close_hooks()
+
+    @property
+    def hooks(self):
+        return self.pipeline.hooks
+
+    @property
+    def sender(self):
+        return self.pipeline.sender
+
+    @property
+    def relay(self):
+        return self.pipeline.relay
+
+    @property
+    def router(self):
+        return self.pipeline.router
 
     @classmethod
-    def create(cls, address, hooks, proxy_address=None):
-        instance = cls(address, proxy_address)
-        instance.hooks = hooks
+    def create(cls, address, hooks, proxy_address=None, **options):
+        instance = cls(address, proxy_address, **options)
+        instance.pipeline.hooks = list(hooks)
         return instance
+
+
+class Channel(smtpd.SMTPChannel):
+    """SMTPChannel streaming the DATA section into a Message as it arrives,
+    measuring how long it takes, and closing once its message is done when
+    the server shuts down"""
+
+    data_started = None
+    message = None  # DATA received so far
+    carried = b''  # CR which may start the CRLF of the next data
+    line_start = True
+    closing = False
+    drained = False  # processed a message while the server shuts down
+    abandoned = False
+    ended = False
+
+    @property
+    def idle(self):
+        return self.smtp_state == self.COMMAND and self.mailfrom is None
+
+    def smtp_QUIT(self, arg):
+        self.closing = True
+        smtpd.SMTPChannel.smtp_QUIT(self, arg)
+
+    def close_gracefully(self):
+        self.closing = True
+        self.push('421 {} Service closing transmission channel'.format(self.fqdn))
+        self.close_when_done()
+
+    def close(self):
+        if not self.ended:
+            self.ended = True
+            self.smtp_server.count_drained_session(self.drained, self.abandoned)
+        smtpd.SMTPChannel.close(self)
+
+    def smtp_DATA(self, arg):
+        smtpd.SMTPChannel.smtp_DATA(self, arg)
+        if self.smtp_state == self.DATA:
+            self.data_started = time.perf_counter()
+
+    def _set_post_data_state(self):
+        smtpd.SMTPChannel._set_post_data_state(self)
+        self.message, self.carried, self.line_start = None, b'', True
+
+    def collect_incoming_data(self, data):
+        if self.smtp_state != self.DATA:
+            return smtpd.SMTPChannel.collect_incoming_data(self, data)
+        if self.data_size_limit and self.num_bytes > self.data_size_limit:
+            return
+        self.num_bytes += len(data)
+        if self.message is None:
+            self.message = Message(**self.smtp_server.spool_options)
+
+        # undo dot-stuffing and turn CRLF into LF like smtpd, line by line
+        # across the pieces of data asynchat hands over
+        lines = (self.carried + data).split(b'\r\n')
+        last = lines.pop()
+        self.carried = b'\r' if last.endswith(b'\r') else b''
+        if self.carried:
+            last = last[:-1]
+        pieces = []
+        for line in lines:
+            pieces.append(self.unstuffed(line))
+            pieces.append(b'\n')
+            self.line_start = True
+        if last:
+            pieces.append(self.unstuffed(last))
+            self.line_start = False
+        self.message.write(b''.join(pieces))
+
+    def unstuffed(self, line):
+        return line[1:] if self.line_start and line.startswith(b'.') else line
+
+    def receive_message(self):
+        if self.data_size_limit and self.num_bytes > self.data_size_limit:
+            self._set_post_data_state()
+            return self.push('552 Error: Too much mail data')
+
+        message = self.message or Message(**self.smtp_server.spool_options)
+        message.write(self.carried)
+        status = self.smtp_server.process_message(self.peer, self.mailfrom, self.rcpttos, message.finish(),
+                                                  mail_options=self.mail_options,
+                                                  rcpt_options=self.rcpt_options)
+        self._set_post_data_state()
+        self.push(status or '250 OK')
+
+    def found_terminator(self):
+        in_data = self.smtp_state == self.DATA
+        if in_data and self.data_started is not None:
+            self.smtp_server.metrics.observe('data', time.perf_counter() - self.data_started)
+            self.data_started = None
+        if in_data:
+            self.received_lines = []
+            self.receive_message()
+        else:
+            smtpd.SMTPChannel.found_terminator(self)
+
+        if in_data and self.smtp_server.draining:
+            self.drained = True
+        if self.smtp_server.draining and self.idle and not self.closing:
+            self.close_gracefully()
+
+
+class Server(BaseServer, smtpd.SMTPServer):
+    channel_class = Channel
+
+    def __init__(self, local_address, remote_address, relay_options=None, queue_options=None,
+                 reuse_port=False, spool_options=None, stats_file=None, rules=None, retry_options=None,
+                 throttle_options=None):
+        BaseServer.__init__(self, local_address, remote_address, relay_options, queue_options,
+                            reuse_port, spool_options, stats_file, rules, retry_options,
+                            throttle_options)
+        self.reuse_port = reuse_port
+        smtpd.SMTPServer.__init__(self, local_address, remote_address)
+
+    def process_message(self, address, sender, recipients, message, **kwargs):
+        if isinstance(message, bytes):
+            message = Message.from_bytes(message)
+        return BaseServer.process_message(self, address, sender, recipients, message, **kwargs)
+
+    def handle_accepted(self, connection, address):
+        started = time.perf_counter()
+        self.metrics.increment('sessions')
+        nodelay(connection)
+        smtpd.SMTPServer.handle_accepted(self, connection, address)
+        self.metrics.observe('accept', time.perf_counter() - started)
+
+    def set_reuse_addr(self):
+        smtpd.SMTPServer.set_reuse_addr(self)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def run(self):
+        log.info('Starting server at {}'.format(self._localaddr))
+        self.start_relay()
+        self.start_stats()
+        try:
+            # until the server and every session are closed, waking up
+            # every second to check for a shutdown
+            while asyncore.socket_map:
+                asyncore.loop(timeout=1, count=1)
+                if self.draining:
+                    self.drain_sessions()
+        except Exception:
+            self.close()
+
+    def channels(self):
+        return [channel for channel in list(asyncore.socket_map.values())
+                if isinstance(channel, smtpd.SMTPChannel)]
+
+    def drain(self):
+        # sockets are closed by run: a signal handler interrupting select
+        # must not close the ones it waits on
+        pass
+
+    def drain_sessions(self):
+        if not self.drain_timeout():
+            self.abandon_sessions()
+        if not self.accepting:
+            return
+
+        asyncore.dispatcher.close(self)  # stop accepting, sessions go on
+        for channel in self.channels():
+            if channel.idle:
+                channel.close_gracefully()
+
+    def abandon_sessions(self):
+        for channel in self.channels():
+            if not channel.closing:
+                log.warning('Session with {} abandoned on shutdown'.format(channel.addr))
+                channel.abandoned = True
+            channel.close()
+
+    def close(self):
+        smtpd.SMTPServer.close(self)
+        self.close_stats()
+        self.close_relay()
+        self.close_hooks()
+        self.close_report()
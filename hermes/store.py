@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only message store
+
+Messages are appended to segment files along with their envelope. Each
+segment has an index file of fixed size entries, so a message is found
+from its id without scanning the segments:
+
+    directory/
+        00000000000000000001.seg   records for messages 1 .. n
+        00000000000000000001.idx   (offset, length) of each record
+
+A record is a header (length, crc32, timestamp, sender, recipients and
+body sizes) followed by the sender, the recipients separated by newlines
+and the body. Segments are rotated by size or age, read back through
+mmap and synced to disk in batches.
+
+A store opened with compress=True writes new segments as `.segz` files
+whose record bodies are compressed one by one, prefixed with the id of
+the shared dictionary used and the uncompressed size, so any message is
+still read alone (see hermes.compression). Dictionaries are trained from
+the first messages, then again on every rotation.
+
+Writes are synced every sync_batch messages, or sync_interval seconds
+after the first one not synced yet, by a background thread when no
+other message comes.
+
+    store = Store('/var/lib/hermes')
+    id = store.append('me@example.com', ['you@example.com'], b'Subject: hi')
+    store.get(id).body
+"""
+
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import bisect
+import struct
+import logging
+import functools
+import threading
+
+from .compression import Codec
+from .indexes import Indexes
+from .message import Message
+
+log = logging.getLogger('hermes')
+
+HEADER = struct.Struct('>IIdHI')  # length, crc32, timestamp, sender size, recipients size
+ENTRY = struct.Struct('>QI')  # record offset and length
+ZBODY = struct.Struct('>HI')  # compression dictionary id, uncompressed body size
+SEGMENT_SUFFIX = '.seg'
+COMPRESSED_SUFFIX = '.segz'
+INDEX_SUFFIX = '.idx'
+
+
+class StoreError(Exception):
+    pass
+
+
+class StoredMessage(object):
+    """A stored message. The body of a compressed one is given as data and
+    decoded with decode on first access, its size being known beforehand"""
+    __slots__ = ('id', 'timestamp', 'sender', 'recipients', 'size', 'data', 'decode', 'decoded')
+
+    def __init__(self, id, timestamp, sender, recipients, body, size=None, decode=None):
+        self.id = id
+        self.timestamp = timestamp
+        self.sender = sender
+        self.recipients = recipients
+        self.size = len(body) if size is None else size
+        self.data, self.decode = (body, decode) if decode is not None else (None, None)
+        self.decoded = body if decode is None else None
+
+    @property
+    def body(self):
+        if self.decoded is None:
+            self.decoded = self.decode(self.data)
+        return self.decoded
+
+    def __repr__(self):
+        return '<StoredMessage {} from {}>'.format(self.id, self.sender)
+
+
+def body_chunks(message):
+    """Returns the size of a message body and a function iterating over it"""
+    if hasattr(message, 'iter_chunks'):
+        return len(message), message.iter_chunks
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    return len(message), lambda: [message]
+
+
+def headers_of(message):
+    """The start of a message body, enough to read its headers"""
+    if hasattr(message, 'getbuffer'):
+        return message.getbuffer()
+    if isinstance(message, str):
+        return message[:2 ** 16].encode('utf-8')
+    return message
+
+
+def decode_record(id, record, codec=None):
+    """Build a StoredMessage from a record held in a memoryview, whose body
+    is decompressed with codec on first access for compressed segments"""
+    length, crc, timestamp, sender_size, recipients_size = HEADER.unpack_from(record)
+    start = HEADER.size
+    sender = bytes(record[start:start + sender_size]).decode('utf-8')
+    start += sender_size
+    recipients = bytes(record[start:start + recipients_size]).decode('utf-8')
+    start += recipients_size
+    recipients = recipients.split('\n') if recipients else []
+    body = record[start:length]
+    if codec is None:
+        return StoredMessage(id, timestamp, sender, recipients, body)
+    dictionary, size = ZBODY.unpack_from(body)
+    return StoredMessage(id, timestamp, sender, recipients, body[ZBODY.size:], size,
+                         functools.partial(codec.decompress, dictionary))
+
+
+class Segment(object):
+    def __init__(self, directory, first_id, codec=None):
+        self.first_id = first_id
+        self.codec = codec
+        suffix = SEGMENT_SUFFIX if codec is None else COMPRESSED_SUFFIX
+        self.path = os.path.join(directory, '{:020d}{}'.format(first_id, suffix))
+        self.index_path = os.path.join(directory, '{:020d}{}'.format(first_id, INDEX_SUFFIX))
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.map = None
+        self.recover()
+        self.created = self.first_timestamp() or time.time()
+
+    @property
+    def last_id(self):
+        return self.first_id + self.count - 1
+
+    def recover(self):
+        """Drop torn records and index records missing from the index file"""
+        self.size = os.fstat(self.fd).st_size
+        index_size = os.fstat(self.index_fd).st_size
+        self.count = index_size // ENTRY.size
+        os.ftruncate(self.index_fd, self.count * ENTRY.size)
+
+        offset = 0
+        if self.count:
+            offset, length = self.entry(self.count - 1)
+            offset += length
+
+        recovered = 0
+        while offset + HEADER.size <= self.size:
+            header = os.pread(self.fd, HEADER.size, offset)
+            length = HEADER.unpack(header)[0]
+            record = os.pread(self.fd, length, offset)
+            if length < HEADER.size or len(record) < length or not self.valid(record):
+                break
+            os.write(self.index_fd, ENTRY.pack(offset, length))
+            self.count += 1
+            recovered += 1
+            offset += length
+
+        if offset < self.size:
+            log.warning('Dropping {} bytes of incomplete records from {}'
+                        .format(self.size - offset, self.path))
+            os.ftruncate(self.fd, offset)
+            self.size = offset
+
+        if recovered:
+            log.info('Recovered {} records missing from {}'.format(recovered, self.index_path))
+
+    def valid(self, record):
+        crc = HEADER.unpack_from(record)[1]
+        return zlib.crc32(memoryview(record)[8:]) == crc
+
+    def first_timestamp(self):
+        if not self.count:
+            return None
+        return HEADER.unpack(os.pread(self.fd, HEADER.size, 0))[2]
+
+    def entry(self, position):
+        return ENTRY.unpack(os.pread(self.index_fd, ENTRY.size, position * ENTRY.size))
+
+    def append(self, timestamp, sender, recipients, message):
+        sender = sender.encode('utf-8')
+        recipients = u'\n'.join(recipients).encode('utf-8')
+        body_size, chunks = body_chunks(message)
+        if self.codec is not None:
+            dictionary, data = self.codec.compress(chunks())
+            body = [ZBODY.pack(dictionary, body_size), data]
+            body_size, chunks = ZBODY.size + len(data), lambda: body
+
+        length = HEADER.size + len(sender) + len(recipients) + body_size
+        crc = zlib.crc32(struct.pack('>dHI', timestamp, len(sender), len(recipients)))
+        crc = zlib.crc32(recipients, zlib.crc32(sender, crc))
+        for chunk in chunks():
+            crc = zlib.crc32(chunk, crc)
+
+        os.write(self.fd, HEADER.pack(length, crc, timestamp, len(sender), len(recipients)) +
+                 sender + recipients)
+        for chunk in chunks():
+            os.write(self.fd, chunk)
+        os.write(self.index_fd, ENTRY.pack(self.size, length))
+
+        if not self.count:
+            self.created = timestamp
+        self.size += length
+        self.count += 1
+        return self.first_id + self.count - 1
+
+    def read(self, id):
+        position = id - self.first_id
+        if position < 0 or position >= self.count:
+            return None
+
+        offset, length = self.entry(position)
+        if self.map is None or len(self.map) < offset + length:
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        return decode_record(id, memoryview(self.map)[offset:offset + length], self.codec)
+
+    def records(self):
+        for id in range(self.first_id, self.first_id + self.count):
+            yield self.read(id)
+
+    def sync(self):
+        os.fsync(self.fd)
+        os.fsync(self.index_fd)
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.index_fd)
+
+
+class Store(object):
+    def __init__(self, directory, segment_size=64 * 2 ** 20, segment_age=24 * 3600,
+                 sync_interval=1.0, sync_batch=100, indexed=True, compress=False, compress_level=6):
+        self.directory = directory
+        self.compress = compress
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
+        self.lock = threading.RLock()
+        self.unsynced = 0
+        self.synced = time.time()
+        self.listeners = []  # called with the id of every appended message
+        self.stopped = threading.Event()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lockfile = self.acquire_directory()
+
+        # dictionaries of segments compressed before are needed even if compress is off now
+        self.codec = Codec(directory, compress_level)
+        found = sorted((int(name[:-len(suffix)]), suffix == COMPRESSED_SUFFIX)
+                       for name in os.listdir(directory)
+                       for suffix in (SEGMENT_SUFFIX, COMPRESSED_SUFFIX) if name.endswith(suffix))
+        self.segments = [Segment(directory, first_id, self.codec if compressed else None)
+                         for first_id, compressed in found or [(1, compress)]]
+        self.first_ids = [segment.first_id for segment in self.segments]
+
+        self.indexes = None
+        if indexed:
+            self.indexes = Indexes(os.path.join(directory, 'indexes.log'))
+            self.indexes.catch_up(self)
+
+        self.flusher = threading.Thread(target=self.flush, name='hermes-store-sync')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def acquire_directory(self):
+        lockfile = open(os.path.join(self.directory, 'LOCK'), 'w')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lockfile.close()
+            raise StoreError('Store at {} is in use by another process'.format(self.directory))
+        return lockfile
+
+    @property
+    def active(self):
+        return self.segments[-1]
+
+    @property
+    def last_id(self):
+        return self.active.last_id
+
+    def __len__(self):
+        return self.last_id - self.segments[0].first_id + 1
+
+    def append(self, sender, recipients, message, timestamp=None):
+        """Store a message and return its id"""
+        timestamp = time.time() if timestamp is None else timestamp
+
+        with self.lock:
+            if self.should_rotate(timestamp):
+                self.rotate()
+            if self.active.codec is not None:
+                self.codec.sample(headers_of(message))
+            id = self.active.append(timestamp, sender, recipients, message)
+            if self.indexes is not None:
+                self.indexes.add(id, timestamp, sender, recipients,
+                                 message if isinstance(message, Message) else headers_of(message))
+            self.unsynced += 1
+            if self.unsynced >= self.sync_batch or timestamp - self.synced >= self.sync_interval:
+                self.sync()
+
+        for listener in self.listeners:
+            listener(id)
+        return id
+
+    def should_rotate(self, now):
+        segment = self.active
+        return segment.count and (segment.size >= self.segment_size or
+                                  now - segment.created >= self.segment_age)
+
+    def rotate(self):
+        self.active.sync()
+        if self.compress:
+            self.codec.retrain()
+        segment = Segment(self.directory, self.last_id + 1, self.codec if self.compress else None)
+        self.segments.append(segment)
+        self.first_ids.append(segment.first_id)
+        log.info('Rotated store segment to {}'.format(segment.path))
+
+    def get(self, id):
+        """Return the StoredMessage with this id, or None"""
+        segment = self.segments[max(0, bisect.bisect_right(self.first_ids, id) - 1)]
+        return segment.read(id)
+
+    def scan(self, start=None):
+        """Iterate over every stored message, oldest first"""
+        for segment in list(self.segments):
+            if start is not None and segment.first_id + segment.count <= start:
+                continue
+            for record in segment.records():
+                if start is None or record.id >= start:
+                    yield record
+
+    def query(self, **filters):
+        """Ids of the messages matching the filters, see Indexes.query"""
+        if self.indexes is None:
+            raise StoreError('Store at {} is not indexed'.format(self.directory))
+        return self.indexes.query(**filters)
+
+    def rebuild_indexes(self):
+        with self.lock:
+            self.sync()
+            self.indexes.rebuild(self)
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                self.active.sync()
+            if self.indexes is not None:
+                self.indexes.flush()
+            self.unsynced = 0
+            self.synced = time.time()
+
+    def flush(self):
+        """Sync the messages left unsynced once no other message comes"""
+        while not self.stopped.wait(self.sync_interval):
+            if self.unsynced and time.time() - self.synced >= self.sync_interval:
+                self.sync()
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        with self.lock:
+            self.sync()
+            for segment in self.segments:
+                segment.close()
+            if self.indexes is not None:
+                self.indexes.close()
+            self.lockfile.close()
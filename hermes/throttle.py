@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Avalanche protection
+
+Messages are checked by a throttle before the hooks run. Each sender and
+each recipient has a token bucket refilled at rate messages per second up
+to burst, and an accepted message takes a token from the bucket of its
+sender and of every recipient. A message repeating the content of one
+accepted less than window seconds ago is a duplicate. Throttled and
+duplicate messages are refused with a 451 reply, so their sender tries
+again later.
+
+Checking a message takes its tokens and reserves its content at once,
+so concurrent copies of a message cannot all pass before any of them is
+recorded. Should the message be refused later, by a hook or a full relay
+queue, they are released, so it is not taken for a duplicate when its
+sender tries it again.
+
+The content of a message is its envelope, Subject and body, leaving out
+the other headers, whose Date and Message-ID change between otherwise
+identical messages sent by a loop.
+
+Buckets and recent contents are kept in tables of at most size entries,
+dropping the least recently used one when full, so every check is O(1)
+and a flood of distinct senders or messages cannot exhaust memory.
+
+    throttle = Throttle(sender_rate=1, sender_burst=20, window=300)
+    reply, ticket = throttle.check(sender, recipients, message)  # reply is None or a 451
+    throttle.release(ticket)  # once refused for another reason
+"""
+
+import time
+import hashlib
+import threading
+import collections
+
+from .message import Message, HEADERS_END
+
+SENDER_REPLY = '451 Too many messages from {}, try again later'
+RECIPIENT_REPLY = '451 Too many messages for {}, try again later'
+DUPLICATE_REPLY = '451 Duplicate message, try again later'
+
+
+class Buckets(object):
+    """Token buckets by key, the least recently used dropped beyond size"""
+
+    def __init__(self, rate, burst, size):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.table = collections.OrderedDict()  # key -> (tokens, updated)
+
+    def tokens(self, key, now):
+        tokens, updated = self.table.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def take(self, key, now, tokens):
+        self.table[key] = (tokens - 1, now)
+        self.table.move_to_end(key)
+        if len(self.table) > self.size:
+            self.table.popitem(last=False)
+
+    def give_back(self, key, now):
+        if key in self.table:  # a dropped bucket is full again anyway
+            self.table[key] = (min(self.burst, self.tokens(key, now) + 1), now)
+
+
+class Recent(object):
+    """Keys seen less than window seconds ago, at most size of them"""
+
+    def __init__(self, window, size):
+        self.window = window
+        self.size = size
+        self.table = collections.OrderedDict()  # key -> last seen, oldest first
+
+    def seen(self, key, now):
+        self.expire(now)
+        return key in self.table
+
+    def add(self, key, now):
+        self.table[key] = now
+        self.table.move_to_end(key)
+        if len(self.table) > self.size:
+            self.table.popitem(last=False)
+
+    def discard(self, key):
+        self.table.pop(key, None)
+
+    def expire(self, now):
+        while self.table:
+            key, seen = next(iter(self.table.items()))
+            if now - seen < self.window:
+                break
+            del self.table[key]
+
+
+def content_hash(sender, recipients, message):
+    if not isinstance(message, Message):
+        message = Message.from_bytes(message.encode('utf-8') if isinstance(message, str) else message)
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(u'{}\n{}\n{}\n'.format(sender, u','.join(sorted(recipients)), message.subject or u'')
+                  .encode('utf-8', 'replace'))
+    body = message.getbuffer()
+    end = HEADERS_END.search(body[:2 ** 16])
+    digest.update(body[end.end():] if end is not None else body)
+    return digest.digest()
+
+
+class Throttle(object):
+    def __init__(self, sender_rate=0, sender_burst=10, recipient_rate=0, recipient_burst=10,
+                 window=0, size=10000):
+        self.senders = Buckets(sender_rate, sender_burst, size) if sender_rate else None
+        self.recipients = Buckets(recipient_rate, recipient_burst, size) if recipient_rate else None
+        self.recent = Recent(window, size) if window else None
+        self.lock = threading.Lock()
+
+    def check(self, sender, recipients, message):
+        """(None, ticket) when a message may go on, its tokens taken and its
+        content reserved, or (reply refusing it, None)"""
+        key = content_hash(sender, recipients, message) if self.recent is not None else None
+        sender_key = sender.lower()
+        recipients = set(recipient.lower() for recipient in recipients)
+        now = time.time()
+
+        with self.lock:
+            if key is not None and self.recent.seen(key, now):
+                return DUPLICATE_REPLY, None
+            if self.senders is not None:
+                sender_tokens = self.senders.tokens(sender_key, now)
+                if sender_tokens < 1:
+                    return SENDER_REPLY.format(sender), None
+            if self.recipients is not None:
+                recipient_tokens = dict((recipient, self.recipients.tokens(recipient, now))
+                                        for recipient in recipients)
+                for recipient, tokens in recipient_tokens.items():
+                    if tokens < 1:
+                        return RECIPIENT_REPLY.format(recipient), None
+
+            if self.senders is not None:
+                self.senders.take(sender_key, now, sender_tokens)
+            if self.recipients is not None:
+                for recipient, tokens in recipient_tokens.items():
+                    self.recipients.take(recipient, now, tokens)
+            if key is not None:
+                self.recent.add(key, now)
+        return None, (sender_key, recipients, key)
+
+    def release(self, ticket):
+        """Give back the tokens and content of a message refused after its check"""
+        sender, recipients, key = ticket
+        now = time.time()
+
+        with self.lock:
+            if self.senders is not None:
+                self.senders.give_back(sender, now)
+            if self.recipients is not None:
+                for recipient in recipients:
+                    self.recipients.give_back(recipient, now)
+            if key is not None:
+                self.recent.discard(key)
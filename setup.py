@@ -14,13 +14,14 @@ setup(
     version='0.1.1',
     packages=find_packages(),
     install_requires=requires,
+    # entry_points(group=...) needs 3.10, smtpd is gone from 3.12
+    python_requires='>=3.10,<3.12',
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Intended Audience :: Developers',
         'Environment :: Console',
     ],
@@ -31,7 +32,10 @@ setup(
         ],
 
         'hermes.extensions.processors': [
-            'printer = hermes.extensions.printer:Printer'
+            'printer = hermes.extensions.printer:Printer',
+            'mailbox = hermes.extensions.mailbox:Mailbox',
+            'capture = hermes.extensions.capture:Capture',
+            'ring = hermes.extensions.ring:RingMailbox'
         ]
     },
 
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import smtplib
+import tempfile
+import threading
+
+from doublex import Spy, called
+from hamcrest import assert_that, anything, is_, contains_string, has_entries
+
+from hermes.aiosmtp import AsyncServer
+
+
+SENDER = 'sender@hermes.test'
+RECIPIENTS = ['one@hermes.test', 'two@hermes.test']
+MESSAGE = 'Subject: test\r\n\r\nHello\r\n.dotted line\r\n'
+
+
+def serve(hooks, **attributes):
+    server = AsyncServer.create(('127.0.0.1', 0), hooks)
+    vars(server).update(attributes)
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    return server, thread
+
+
+def shutdown(server, thread):
+    server.stop()
+    thread.join()
+
+
+class TestAsyncServerSession(object):
+    def test_delivers_message_to_hooks(self):
+        with Spy() as spy:
+            pass
+        server, thread = serve([spy.hook])
+
+        try:
+            client = smtplib.SMTP(*server.socket.getsockname())
+            client.sendmail(SENDER, RECIPIENTS, MESSAGE)
+            client.quit()
+        finally:
+            shutdown(server, thread)
+
+        assert_that(spy.hook, called().with_args(
+            anything(), SENDER, RECIPIENTS, b'Subject: test\n\nHello\n.dotted line'))
+
+    def test_serves_concurrent_sessions(self):
+        server, thread = serve([])
+
+        try:
+            clients = [smtplib.SMTP(*server.socket.getsockname()) for _ in range(20)]
+            for client in clients:
+                client.ehlo()
+            replies = [client.noop() for client in clients]
+            for client in clients:
+                client.quit()
+        finally:
+            shutdown(server, thread)
+
+        assert_that(replies, is_([(250, b'OK')] * 20))
+
+    def test_rejects_data_before_recipients(self):
+        server, thread = serve([])
+
+        try:
+            client = smtplib.SMTP(*server.socket.getsockname())
+            client.ehlo()
+            client.mail(SENDER)
+            code, reply = client.docmd('DATA')
+            client.quit()
+        finally:
+            shutdown(server, thread)
+
+        assert_that(code, is_(503))
+        assert_that(reply.decode(), contains_string('need RCPT command'))
+
+
+    def test_keeps_bare_carriage_returns_in_data(self):
+        with Spy() as spy:
+            pass
+        server, thread = serve([spy.hook])
+
+        try:
+            client = smtplib.SMTP(*server.socket.getsockname())
+            client.sendmail(SENDER, RECIPIENTS, b'Subject: test\r\n\r\nends with\r\r\n')
+            client.quit()
+        finally:
+            shutdown(server, thread)
+
+        assert_that(spy.hook, called().with_args(
+            anything(), SENDER, RECIPIENTS, b'Subject: test\n\nends with\r'))
+
+    def test_refuses_data_lines_over_the_stream_limit(self):
+        with Spy() as spy:
+            pass
+        server, thread = serve([spy.hook], stream_limit=256)
+
+        try:
+            client = smtplib.SMTP(*server.socket.getsockname())
+            client.ehlo()
+            client.mail(SENDER)
+            client.rcpt(RECIPIENTS[0])
+            refused = client.data(b'Subject: test\r\n\r\n' + b'x' * 1024 + b'\r\nend\r\n')
+            accepted = client.sendmail(SENDER, RECIPIENTS, MESSAGE)
+            client.quit()
+        finally:
+            shutdown(server, thread)
+
+        assert_that(refused, is_((500, b'Error: line too long')))
+        assert_that(accepted, is_({}))
+        assert_that(spy.hook, called().times(1))
+
+
+class TestAsyncServerTimeout(object):
+    def test_closes_idle_sessions(self):
+        server, thread = serve([])
+        server.timeout = 0.1
+
+        try:
+            client = smtplib.SMTP(*server.socket.getsockname())
+            client.ehlo()
+            client.sock.settimeout(5)
+            reply = client.getreply()
+        finally:
+            client.close()
+            shutdown(server, thread)
+
+        assert_that(reply, is_((421, b'Error: timeout exceeded')))
+
+
+class TestAsyncServerShutdown(object):
+    def setup_method(self):
+        self.report_file = os.path.join(tempfile.mkdtemp(), 'hermes.{pid}.shutdown')
+
+    def report(self):
+        with open(self.report_file.format(pid=os.getpid())) as stream:
+            return json.load(stream)
+
+    def test_closes_idle_sessions_and_stops(self):
+        server, thread = serve([])
+        server.shutdown_file = self.report_file
+
+        client = smtplib.SMTP(*server.socket.getsockname())
+        client.ehlo()
+        server.shutdown(5)
+        client.sock.settimeout(5)
+        reply = client.getreply()
+        thread.join(5)
+        client.close()
+
+        assert_that(reply[0], is_(421))
+        assert_that(thread.is_alive(), is_(False))
+        assert_that(self.report(), has_entries(sessions_closed=1, sessions_abandoned=0))
+
+    def test_lets_open_transactions_finish(self):
+        with Spy() as spy:
+            pass
+        server, thread = serve([spy.hook])
+        server.shutdown_file = self.report_file
+
+        client = smtplib.SMTP(*server.socket.getsockname())
+        client.ehlo()
+        client.mail(SENDER)
+        server.shutdown(5)
+        client.rcpt(RECIPIENTS[0])
+        code, _ = client.data(MESSAGE)
+        thread.join(5)
+        client.close()
+
+        assert_that(code, is_(250))
+        assert_that(spy.hook, called())
+        assert_that(self.report(), has_entries(sessions_finished=1, sessions_abandoned=0))
+
+    def test_abandons_sessions_past_the_deadline(self):
+        server, thread = serve([])
+        server.shutdown_file = self.report_file
+
+        client = smtplib.SMTP(*server.socket.getsockname())
+        client.ehlo()
+        client.mail(SENDER)
+        server.shutdown(0.2)
+        thread.join(5)
+        client.close()
+
+        assert_that(thread.is_alive(), is_(False))
+        assert_that(self.report(), has_entries(sessions_finished=0, sessions_abandoned=1))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import shutil
+import smtplib
+import tempfile
+import threading
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+from hamcrest import assert_that, is_, has_entries, contains_exactly
+
+from hermes.api import Api
+from hermes.aiosmtp import AsyncServer
+from hermes.extensions.mailbox import Mailbox
+
+SENDER = 'sender@hermes.test'
+RECIPIENT = 'one@hermes.test'
+MESSAGE = 'Subject: {}\r\n\r\nHello'
+
+
+def serve():
+    mailbox = Mailbox()
+    mailbox.configure({'directory': tempfile.mkdtemp(prefix='hermes-api-')})
+    server = AsyncServer.create(('127.0.0.1', 0), [mailbox])
+    api = Api(('127.0.0.1', 0), mailbox)
+    server.add_service(api)
+
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    while api.server is None:
+        time.sleep(0.01)
+    return server, api, thread
+
+
+def shutdown(server, api, thread):
+    server.stop()
+    thread.join()
+    api.mailbox.close()
+    shutil.rmtree(api.mailbox.directory)
+
+
+def send(server, subject, recipient=RECIPIENT):
+    client = smtplib.SMTP(*server.socket.getsockname())
+    client.sendmail(SENDER, [recipient], MESSAGE.format(subject))
+    client.quit()
+
+
+def get(api, path):
+    url = 'http://{}:{}{}'.format(*(api.server.sockets[0].getsockname() + (path,)))
+    return urlopen(url, timeout=10).read()
+
+
+class TestApi(object):
+    def test_lists_messages_newest_first_by_pages(self):
+        server, api, thread = serve()
+        try:
+            for subject in ('first', 'second', 'third'):
+                send(server, subject)
+            send(server, 'other', recipient='two@hermes.test')
+
+            page = json.loads(get(api, '/messages?recipient={}&limit=2'.format(RECIPIENT)))
+            last = json.loads(get(api, '/messages?recipient={}&limit=2&after={}'
+                                  .format(RECIPIENT, page['next'])))
+        finally:
+            shutdown(server, api, thread)
+
+        assert_that([message['id'] for message in page['messages']], is_([3, 2]))
+        assert_that(last, has_entries(next=None, messages=contains_exactly(
+            has_entries(id=1, sender=SENDER, recipients=[RECIPIENT]))))
+
+    def test_streams_raw_messages(self):
+        server, api, thread = serve()
+        try:
+            send(server, 'raw')
+            raw = get(api, '/messages/1/raw')
+        finally:
+            shutdown(server, api, thread)
+
+        assert_that(raw, is_(b'Subject: raw\n\nHello'))
+
+    def test_wait_replies_once_a_matching_message_arrives(self):
+        server, api, thread = serve()
+        replies = []
+        try:
+            waiting = threading.Thread(target=lambda: replies.append(
+                get(api, '/wait?recipient={}&subject=welcome&timeout=10'.format(RECIPIENT))))
+            waiting.start()
+            while not api.waiters:
+                time.sleep(0.01)
+            send(server, 'unrelated')
+            send(server, 'Welcome')
+            waiting.join()
+        finally:
+            shutdown(server, api, thread)
+
+        assert_that(json.loads(replies[0]), has_entries(id=2))
+
+    def test_unknown_messages_are_not_found(self):
+        server, api, thread = serve()
+        try:
+            get(api, '/messages/10')
+        except HTTPError as error:
+            status = error.code
+        finally:
+            shutdown(server, api, thread)
+
+        assert_that(status, is_(404))
+
+
+class TestMetricsApi(object):
+    def test_reports_stage_summaries(self):
+        server, api, thread = serve()
+        api.metrics = server.metrics
+        try:
+            send(server, 'measured')
+            metrics = json.loads(get(api, '/metrics'))
+        finally:
+            shutdown(server, api, thread)
+
+        assert_that(metrics['counters'], has_entries(messages=1, sessions=1))
+        assert_that(metrics['stages'], has_entries(
+            accept=has_entries(count=1), data=has_entries(count=1),
+            process=has_entries(count=1)))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+
+from doublex import ANY_ARG, Spy, called
+from hamcrest import assert_that, is_, has_length, has_properties, greater_than_or_equal_to
+import pytest
+
+from hermes.capture import CaptureWriter, CaptureError, read_capture
+from hermes.extensions.capture import Capture
+from hermes.message import Message
+from hermes.replay import Replay
+from hermes.smtp import Sender
+
+SENDER = 'sender@hermes.test'
+RECIPIENTS = ['one@hermes.test', 'two@hermes.test']
+BODY = b'Subject: test\n\nHello'
+
+
+class TestCapture(object):
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp(prefix='hermes-capture-')
+        self.path = os.path.join(self.directory, 'traffic.hcap')
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_back_captured_messages(self):
+        writer = CaptureWriter(self.path)
+        writer.append(10.5, SENDER, RECIPIENTS, Message.from_bytes(BODY))
+        writer.append(11.0, SENDER, RECIPIENTS[:1], 'second')
+        writer.close()
+
+        captured = list(read_capture(self.path))
+
+        assert_that(captured[0], has_properties(timestamp=10.5, sender=SENDER,
+                                                recipients=RECIPIENTS, body=BODY))
+        assert_that(captured[1], has_properties(recipients=RECIPIENTS[:1], body=b'second'))
+
+    def test_writers_append_to_the_same_capture(self):
+        for _ in range(2):
+            writer = CaptureWriter(self.path)
+            writer.append(10.5, SENDER, RECIPIENTS, BODY)
+            writer.close()
+
+        assert_that(list(read_capture(self.path)), has_length(2))
+
+    def test_skips_incomplete_last_record(self):
+        writer = CaptureWriter(self.path)
+        writer.append(10.5, SENDER, RECIPIENTS, BODY)
+        writer.append(11.0, SENDER, RECIPIENTS, BODY)
+        writer.close()
+        with open(self.path, 'r+b') as stream:
+            stream.truncate(os.path.getsize(self.path) - 3)
+
+        assert_that(list(read_capture(self.path)), has_length(1))
+
+    def test_refuses_other_files(self):
+        with open(self.path, 'wb') as stream:
+            stream.write(BODY)
+
+        with pytest.raises(CaptureError):
+            list(read_capture(self.path))
+
+    def test_extension_captures_every_message(self):
+        capture = Capture()
+        capture.configure(dict(path=self.path))
+
+        capture(None, SENDER, RECIPIENTS, Message.from_bytes(BODY))
+        capture.close()
+
+        assert_that([captured.body for captured in read_capture(self.path)], is_([BODY]))
+
+
+class TestReplay(object):
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp(prefix='hermes-replay-')
+        self.path = os.path.join(self.directory, 'traffic.hcap')
+        writer = CaptureWriter(self.path)
+        for timestamp in (100.0, 100.1, 100.2):
+            writer.append(timestamp, SENDER, RECIPIENTS, BODY)
+        writer.close()
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self, speed):
+        replay = Replay(self.path, ('127.0.0.1', 8888), speed=speed, connections=2)
+        with Spy(Sender) as replay.sender:
+            replay.sender.send(ANY_ARG).returns(True)
+        return replay
+
+    def test_replays_every_message_at_max_speed(self):
+        replay = self.replay(speed=0)
+
+        report = replay.run()
+
+        assert_that(replay.sender.send, called().times(3))
+        assert_that(report['sent'], is_(3))
+
+    def test_keeps_captured_intervals_divided_by_speed(self):
+        replay = self.replay(speed=2)
+
+        started = time.time()
+        replay.run()
+
+        assert_that(time.time() - started, greater_than_or_equal_to(0.1))
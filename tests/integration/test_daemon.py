@@ -71,8 +71,8 @@ class TestPIDFile(object):
 
         assert_that(not os.path.exists(PIDFILE))
 
-    def setup(self):
+    def setup_method(self):
         create_pidfile(PIDFILE, PID)
 
-    def teardown(self):
+    def teardown_method(self):
         remove_pidfile(PIDFILE)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+
+from hamcrest import assert_that, is_, has_length, contains_exactly, less_than
+
+from hermes.retry import RetryLog, LOG_NAME, CURSOR_NAME, encode_cursor
+
+SENDER = 'sender@hermes.test'
+RECIPIENTS = ['one@hermes.test', 'two@hermes.test']
+BODY = b'Subject: test\n\nHello'
+
+
+class Relay(object):
+    """Relay server answering every message with outcome"""
+
+    def __init__(self, outcome):
+        self.outcome = outcome
+        self.batches = []
+
+    def __call__(self, messages):
+        self.batches.append(messages)
+        return [self.outcome] * len(messages)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class TestRetryLog(object):
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp(prefix='hermes-retry-')
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def test_relays_deferred_messages_again_in_batches(self):
+        relay = Relay(True)
+        retry = RetryLog(self.directory, delay=0, batch_size=10)
+        retry.open(relay)
+
+        retry.defer([(SENDER, RECIPIENTS, BODY)] * 3)
+        wait_for(lambda: not len(retry))
+        retry.close()
+
+        assert_that(relay.batches, contains_exactly([(SENDER, RECIPIENTS, BODY)] * 3))
+
+    def test_reads_pending_messages_back_on_open(self):
+        retry = RetryLog(self.directory, delay=60)
+        retry.open(Relay(None))
+        retry.defer([(SENDER, RECIPIENTS, BODY), (SENDER, RECIPIENTS[:1], b'second')])
+        retry.close()
+
+        reopened = RetryLog(self.directory, delay=60)
+        reopened.open(Relay(None))
+
+        assert_that(reopened, has_length(2))
+        assert_that([reopened.read(entry) for entry in reopened.pending.values()],
+                    is_([(SENDER, RECIPIENTS, BODY), (SENDER, RECIPIENTS[:1], b'second')]))
+        reopened.close()
+
+    def test_drops_messages_after_max_attempts(self):
+        relay = Relay(None)
+        retry = RetryLog(self.directory, delay=0.01, max_delay=0.01, max_attempts=3)
+        retry.open(relay)
+
+        retry.defer([(SENDER, RECIPIENTS, BODY)])
+        wait_for(lambda: not len(retry))
+        retry.close()
+
+        assert_that(relay.batches, has_length(2))
+
+    def test_drops_refused_messages(self):
+        retry = RetryLog(self.directory, delay=0.01)
+        retry.open(Relay(False))
+
+        retry.defer([(SENDER, RECIPIENTS, BODY)])
+        wait_for(lambda: not len(retry))
+        retry.close()
+
+        assert_that(retry, has_length(0))
+
+    def test_skips_records_before_the_cursor_on_open(self):
+        retry = RetryLog(self.directory, delay=0.01)
+        retry.open(Relay(True))
+        retry.defer([(SENDER, RECIPIENTS, BODY)])
+        wait_for(lambda: not len(retry))
+        retry.close()
+
+        reopened = RetryLog(self.directory)
+        reopened.open(Relay(True))
+
+        assert_that(reopened.cursor, is_(reopened.size))
+        assert_that(reopened.next_id, is_(2))
+        reopened.close()
+
+    def test_drops_torn_record_on_open(self):
+        retry = RetryLog(self.directory, delay=60)
+        retry.open(Relay(None))
+        retry.defer([(SENDER, RECIPIENTS, BODY)] * 2)
+        retry.close()
+        with open(os.path.join(retry.path, LOG_NAME), 'r+b') as stream:
+            stream.truncate(os.path.getsize(stream.name) - 3)
+
+        reopened = RetryLog(self.directory, delay=60)
+        reopened.open(Relay(None))
+
+        assert_that(reopened, has_length(1))
+        reopened.close()
+
+    def test_compaction_keeps_pending_messages(self):
+        retry = RetryLog(self.directory, delay=60, compact_size=1)
+        retry.open(Relay(None))
+        retry.defer([(SENDER, RECIPIENTS, b'relayed'), (SENDER, RECIPIENTS, b'pending')])
+        first = next(iter(retry.pending.values()))
+        retry.attempt([first], [(SENDER, RECIPIENTS, b'relayed')])  # still failing
+        retry.deliver = Relay(True)
+        retry.attempt([first], [(SENDER, RECIPIENTS, b'relayed')])
+        retry.close()
+
+        reopened = RetryLog(self.directory, delay=60)
+        reopened.open(Relay(None))
+
+        assert_that([reopened.read(entry)[2] for entry in reopened.pending.values()],
+                    is_([b'pending']))
+        assert_that(reopened.cursor, is_(0))
+        reopened.close()
+
+    def test_compacts_log_mostly_done_with_behind_old_pending_message(self):
+        retry = RetryLog(self.directory, delay=60, compact_size=1024)
+        retry.open(Relay(None))
+        retry.defer([(SENDER, RECIPIENTS, b'pending')])
+        retry.deliver = Relay(True)
+        for index in range(20):
+            retry.defer([(SENDER, RECIPIENTS, BODY)])
+            retry.attempt([retry.pending[index + 2]], [(SENDER, RECIPIENTS, BODY)])
+
+        assert_that(retry.size, less_than(1024))
+        assert_that([retry.read(entry)[2] for entry in retry.pending.values()], is_([b'pending']))
+        retry.close()
+
+    def test_reads_whole_log_when_cursor_is_stale(self):
+        retry = RetryLog(self.directory, delay=60)
+        retry.open(Relay(None))
+        retry.defer([(SENDER, RECIPIENTS, b'first'), (SENDER, RECIPIENTS, b'second')])
+        retry.close()
+        with open(os.path.join(retry.path, CURSOR_NAME), 'r+b') as stream:
+            stream.write(encode_cursor(5, 3))  # into the first record, as of an older log
+
+        reopened = RetryLog(self.directory, delay=60)
+        reopened.open(Relay(None))
+
+        assert_that(reopened, has_length(2))
+        assert_that(reopened.cursor, is_(0))
+        reopened.close()
+
+    def test_compressed_messages_survive_compaction(self):
+        retry = RetryLog(self.directory, delay=60, compact_size=1, compress=True)
+        retry.open(Relay(None))
+        retry.defer([(SENDER, RECIPIENTS, b'relayed'), (SENDER, RECIPIENTS, BODY * 10)])
+        first = next(iter(retry.pending.values()))
+        retry.deliver = Relay(True)
+        retry.attempt([first], [(SENDER, RECIPIENTS, b'relayed')])
+        retry.close()
+
+        reopened = RetryLog(self.directory, delay=60)
+        reopened.open(Relay(None))
+
+        assert_that([reopened.read(entry) for entry in reopened.pending.values()],
+                    is_([(SENDER, RECIPIENTS, BODY * 10)]))
+        reopened.close()
+
+    def test_workers_claim_a_log_each(self):
+        first, second = RetryLog(self.directory), RetryLog(self.directory)
+        first.open(Relay(True))
+        second.open(Relay(True))
+
+        assert_that(first.path, is_(os.path.join(self.directory, '0')))
+        assert_that(second.path, is_(os.path.join(self.directory, '1')))
+        first.close()
+        second.close()
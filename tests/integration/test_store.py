@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+
+from hamcrest import assert_that, is_, none, has_length, has_properties, less_than
+import pytest
+
+from hermes.message import Message
+from hermes.store import Store, StoreError, SEGMENT_SUFFIX, COMPRESSED_SUFFIX
+from hermes.extensions.mailbox import Mailbox
+
+SENDER = 'sender@hermes.test'
+RECIPIENTS = ['one@hermes.test', 'two@hermes.test']
+BODY = b'Subject: test\n\nHello'
+
+
+def store_directory():
+    return tempfile.mkdtemp(prefix='hermes-store-')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def segments(directory, suffix=SEGMENT_SUFFIX):
+    return sorted(name for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def templated(index):
+    return (u'Subject: Your order {0}\nContent-Type: text/html\n\n<html><body>\n'
+            u'<p>Thank you for your order {0}, it will be shipped within two working days.</p>\n'
+            u'<p>Track it at https://shop.example.com/orders/{0}</p>\n'
+            u'<p class="footer">You receive this email because you subscribed at shop.example.com.'
+            u' Unsubscribe at https://shop.example.com/unsubscribe?id={0}</p>\n'
+            u'</body></html>\n'.format(index)).encode('utf-8')
+
+
+class TestStore(object):
+    def test_get_returns_appended_message(self):
+        directory = store_directory()
+        store = Store(directory)
+
+        id = store.append(SENDER, RECIPIENTS, BODY, timestamp=10.5)
+        message = store.get(id)
+
+        assert_that(message, has_properties(id=1, timestamp=10.5, sender=SENDER,
+                                            recipients=RECIPIENTS))
+        assert_that(bytes(message.body), is_(BODY))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_get_returns_none_for_unknown_ids(self):
+        directory = store_directory()
+        store = Store(directory)
+        store.append(SENDER, RECIPIENTS, BODY)
+
+        assert_that(store.get(2), is_(none()))
+        assert_that(store.get(0), is_(none()))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_messages_survive_reopening_the_store(self):
+        directory = store_directory()
+        store = Store(directory)
+        for _ in range(3):
+            store.append(SENDER, RECIPIENTS, BODY)
+        store.close()
+
+        store = Store(directory)
+        id = store.append(SENDER, RECIPIENTS, b'last')
+
+        assert_that(id, is_(4))
+        assert_that(bytes(store.get(2).body), is_(BODY))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_rotates_segments_by_size(self):
+        directory = store_directory()
+        store = Store(directory, segment_size=1)
+
+        ids = [store.append(SENDER, RECIPIENTS, BODY) for _ in range(3)]
+
+        assert_that(segments(directory), has_length(3))
+        assert_that([bytes(store.get(id).body) for id in ids], is_([BODY] * 3))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_rotates_segments_by_age(self):
+        directory = store_directory()
+        store = Store(directory, segment_age=60)
+
+        store.append(SENDER, RECIPIENTS, BODY, timestamp=0)
+        store.append(SENDER, RECIPIENTS, BODY, timestamp=30)
+        store.append(SENDER, RECIPIENTS, BODY, timestamp=61)
+
+        assert_that(segments(directory), has_length(2))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_recovers_records_missing_from_index_and_drops_torn_ones(self):
+        directory = store_directory()
+        store = Store(directory)
+        store.append(SENDER, RECIPIENTS, BODY)
+        store.append(SENDER, RECIPIENTS, BODY)
+        segment = store.active
+        store.close()
+        with open(segment.index_path, 'r+b') as index:
+            index.truncate(0)
+        with open(segment.path, 'ab') as data:
+            data.write(b'\x00\x00\x10\x00torn')
+
+        store = Store(directory)
+
+        assert_that(len(store), is_(2))
+        assert_that(store.append(SENDER, RECIPIENTS, BODY), is_(3))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_stores_spooled_messages(self):
+        directory = store_directory()
+        store = Store(directory)
+        message = Message(spool_threshold=4)
+        message.write(BODY)
+
+        id = store.append(SENDER, RECIPIENTS, message.finish())
+
+        assert_that(bytes(store.get(id).body), is_(BODY))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_refuses_to_open_a_store_in_use(self):
+        directory = store_directory()
+        store = Store(directory)
+
+        with pytest.raises(StoreError):
+            Store(directory)
+        store.close()
+        shutil.rmtree(directory)
+
+
+class TestCompressedStore(object):
+    def test_get_returns_compressed_messages(self):
+        directory = store_directory()
+        store = Store(directory, compress=True)
+
+        ids = [store.append(SENDER, RECIPIENTS, templated(index)) for index in range(100)]
+
+        assert_that(segments(directory, COMPRESSED_SUFFIX), has_length(1))
+        assert_that(store.get(ids[42]).body, is_(templated(42)))
+        assert_that(store.get(ids[0]).recipients, is_(RECIPIENTS))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_size_of_compressed_messages_is_known_without_decompressing(self):
+        directory = store_directory()
+        store = Store(directory, compress=True)
+        id = store.append(SENDER, RECIPIENTS, templated(7))
+        message = store.get(id)
+
+        assert_that(message.size, is_(len(templated(7))))
+        assert_that(message.decoded, is_(none()))
+        assert_that(message.body, is_(templated(7)))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_trained_dictionary_shrinks_segments(self):
+        directory, plain_directory = store_directory(), store_directory()
+        store, plain = Store(directory, compress=True), Store(plain_directory)
+        for index in range(200):
+            store.append(SENDER, RECIPIENTS, templated(index))
+        store.rotate()
+
+        ids = [store.append(SENDER, RECIPIENTS, templated(index)) for index in range(200, 300)]
+        for index in range(200, 300):
+            plain.append(SENDER, RECIPIENTS, templated(index))
+
+        assert_that(store.active.size * 3, less_than(plain.active.size))
+        assert_that(store.get(ids[-1]).body, is_(templated(299)))
+        store.close()
+        plain.close()
+        shutil.rmtree(directory)
+        shutil.rmtree(plain_directory)
+
+    def test_reads_segments_written_before_compression(self):
+        directory = store_directory()
+        store = Store(directory)
+        store.append(SENDER, RECIPIENTS, BODY)
+        store.close()
+
+        store = Store(directory, compress=True, segment_size=1)
+        id = store.append(SENDER, RECIPIENTS, BODY)
+        store.append(SENDER, RECIPIENTS, BODY)
+
+        assert_that(bytes(store.get(1).body), is_(BODY))
+        assert_that(store.get(id + 1).body, is_(BODY))
+        assert_that(segments(directory, COMPRESSED_SUFFIX), has_length(2))
+        store.close()
+        shutil.rmtree(directory)
+
+
+class TestStoreSync(object):
+    def setup_method(self):
+        self.directory = store_directory()
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def test_syncs_last_messages_when_no_other_comes(self):
+        store = Store(self.directory, sync_interval=0.05, sync_batch=100)
+        store.append(SENDER, RECIPIENTS, BODY)
+
+        wait_for(lambda: not store.unsynced)
+
+        assert_that(store.unsynced, is_(0))
+        store.close()
+
+    def test_close_stops_syncing(self):
+        store = Store(self.directory, sync_interval=0.05)
+        store.close()
+
+        assert_that(store.flusher.is_alive(), is_(False))
+
+
+class TestMailbox(object):
+    def test_stores_received_messages(self):
+        directory = store_directory()
+        mailbox = Mailbox()
+        mailbox.configure({'directory': directory})
+
+        mailbox(('127.0.0.1', 1000), SENDER, RECIPIENTS, BODY)
+
+        assert_that(bytes(mailbox.store.get(1).body), is_(BODY))
+        mailbox.close()
+        shutil.rmtree(directory)
+
+
+class TestStoreIndexes(object):
+    def test_query_finds_stored_messages(self):
+        directory = store_directory()
+        store = Store(directory)
+        store.append(SENDER, RECIPIENTS, BODY)
+        store.append(SENDER, ['other@hermes.test'], BODY)
+
+        assert_that(store.query(recipient='two@hermes.test'), is_([1]))
+        store.close()
+        shutil.rmtree(directory)
+
+    def test_indexes_are_rebuilt_from_segments_when_log_is_lost(self):
+        directory = store_directory()
+        store = Store(directory)
+        store.append(SENDER, RECIPIENTS, BODY)
+        store.append('other@hermes.test', RECIPIENTS, BODY)
+        store.close()
+        os.remove(os.path.join(directory, 'indexes.log'))
+
+        store = Store(directory)
+
+        assert_that(store.query(sender='other@hermes.test'), is_([2]))
+        assert_that(store.query(subject='test'), is_([1, 2]))
+        store.close()
+        shutil.rmtree(directory)
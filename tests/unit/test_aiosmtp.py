@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from doublex import Spy, called
+from hamcrest import assert_that, has_property, has_item, is_, none
+
+from hermes.aiosmtp import AsyncServer, Session, parse_address
+
+
+LOCALHOST = '127.0.0.1'
+ADDRESS = (LOCALHOST, 0)
+
+
+class TestAsyncServer(object):
+    def test_create_initializes_hooks(self):
+        hook = lambda: None
+
+        server = AsyncServer.create(ADDRESS, hooks=[hook])
+        server.close()
+
+        assert_that(server, has_property('hooks', has_item(hook)))
+
+    def test_create_without_proxy_has_no_sender(self):
+        server = AsyncServer.create(ADDRESS, hooks=[])
+        server.close()
+
+        assert_that(server, has_property('sender', none()))
+
+    def test_process_message_calls_hook(self):
+        with Spy() as spy:
+            server = AsyncServer.create(ADDRESS, hooks=[spy.hook])
+            server.close()
+
+        server.process_message(*[1, 2, 3, 4])
+
+        assert_that(spy.hook, is_(called().with_args(1, 2, 3, 4)))
+
+
+class Writer(object):
+    """Stream writer keeping every write"""
+
+    def __init__(self):
+        self.writes = []
+
+    def get_extra_info(self, name):
+        return None
+
+    def write(self, data):
+        self.writes.append(data)
+
+    async def drain(self):
+        pass
+
+
+class TestSessionReplies(object):
+    def test_replies_are_written_together_on_flush(self):
+        writer = Writer()
+        server = AsyncServer.create(ADDRESS, hooks=[])
+        server.close()
+        session = Session(server, None, writer)
+
+        session.push('250-hermes')
+        session.push('250 PIPELINING')
+        asyncio.run(session.flush())
+
+        assert_that(writer.writes, is_([b'250-hermes\r\n250 PIPELINING\r\n']))
+
+
+class TestParseAddress(object):
+    def test_parses_address_between_brackets(self):
+        assert_that(parse_address('FROM:', 'FROM:<a@b.c>'), is_(('a@b.c', [])))
+
+    def test_parses_address_options(self):
+        assert_that(parse_address('FROM:', 'from: <a@b.c> SIZE=10'),
+                    is_(('a@b.c', ['SIZE=10'])))
+
+    def test_accepts_null_sender(self):
+        assert_that(parse_address('FROM:', 'FROM:<>'), is_(('', [])))
+
+    def test_returns_none_on_wrong_keyword(self):
+        assert_that(parse_address('TO:', 'FROM:<a@b.c>'), is_((None, [])))
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from nose.tools import assert_raises
+import pytest
 
 from hermes.daemon import Daemon
 
@@ -57,13 +57,13 @@ class TestDaemon(object):
     def test_daemon_does_not_implements_run_method(self):
         daemon = Daemon(*DAEMON_ARGS)
 
-        with assert_raises(NotImplementedError):
+        with pytest.raises(NotImplementedError):
             daemon.run()
 
     def test_daemon_does_not_implements_initialize_method(self):
         daemon = Daemon(*DAEMON_ARGS)
 
-        with assert_raises(NotImplementedError):
+        with pytest.raises(NotImplementedError):
             daemon.initialize()
 
     def test_daemon_status_returns_running_if_pid(self):
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from hamcrest import assert_that, is_, contains_string, empty
+
+from hermes.cli import MailDaemon
+from hermes.daemons import Supervisor, read_pids, signal_pids
+
+
+def pidsfile(pids):
+    descriptor, path = tempfile.mkstemp(suffix='.workers')
+    with os.fdopen(descriptor, 'w') as stream:
+        stream.write(''.join('{}\n'.format(pid) for pid in pids))
+    return path
+
+
+class TestPids(object):
+    def test_read_pids_returns_one_pid_per_line(self):
+        path = pidsfile([10, 20])
+
+        assert_that(read_pids(path), is_([10, 20]))
+        os.remove(path)
+
+    def test_read_pids_returns_nothing_when_file_is_missing(self):
+        assert_that(read_pids('/nonexistent/hermes.workers'), is_(empty()))
+
+    def test_signal_pids_returns_only_alive_processes(self):
+        alive = signal_pids([os.getpid(), 2 ** 22 + 1], 0)
+
+        assert_that(alive, is_([os.getpid()]))
+
+
+class TestSupervisor(object):
+    def test_spawned_workers_are_listed_until_they_exit(self):
+        path = pidsfile([])
+        supervisor = Supervisor(lambda: None, workers=1, pidsfile=path)
+
+        pid = supervisor.spawn(0)
+        listed = read_pids(path)
+        supervisor.stopping = True
+        supervisor.supervise()
+
+        assert_that(listed, is_([pid]))
+        assert_that(read_pids(path), is_(empty()))
+        os.remove(path)
+
+    def test_restarts_workers_which_exit_unexpectedly(self):
+        supervisor = Supervisor(lambda: None, workers=1)
+        supervisor.restart_delay = 0
+        spawned = []
+
+        def spawn(slot):
+            spawned.append(slot)
+            if len(spawned) == 2:
+                supervisor.stopping = True
+            return Supervisor.spawn(supervisor, slot)
+
+        supervisor.spawn = spawn
+        supervisor.spawn(0)
+        supervisor.supervise()
+
+        assert_that(spawned, is_([0, 0]))
+
+
+class TestMailDaemon(object):
+    def test_status_reports_worker_pids(self):
+        daemon = MailDaemon('/tmp/hermes-test.pid')
+        daemon.read_pid = lambda: 100
+        path = pidsfile([101, 102])
+        os.rename(path, daemon.workers_pidsfile)
+
+        status = daemon.status()
+        os.remove(daemon.workers_pidsfile)
+
+        assert_that(status, contains_string('running pid: 100 workers: 101, 102'))
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from doublex import Spy, called
+from hamcrest import assert_that, is_, instance_of, has_length
+import pytest
+
+from hermes.hooks import (Executors, ExecutorHook, HookTimeout, RejectMessage,
+                          create_hook, validate_options)
+from hermes.cli import bind_metrics
+from hermes.extensions.base import Extension
+from hermes.metrics import Metrics
+from hermes.smtp import BaseServer
+
+ADDRESS = ('127.0.0.1', 8888)
+ARGS = ['peer', 'email@email.em', ['email@email.em'], 'foo']
+
+
+def slow_hook(*args):
+    time.sleep(0.5)
+
+
+class Store(object):
+    """Slow hook recording how many calls were done when closed"""
+
+    def __init__(self):
+        self.calls = 0
+        self.closed_after = None
+
+    def __call__(self, *args):
+        time.sleep(0.2)
+        self.calls += 1
+
+    def close(self):
+        self.closed_after = self.calls
+
+
+class Counting(Extension):
+    """Extension counting its messages with the server metrics"""
+    accepts_metrics = True
+
+    def __call__(self, address, sender, recipients, message):
+        if self.metrics is not None:
+            self.metrics.increment('counted')
+        return sender
+
+
+class TestCreateHook(object):
+    def test_returns_hook_unchanged_when_inline(self):
+        hook = lambda *args: None
+
+        assert_that(create_hook('hook', hook, None, Executors()), is_(hook))
+
+    def test_wraps_hook_running_on_an_executor(self):
+        hook = create_hook('hook', slow_hook, {'executor': 'thread'}, Executors())
+
+        assert_that(hook, instance_of(ExecutorHook))
+
+    def test_validate_options_reports_unknown_executors(self):
+        errors = validate_options({'hook': {'executor': 'fiber', 'on_timeout': 'retry'}})
+
+        assert_that(errors, has_length(2))
+
+
+class TestExecutorHook(object):
+    def test_runs_hook_on_thread_pool(self):
+        with Spy() as spy:
+            pass
+        hook = ExecutorHook('spy', spy.hook, Executors(), 'thread', timeout=5)
+
+        hook(*ARGS)
+        hook.close()
+
+        assert_that(spy.hook, called().with_args(*ARGS))
+
+    def test_runs_extension_with_metrics_bound_on_process_pool(self):
+        extension = Counting()
+        bind_metrics({'counting': extension}, Metrics())
+        hook = ExecutorHook('counting', extension, Executors(), 'process', timeout=30)
+
+        assert_that(hook(*ARGS), is_(ARGS[1]))
+        hook.close()
+
+    def test_close_waits_for_running_calls_then_closes_the_hook(self):
+        store = Store()
+        hook = ExecutorHook('store', store, Executors(), 'thread', timeout=0.01)
+        with pytest.raises(HookTimeout):
+            hook(*ARGS)
+
+        hook.close()
+
+        assert_that(store.closed_after, is_(1))
+
+    def test_close_leaves_hook_kept_by_another_pipeline_open(self):
+        store = Store()
+        hook = ExecutorHook('store', store, Executors(), 'thread')
+
+        hook.close(close_hook=False)
+
+        assert_that(store.closed_after, is_(None))
+
+    def test_raises_timeout_when_hook_takes_too_long(self):
+        hook = ExecutorHook('slow', slow_hook, Executors(), 'thread', timeout=0.01)
+
+        with pytest.raises(HookTimeout):
+            hook(*ARGS)
+        hook.close()
+
+    def test_rejects_message_on_timeout_when_configured(self):
+        hook = ExecutorHook('slow', slow_hook, Executors(), 'thread', timeout=0.01,
+                            on_timeout='reject')
+
+        with pytest.raises(RejectMessage):
+            hook(*ARGS)
+        hook.close()
+
+
+class TestServerHookPolicies(object):
+    def test_process_message_keeps_running_hooks_after_a_timeout(self):
+        with Spy() as spy:
+            pass
+        timed_out = ExecutorHook('slow', slow_hook, Executors(), 'thread', timeout=0.01)
+        server = BaseServer.create(ADDRESS, [timed_out, spy.hook])
+
+        reply = server.process_message(*ARGS)
+        server.close_hooks()
+
+        assert_that(reply, is_(None))
+        assert_that(spy.hook, is_(called()))
+
+    def test_process_message_replies_with_rejection(self):
+        def reject(*args):
+            raise RejectMessage('550 Go away')
+
+        server = BaseServer.create(ADDRESS, [reject])
+
+        assert_that(server.process_message(*ARGS), is_('550 Go away'))
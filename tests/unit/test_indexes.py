@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from hamcrest import assert_that, is_, is_not, none, empty
+
+from hermes.indexes import Indexes, subject_of
+from hermes.message import Message
+
+ALICE = 'alice@hermes.test'
+BOB = 'bob@hermes.test'
+
+
+def message(subject):
+    return u'Subject: {}\nFrom: someone\n\nbody'.format(subject).encode('utf-8')
+
+
+def indexes():
+    descriptor, path = tempfile.mkstemp(suffix='.log')
+    os.close(descriptor)
+    indexes = Indexes(path)
+    indexes.add(1, 100.0, ALICE, [BOB], message('Welcome aboard'))
+    indexes.add(2, 200.0, BOB, [ALICE], message('Password reset'))
+    indexes.add(3, 300.0, ALICE, [BOB, ALICE], message('Reset your password'))
+    return indexes
+
+
+class TestIndexes(object):
+    def test_query_by_sender(self):
+        assert_that(indexes().query(sender=ALICE), is_([1, 3]))
+
+    def test_query_by_recipient_ignores_case_and_brackets(self):
+        assert_that(indexes().query(recipient='<Alice@Hermes.Test>'), is_([2, 3]))
+
+    def test_query_by_subject_matches_every_word(self):
+        assert_that(indexes().query(subject='password RESET'), is_([2, 3]))
+
+    def test_query_by_time_range(self):
+        assert_that(indexes().query(since=150, until=300), is_([2]))
+
+    def test_query_combines_filters(self):
+        assert_that(indexes().query(recipient=BOB, since=150), is_([3]))
+
+    def test_query_pages_newest_first(self):
+        found = indexes()
+
+        first_page = found.query(recipient=BOB, limit=1, reverse=True)
+        second_page = found.query(recipient=BOB, limit=1, reverse=True, after=first_page[-1])
+
+        assert_that(first_page + second_page, is_([3, 1]))
+
+    def test_query_without_matches(self):
+        assert_that(indexes().query(sender='nobody@hermes.test'), is_(empty()))
+
+    def test_entries_are_replayed_from_the_log(self):
+        found = indexes()
+        found.close()
+
+        assert_that(Indexes(found.path).query(sender=BOB), is_([2]))
+        os.remove(found.path)
+
+    def test_damaged_log_entries_are_dropped(self):
+        found = indexes()
+        found.close()
+        with open(found.path, 'a') as stream:
+            stream.write('[4, 400.0, "torn')
+
+        replayed = Indexes(found.path)
+
+        assert_that(replayed.last_id, is_(3))
+        os.remove(found.path)
+
+
+class TestSubject(object):
+    def test_decodes_encoded_subjects(self):
+        assert_that(subject_of(b'Subject: =?utf-8?q?Caf=C3=A9?=\n\nbody'), is_(u'Caf\xe9'))
+
+    def test_ignores_body(self):
+        assert_that(subject_of(b'From: a\n\nSubject: no'), is_(u''))
+
+    def test_uses_headers_parsed_by_message(self):
+        received = Message.from_bytes(message('Shared headers'))
+
+        assert_that(subject_of(received), is_(u'Shared headers'))
+        assert_that(received.parsed_headers, is_not(none()))
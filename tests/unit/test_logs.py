@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from hamcrest import assert_that, is_, contains_exactly, contains_string
+
+from hermes.logs import QueueHandler
+
+
+class BlockedHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.released = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.released.wait()
+        self.messages.append(record.getMessage())
+
+
+def logger_with(handler):
+    logger = logging.getLogger('hermes.test.logs.{}'.format(id(handler)))
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger
+
+
+class TestQueueHandler(object):
+    def test_writes_records_from_a_background_thread(self):
+        target = BlockedHandler()
+        handler = QueueHandler([target], size=10)
+        logger = logger_with(handler)
+
+        logger.warning('not waiting for %s', 'stdout')
+        written_before_release = list(target.messages)
+        target.released.set()
+        handler.stop()
+
+        assert_that(written_before_release, is_([]))
+        assert_that(target.messages, is_(['not waiting for stdout']))
+
+    def test_drops_records_when_full_and_reports_them(self):
+        target = BlockedHandler()
+        handler = QueueHandler([target], size=2)
+        logger = logger_with(handler)
+
+        for index in range(10):
+            logger.warning('record %d', index)
+        target.released.set()
+        handler.stop()
+
+        reports = [message for message in target.messages if 'Log queue full' in message]
+        assert_that(len(target.messages) - len(reports) + handler.dropped, is_(10))
+        assert_that(reports, contains_exactly(
+            contains_string('dropped {} records'.format(handler.dropped))))
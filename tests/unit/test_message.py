@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import smtplib
+
+from doublex import ANY_ARG, Spy, called
+from hamcrest import assert_that, is_, has_length, same_instance
+
+from hermes.message import Message
+from hermes.smtp import sendmessage, hook_message, hook_messages
+
+SENDER = 'email@email.em'
+RECIPIENTS = [SENDER]
+LINES = [b'Subject: test', b'', b'.hidden', b'body']
+
+
+def message(lines, spool_threshold=1024):
+    message = Message(spool_threshold=spool_threshold)
+    separator = b''
+    for line in lines:
+        message.write(separator + line)
+        separator = b'\n'
+    return message.finish()
+
+
+def relay_connection(extensions=()):
+    with Spy(smtplib.SMTP) as connection:
+        for extension in extensions:
+            connection.has_extn(extension).returns(True)
+        connection.mail(ANY_ARG).returns((250, b'OK'))
+        connection.rcpt(ANY_ARG).returns((250, b'OK'))
+        connection.getreply().delegates([(354, b'Go ahead'), (250, b'OK')])
+    return connection
+
+
+class TestMessage(object):
+    def test_small_messages_stay_in_memory(self):
+        assert_that(message(LINES).spooled, is_(False))
+
+    def test_big_messages_are_spooled(self):
+        spooled = message(LINES, spool_threshold=10)
+
+        assert_that(spooled.spooled, is_(True))
+        assert_that(spooled.as_bytes(), is_(b'\n'.join(LINES)))
+
+    def test_readers_are_independent(self):
+        spooled = message(LINES, spool_threshold=10)
+        first, second = spooled.open(), spooled.open()
+
+        first.read(8)
+
+        assert_that(second.read(), is_(b'\n'.join(LINES)))
+        assert_that(first.read(), is_(b'\n'.join(LINES)[8:]))
+
+    def test_iter_chunks_splits_after_newlines(self):
+        chunks = list(message(LINES).iter_chunks(size=20))
+
+        assert_that(chunks, is_([b'Subject: test\n\n', b'.hidden\nbody']))
+
+    def test_equals_its_content(self):
+        assert_that(message(LINES) == b'\n'.join(LINES))
+
+
+class TestHookMessage(object):
+    def test_legacy_hooks_get_bytes(self):
+        assert_that(hook_message(lambda *args: None, message(LINES)), is_(b'\n'.join(LINES)))
+
+    def test_hooks_accepting_messages_get_the_message(self):
+        class Hook(object):
+            accepts_message = True
+
+        received = message(LINES)
+
+        assert_that(hook_message(Hook(), received), is_(received))
+
+    def test_legacy_hooks_share_one_copy_of_spooled_messages(self):
+        hooks = [lambda *args: None, lambda *args: None]
+
+        (_, first), (_, second) = hook_messages(hooks, message(LINES, spool_threshold=1))
+
+        assert_that(first, is_(b'\n'.join(LINES)))
+        assert_that(second, same_instance(first))
+
+
+class TestSendMessage(object):
+    def test_streams_data_with_dot_stuffing_and_crlf(self):
+        connection = relay_connection()
+
+        sendmessage(connection, SENDER, RECIPIENTS, message(LINES))
+
+        assert_that(connection.send, called().with_args(
+            b'Subject: test\r\n\r\n..hidden\r\nbody\r\n.\r\n'))
+
+    def test_declares_the_message_size_when_supported(self):
+        connection = relay_connection(extensions=('size',))
+
+        sendmessage(connection, SENDER, RECIPIENTS, message(LINES))
+
+        assert_that(connection.mail, called().with_args(SENDER, ['size=27']))
+
+    def test_raises_when_every_recipient_is_refused(self):
+        with Spy(smtplib.SMTP) as connection:
+            connection.mail(ANY_ARG).returns((250, b'OK'))
+            connection.rcpt(ANY_ARG).returns((550, b'No such user'))
+
+        try:
+            sendmessage(connection, SENDER, RECIPIENTS, message(LINES))
+        except smtplib.SMTPRecipientsRefused as error:
+            assert_that(error.recipients, has_length(1))
+        else:
+            raise AssertionError('SMTPRecipientsRefused not raised')
+
+
+MULTIPART = [
+    b'Subject: =?utf-8?q?caf=C3=A9?=',
+    b'Content-Type: multipart/mixed; boundary="b"',
+    b'',
+    b'--b',
+    b'Content-Type: text/plain',
+    b'',
+    b'hello',
+    b'--b',
+    b'Content-Type: text/csv',
+    b'Content-Disposition: attachment; filename="report.csv"',
+    b'',
+    b'a,b',
+    b'--b--',
+]
+
+
+class TestParsedMessage(object):
+    def test_decodes_headers_once(self):
+        received = message(MULTIPART)
+
+        assert_that(received.subject, is_(u'café'))
+        assert_that(received.headers, is_(received.headers))
+
+    def test_headers_do_not_parse_the_body(self):
+        received = message(MULTIPART)
+
+        received.headers
+
+        assert_that(received.parsed_email, is_(None))
+
+    def test_parses_mime_parts_of_spooled_messages(self):
+        received = message(MULTIPART, spool_threshold=10)
+
+        attachments = list(received.email.iter_attachments())
+
+        assert_that(received.spooled, is_(True))
+        assert_that([part.get_filename() for part in attachments], is_(['report.csv']))
+        assert_that(received.email.get_body(('plain',)).get_content(), is_(u'hello'))
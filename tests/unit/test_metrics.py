@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import tempfile
+import threading
+
+from hamcrest import assert_that, is_, has_entries, has_key, close_to
+
+from hermes.metrics import BUCKETS, Metrics, StatsWriter, merge, quantile, summary
+from hermes.smtp import BaseServer
+from hermes.hooks import RejectMessage
+
+ADDRESS = ('127.0.0.1', 8888)
+SENDER = 'email@email.em'
+RECIPIENTS = [SENDER]
+
+
+class TestMetrics(object):
+    def test_snapshot_merges_every_thread(self):
+        metrics = Metrics()
+
+        def record():
+            for _ in range(100):
+                metrics.increment('messages')
+                metrics.observe('relay', 0.002)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = metrics.snapshot()
+
+        assert_that(snapshot['counters'], is_({'messages': 400}))
+        assert_that(snapshot['stages']['relay'], has_entries(count=400, total=close_to(0.8, 0.001)))
+
+    def test_merge_adds_up_snapshots_of_several_processes(self):
+        first, second = Metrics(), Metrics()
+        first.observe('data', 0.001)
+        second.observe('data', 0.5)
+        second.increment('sessions', 2)
+
+        merged = merge([first.snapshot(), second.snapshot()])
+
+        assert_that(merged['counters'], is_({'sessions': 2}))
+        assert_that(merged['gauges'], is_({}))
+        assert_that(merged['stages']['data'], has_entries(count=2, max=0.5))
+
+    def test_snapshot_reads_gauges_and_merge_adds_them_up(self):
+        first, second = Metrics(), Metrics()
+        first.gauge('relay_queue_depth', lambda: 3)
+        second.gauge('relay_queue_depth', lambda: 4)
+
+        merged = merge([first.snapshot(), second.snapshot()])
+
+        assert_that(merged['gauges'], is_({'relay_queue_depth': 7}))
+
+    def test_quantiles_are_bucket_bounds_capped_by_the_max(self):
+        metrics = Metrics()
+        for _ in range(98):
+            metrics.observe('hook.printer', 0.0004)
+        for _ in range(2):
+            metrics.observe('hook.printer', 3)
+        histogram = metrics.snapshot()['stages']['hook.printer']
+
+        assert_that(quantile(histogram, 0.5), is_(0.0005))
+        assert_that(quantile(histogram, 0.99), is_(3))
+
+    def test_summary_reports_rates_over_uptime(self):
+        histogram = dict(count=20, total=2.0, max=0.3, buckets=[0] * len(BUCKETS))
+        snapshot = merge([dict(counters={}, stages={'relay': histogram})], uptime=10)
+
+        assert_that(summary(snapshot)['relay'], has_entries(rate=2.0, mean=0.1))
+
+
+class TestServerMetrics(object):
+    def test_records_hooks_by_name_and_rejections(self):
+        def spam_filter(address, sender, recipients, message):
+            raise RejectMessage('550 Spam')
+        spam_filter.name = 'spam'
+        server = BaseServer.create(ADDRESS, [spam_filter])
+
+        server.process_message(None, SENDER, RECIPIENTS, b'foo')
+        snapshot = server.metrics.snapshot()
+
+        assert_that(snapshot['counters'], is_({'messages': 1, 'rejected': 1}))
+        assert_that(snapshot['stages'], has_key('hook.spam'))
+
+
+class TestStatsWriter(object):
+    def test_writes_snapshots_and_removes_them_on_close(self):
+        metrics = Metrics()
+        metrics.increment('messages')
+        path = os.path.join(tempfile.mkdtemp(), 'hermes.1.stats')
+        writer = StatsWriter(metrics, path)
+
+        writer.write()
+        with open(path) as stream:
+            written = json.load(stream)
+        writer.close()
+
+        assert_that(written['counters'], is_({'messages': 1}))
+        assert_that(os.path.exists(path), is_(False))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+
+from hamcrest import assert_that, is_, has_entries
+
+from hermes import plugins
+
+
+class TestEntryPoints(object):
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'entry_points.json')
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def test_lists_extensions_without_loading_them(self):
+        found = plugins.entry_points(path=self.path)
+
+        assert_that(found, has_entries(printer='hermes.extensions.printer:Printer',
+                                       mailbox='hermes.extensions.mailbox:Mailbox'))
+
+    def test_reads_cache_while_sys_path_is_unchanged(self):
+        plugins.entry_points(path=self.path)
+        self.write_cache(plugins.fingerprint(), {'printer': 'cached:Printer'})
+
+        assert_that(plugins.entry_points(path=self.path), is_({'printer': 'cached:Printer'}))
+
+    def test_scans_again_when_sys_path_changes(self):
+        self.write_cache([['/nowhere', None]], {'printer': 'cached:Printer'})
+
+        found = plugins.entry_points(path=self.path)
+
+        assert_that(found, has_entries(printer='hermes.extensions.printer:Printer'))
+
+    def write_cache(self, fingerprint, found):
+        with open(self.path, 'w') as stream:
+            json.dump(dict(fingerprint=fingerprint, namespaces={plugins.NAMESPACE: found}), stream)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from hamcrest import assert_that, is_, contains_string
+import pytest
+
+from hermes.extensions.printer import Printer
+from hermes.message import Message
+
+BODY = b'Subject: hello\n\n' + b'x' * 100
+
+
+def printer(**options):
+    extension = Printer()
+    extension.configure(options)
+    return extension
+
+
+class TestPrinter(object):
+    def test_prints_short_bodies_whole_by_default(self):
+        assert_that(printer().format_body(Message.from_bytes(BODY)), is_(BODY.decode('ascii')))
+
+    def test_truncates_long_bodies_by_default(self):
+        body = printer(max_body=14).format_body(Message.from_bytes(BODY))
+
+        assert_that(body, is_(u'Subject: hello\n[... 102 more bytes]'))
+
+    def test_prints_whole_body_when_asked(self):
+        body = printer(body='full', max_body=14).format_body(Message.from_bytes(BODY))
+
+        assert_that(body, is_(BODY.decode('ascii')))
+
+    def test_truncates_long_bodies(self):
+        body = printer(body='truncate', max_body=14).format_body(Message.from_bytes(BODY))
+
+        assert_that(body, is_(u'Subject: hello\n[... 102 more bytes]'))
+
+    def test_summarizes_bodies(self):
+        body = printer(body='summary').format_body(BODY)
+
+        assert_that(body, contains_string(u'116 bytes, subject: hello'))
+
+    def test_rejects_unknown_body_modes(self):
+        with pytest.raises(ValueError):
+            printer(body='everything')
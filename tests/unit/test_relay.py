@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from doublex import ANY_ARG, Spy, Stub, called
+from hamcrest import assert_that, is_, has_entries
+
+from hermes.relay import RelayQueue
+from hermes.smtp import Sender, BaseServer
+
+ADDRESS = ('127.0.0.1', 8888)
+SENDER = 'email@email.em'
+RECIPIENTS = [SENDER]
+MESSAGE = 'foo'
+
+
+def sender_spy():
+    with Spy(Sender) as sender:
+        sender.send(ANY_ARG).returns(True)
+    return sender
+
+
+class TestRelayQueue(object):
+    def test_put_rejects_messages_when_full(self):
+        relay = RelayQueue(sender_spy(), size=1)
+
+        accepted = [relay.put(SENDER, RECIPIENTS, MESSAGE) for _ in range(2)]
+
+        assert_that(accepted, is_([True, False]))
+        assert_that(relay.stats(), has_entries(depth=1, rejected=1))
+
+    def test_workers_relay_queued_messages(self):
+        sender = sender_spy()
+        relay = RelayQueue(sender, size=10, workers=2)
+        relay.start()
+
+        relay.put(SENDER, RECIPIENTS, MESSAGE)
+        relay.close()
+
+        assert_that(sender.send, called().with_args(SENDER, RECIPIENTS, MESSAGE))
+        assert_that(relay.stats(), has_entries(depth=0, relayed=1))
+
+    def test_close_drains_queue_before_stopping(self):
+        sender = sender_spy()
+        relay = RelayQueue(sender, size=10, workers=1)
+
+        for _ in range(5):
+            relay.put(SENDER, RECIPIENTS, MESSAGE)
+        relay.start()
+        abandoned = relay.close()
+
+        assert_that(abandoned, is_(0))
+        assert_that(sender.send, called().times(5))
+
+    def test_close_reports_messages_left_behind(self):
+        relay = RelayQueue(sender_spy(), size=10)
+        relay.put(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(relay.close(timeout=0), is_(1))
+
+    def test_counts_failed_relays(self):
+        with Stub(Sender) as sender:
+            sender.send(ANY_ARG).returns(False)
+        relay = RelayQueue(sender, size=10, workers=1)
+        relay.start()
+
+        relay.put(SENDER, RECIPIENTS, MESSAGE)
+        relay.close()
+
+        assert_that(relay.stats(), has_entries(failed=1))
+
+
+    def test_workers_keep_relaying_after_unexpected_errors(self):
+        sender = sender_spy()
+        relay = RelayQueue(Failing(sender), size=10, workers=1)
+        relay.start()
+
+        relay.put(u'j\xe9@hermes.test', RECIPIENTS, MESSAGE)
+        relay.put(SENDER, RECIPIENTS, MESSAGE)
+        relay.close()
+
+        assert_that(sender.send, called().with_args(SENDER, RECIPIENTS, MESSAGE))
+        assert_that(relay.stats(), has_entries(relayed=1, failed=1))
+
+
+class Failing(object):
+    """Sender failing like smtplib on non ASCII senders"""
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def send(self, sender, recipients, message):
+        sender.encode('ascii')
+        return self.sender.send(sender, recipients, message)
+
+
+class TestServerRelayQueue(object):
+    def test_process_message_replies_451_when_relay_queue_is_full(self):
+        server = BaseServer.create(ADDRESS, [], ADDRESS, queue_options=dict(size=1))
+
+        replies = [server.process_message(None, SENDER, RECIPIENTS, MESSAGE) for _ in range(2)]
+
+        assert_that(replies, is_([None, '451 Relay queue full, try again later']))
+
+    def test_metrics_report_relay_queue_depth_and_drops(self):
+        server = BaseServer.create(ADDRESS, [], ADDRESS, queue_options=dict(size=1))
+
+        for _ in range(3):
+            server.process_message(None, SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(server.metrics.snapshot()['gauges'],
+                    is_({'relay_queue_depth': 1, 'relay_queue_dropped': 2}))
+
+
+class TestRelayBatches(object):
+    def test_groups_queued_messages_by_recipient_domain(self):
+        with Spy(Sender) as sender:
+            sender.send(ANY_ARG).returns(True)
+            sender.send_batch(ANY_ARG).delegates(lambda messages: [True] * len(messages))
+        relay = RelayQueue(sender, size=10, workers=1, batch_size=2, batch_wait=10)
+
+        for recipient in ('one@a.test', 'two@b.test', 'three@A.test'):
+            relay.put(SENDER, [recipient], MESSAGE)
+        relay.start()
+        relay.close()
+
+        assert_that(sender.send_batch, called().with_args([
+            (SENDER, ['one@a.test'], MESSAGE), (SENDER, ['three@A.test'], MESSAGE)]))
+        assert_that(sender.send, called().with_args(SENDER, ['two@b.test'], MESSAGE))
+        assert_that(relay.stats(), has_entries(relayed=3, batches=1))
+
+    def test_relays_partial_batches_after_batch_wait(self):
+        sender = sender_spy()
+        relay = RelayQueue(sender, size=10, workers=1, batch_size=10, batch_wait=0.01)
+        relay.start()
+
+        relay.put(SENDER, RECIPIENTS, MESSAGE)
+        time.sleep(0.2)
+
+        assert_that(sender.send, called().with_args(SENDER, RECIPIENTS, MESSAGE))
+        relay.close()
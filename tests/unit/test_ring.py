@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from hamcrest import assert_that, is_, none, has_entries, has_properties, less_than_or_equal_to
+import pytest
+
+from hermes.extensions.ring import RingMailbox
+from hermes.message import Message
+from hermes.metrics import Metrics
+from hermes.ring import Ring, RECORD_OVERHEAD
+
+ALICE = 'alice@hermes.test'
+BOB = 'bob@hermes.test'
+
+
+def message(subject, size=0):
+    return u'Subject: {}\n\n{}'.format(subject, u'x' * size).encode('utf-8')
+
+
+def budget(messages, size):
+    """Room for that many messages of that body size"""
+    return messages * (RECORD_OVERHEAD + size + 64)
+
+
+class TestRing(object):
+    def test_get_returns_kept_message(self):
+        ring = Ring()
+
+        id = ring.append(ALICE, [BOB], message('hello'), timestamp=10.5)
+
+        assert_that(ring.get(id), has_properties(id=1, timestamp=10.5, sender=ALICE, recipients=[BOB],
+                                                 body=message('hello')))
+
+    def test_query_by_recipient_subject_and_time(self):
+        ring = Ring()
+        ring.append(ALICE, [BOB], message('Welcome aboard'), timestamp=100.0)
+        ring.append(BOB, [ALICE], message('Password reset'), timestamp=200.0)
+        ring.append(ALICE, [BOB, ALICE], message('Reset your password'), timestamp=300.0)
+
+        assert_that(ring.query(recipient='Bob@hermes.test'), is_([1, 3]))
+        assert_that(ring.query(subject='password', reverse=True), is_([3, 2]))
+        assert_that(ring.query(recipient=ALICE, since=250.0), is_([3]))
+
+    def test_evicts_oldest_messages_over_budget(self):
+        ring = Ring(budget=budget(3, 1000))
+
+        for index in range(10):
+            ring.append(ALICE, [BOB if index % 2 else ALICE], message(index, 1000))
+
+        assert_that(len(ring), is_(3))
+        assert_that(ring.size, less_than_or_equal_to(ring.budget))
+        assert_that(ring.get(7), is_(none()))
+        assert_that(ring.query(recipient=BOB), is_([8, 10]))
+        assert_that(ring.query(sender=ALICE, limit=2), is_([8, 9]))
+
+    def test_drops_index_entries_of_evicted_messages(self):
+        ring = Ring(budget=budget(1, 0))
+
+        ring.append(ALICE, [BOB], message('first'))
+        ring.append(BOB, [ALICE], message('second'))
+
+        assert_that(ring.recipients, is_({'alice@hermes.test': ring.recipients[ALICE]}))
+        assert_that(ring.query(subject='first'), is_([]))
+
+    def test_does_not_keep_messages_bigger_than_budget(self):
+        ring = Ring(budget=budget(1, 100))
+        ring.append(ALICE, [BOB], message('small'))
+
+        assert_that(ring.append(ALICE, [BOB], message('big', 1000)), is_(none()))
+        assert_that(len(ring), is_(1))
+
+    def test_counts_occupancy_and_evictions(self):
+        metrics = Metrics()
+        ring = Ring(budget=budget(2, 0), metrics=metrics)
+
+        for index in range(5):
+            ring.append(ALICE, [BOB], message(index))
+
+        assert_that(metrics.snapshot()['counters'],
+                    has_entries(ring_messages=2, ring_evicted=3, ring_bytes=ring.size))
+
+
+class TestRingMailbox(object):
+    def test_keeps_received_messages(self):
+        mailbox = RingMailbox()
+        mailbox.configure({'budget': 2 ** 20})
+
+        mailbox(('127.0.0.1', 1000), ALICE, [BOB], Message.from_bytes(message('hello')))
+
+        assert_that(mailbox.ring.get(1).body, is_(message('hello')))
+
+    def test_refuses_invalid_budget(self):
+        with pytest.raises(ValueError):
+            RingMailbox().configure({'budget': 'lots'})
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from doublex import Spy, called, never
+from hamcrest import assert_that, is_, none, contains_string
+
+from hermes.rules import Router, validate
+from hermes.smtp import BaseServer
+
+ADDRESS = ('127.0.0.1', 8888)
+SENDER = 'email@email.em'
+RULES = [
+    {'match': 'bob@example.com', 'action': 'redirect', 'to': 'alice@example.com'},
+    {'match': 'example.com', 'hooks': ['mailbox']},
+    {'match': 'example.net', 'action': 'rewrite', 'to': 'example.com'},
+    {'match': '*.example.org', 'action': 'drop'},
+    {'match': '*.lists.example.org', 'hooks': ['printer']},
+    {'match': 'spam.test', 'action': 'reject', 'reply': '550 No thanks'},
+]
+
+
+class TestRouter(object):
+    def test_addresses_win_over_domains(self):
+        router = Router(RULES)
+
+        assert_that(router.match('<Bob@Example.com>').action, is_('redirect'))
+        assert_that(router.match('carol@example.com').hooks, is_(frozenset(['mailbox'])))
+
+    def test_longest_wildcard_wins_and_only_covers_subdomains(self):
+        router = Router(RULES)
+
+        assert_that(router.match('a@news.lists.example.org').hooks, is_(frozenset(['printer'])))
+        assert_that(router.match('a@eu.mx.example.org').action, is_('drop'))
+        assert_that(router.match('a@example.org'), is_(none()))
+
+    def test_default_rule_applies_to_unmatched_recipients(self):
+        router = Router(RULES + [{'match': '*', 'action': 'drop'}])
+
+        assert_that(router.match('a@elsewhere.test').action, is_('drop'))
+
+    def test_route_rewrites_and_drops_recipients(self):
+        route = Router(RULES).route(['bob@example.com', 'dan@example.net', 'x@mx.example.org'])
+
+        assert_that(route.recipients, is_(['alice@example.com', 'dan@example.com']))
+
+    def test_route_runs_the_hooks_of_matched_rules(self):
+        route = Router(RULES).route(['carol@example.com', 'a@news.lists.example.org'])
+
+        assert_that(route.hooks, is_(frozenset(['mailbox', 'printer'])))
+
+    def test_route_runs_every_hook_for_unmatched_recipients(self):
+        route = Router(RULES).route(['carol@example.com', 'a@elsewhere.test'])
+
+        assert_that(route.hooks, is_(none()))
+
+    def test_route_rejects_the_message(self):
+        assert_that(Router(RULES).route(['a@spam.test']).reply, is_('550 No thanks'))
+
+
+class TestValidate(object):
+    def test_reports_bad_rules(self):
+        errors = validate([{'match': 'a.test', 'action': 'bounce'},
+                           {'match': 'b.test', 'action': 'redirect'},
+                           {'match': 'c.test', 'hooks': ['scanner']}], ['printer'])
+
+        assert_that(errors[0], contains_string('action should be one of'))
+        assert_that(errors[1], contains_string('redirect needs "to"'))
+        assert_that(errors[2], contains_string('hook scanner is not loaded'))
+
+
+def named_hook(name):
+    with Spy() as spy:
+        pass
+    hook = spy.hook
+    hook.name = name
+    return hook
+
+
+class TestServerRouting(object):
+    def test_runs_hooks_selected_by_the_rules(self):
+        mailbox, printer = named_hook('mailbox'), named_hook('printer')
+        server = BaseServer.create(ADDRESS, [mailbox, printer], rules=RULES)
+
+        server.process_message(None, SENDER, ['carol@example.com'], b'foo')
+
+        assert_that(mailbox, called().with_args(None, SENDER, ['carol@example.com'], b'foo'))
+        assert_that(printer, never(called()))
+
+    def test_accepts_messages_without_recipients_left(self):
+        printer = named_hook('printer')
+        server = BaseServer.create(ADDRESS, [printer], rules=RULES)
+
+        reply = server.process_message(None, SENDER, ['a@mx.example.org'], b'foo')
+
+        assert_that(reply, is_(none()))
+        assert_that(printer, never(called()))
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import time
+import socket
 import smtplib
+import threading
 
-from doublex import Spy, called
-from hamcrest import assert_that, has_property, is_, is_not
+from doublex import ANY_ARG, Spy, called, never
+from hamcrest import assert_that, has_length, has_property, is_, is_not
+import pytest
 
-from hermes.smtp import Sender
+from hermes.message import Message
+from hermes.smtp import Sender, Balancer, Pool, transparent, senddata, nodelay
+from hermes.retry import RetryLog
 
 IP = '127.0.0.1'
 PORT = 8888
@@ -48,6 +54,321 @@ class TestSender(object):
 
         assert_that(self.connection.sendmail, called().with_args(SENDER, RECIPIENTS, MESSAGE))
 
-    def setup(self):
+    def setup_method(self):
         self.connection = Spy(smtplib.SMTP)
         Sender.sender_class = lambda _: self.connection
+
+
+class Connection(object):
+    """SMTP connection over a TCP socket which is never connected"""
+
+    def connect(self, host, port):
+        self.sock = socket.socket()
+
+    def quit(self):
+        self.sock.close()
+
+
+def delays(sock):
+    return not sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+
+
+class TestNoDelay(object):
+    def test_disables_nagle_on_sockets(self):
+        sock = socket.socket()
+
+        nodelay(sock)
+
+        assert_that(delays(sock), is_(False))
+        sock.close()
+
+    def test_relay_connections_do_not_delay_small_writes(self):
+        sender = Sender(ADDRESS)
+        sender.sender_class = Connection
+
+        with sender.connection() as connection:
+            assert_that(delays(connection.sock), is_(False))
+
+
+def pooled_sender(connections, **options):
+    sender = Sender(ADDRESS, pool_size=2, **options)
+    sender.sender_class = lambda: connections.pop(0)
+    return sender
+
+
+def healthy_connection():
+    with Spy(smtplib.SMTP) as connection:
+        connection.rset().returns((250, b'OK'))
+    return connection
+
+
+class TestPooledSender(object):
+    def test_pooled_sender_reuses_connection_between_messages(self):
+        connection = healthy_connection()
+        sender = pooled_sender([connection])
+
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(connection.connect, called().times(1))
+        assert_that(connection.sendmail, called().times(2))
+
+    def test_pooled_sender_does_not_quit_connection_after_usage(self):
+        connection = healthy_connection()
+        sender = pooled_sender([connection])
+
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(connection.quit, is_not(called()))
+
+    def test_pooled_sender_reconnects_after_max_messages(self):
+        first, second = healthy_connection(), healthy_connection()
+        sender = pooled_sender([first, second], max_messages=1)
+
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(first.quit, is_(called()))
+        assert_that(second.sendmail, called().with_args(SENDER, RECIPIENTS, MESSAGE))
+
+    def test_pooled_sender_drops_connections_failing_health_check(self):
+        with Spy(smtplib.SMTP) as broken:
+            broken.rset().raises(smtplib.SMTPServerDisconnected)
+        fresh = healthy_connection()
+        sender = pooled_sender([broken, fresh], idle_timeout=60)
+        sender.pool.check_interval = -1
+
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(fresh.sendmail, called().times(1))
+
+    def test_pooled_sender_resets_connection_after_refused_message(self):
+        with Spy(smtplib.SMTP) as connection:
+            connection.rset().returns((250, b'OK'))
+            connection.sendmail(SENDER, RECIPIENTS, MESSAGE).raises(
+                smtplib.SMTPRecipientsRefused({}))
+        sender = pooled_sender([connection])
+
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(connection.rset, is_(called()))
+        assert_that(sender.pool.idle, has_length(1))
+
+    def test_close_quits_idle_connections(self):
+        connection = healthy_connection()
+        sender = pooled_sender([connection])
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        sender.close()
+
+        assert_that(connection.quit, is_(called()))
+
+
+def refused():
+    raise socket.error('Connection refused')
+
+
+class TestPool(object):
+    def setup_method(self):
+        self.pool = Pool(healthy_connection, 1)
+        self.acquired = []
+        self.waiting = threading.Thread(target=lambda: self.acquired.append(self.pool.acquire()),
+                                        daemon=True)
+
+    def test_waits_for_a_released_connection_once_all_are_in_use(self):
+        entry = self.pool.acquire()
+        self.waiting.start()
+        self.waiting.join(0.1)
+        waited = list(self.acquired)
+
+        self.pool.release(entry)
+        self.waiting.join(1)
+
+        assert_that(waited, is_([]))
+        assert_that(self.acquired, is_([entry]))
+
+    def test_discarded_connections_free_their_slot(self):
+        entry = self.pool.acquire()
+        self.waiting.start()
+
+        self.pool.discard(entry)
+        self.waiting.join(1)
+
+        assert_that(self.acquired, has_length(1))
+        assert_that(self.acquired[0], is_not(entry))
+
+    def test_failed_connects_free_their_slot(self):
+        self.pool.factory = refused
+
+        with pytest.raises(socket.error):
+            self.pool.acquire()
+        self.pool.factory = healthy_connection
+
+        assert_that(self.pool.acquire(), is_not(None))
+
+
+def pipelining_connection(replies, extensions=('pipelining',)):
+    with Spy(smtplib.SMTP) as connection:
+        for extension in extensions:
+            connection.has_extn(extension).returns(True)
+        connection.getreply().delegates(replies)
+    return connection
+
+
+class TestBatchSender(object):
+    def test_pipelines_envelope_and_data_commands(self):
+        connection = pipelining_connection([(250, b'OK'), (250, b'OK'), (354, b'Go'), (250, b'OK')])
+        sender = Sender(ADDRESS)
+        sender.sender_class = lambda: connection
+
+        sent = sender.send_batch([(SENDER, RECIPIENTS, MESSAGE)])
+
+        assert_that(sent, is_([True]))
+        assert_that(connection.send, called().with_args(
+            u'mail FROM:<{0}>\r\nrcpt TO:<{0}>\r\ndata\r\n'.format(SENDER)))
+        assert_that(connection.send, called().with_args(b'foo\r\n.\r\n'))
+
+    def test_pipelines_esmtp_mail_options(self):
+        connection = pipelining_connection([(250, b'OK'), (250, b'OK'), (354, b'Go'), (250, b'OK')],
+                                           extensions=('pipelining', 'size'))
+        sender = Sender(ADDRESS)
+        sender.sender_class = lambda: connection
+
+        sender.send_batch([(SENDER, RECIPIENTS, MESSAGE)])
+
+        assert_that(connection.send, called().with_args(
+            u'mail FROM:<{0}> size=3\r\nrcpt TO:<{0}>\r\ndata\r\n'.format(SENDER)))
+
+    def test_sends_a_batch_over_one_connection(self):
+        connection = pipelining_connection([(250, b'OK'), (250, b'OK'), (354, b'Go'), (250, b'OK')] * 2)
+        sender = pooled_sender([connection])
+
+        sent = sender.send_batch([(SENDER, RECIPIENTS, MESSAGE)] * 2)
+
+        assert_that(sent, is_([True, True]))
+        assert_that(connection.send, called().times(4))
+
+    def test_refused_messages_do_not_fail_the_batch(self):
+        connection = pipelining_connection([(550, b'No'), (503, b'No'), (503, b'No'),
+                                            (250, b'OK'), (250, b'OK'), (354, b'Go'), (250, b'OK')])
+        sender = Sender(ADDRESS)
+        sender.sender_class = lambda: connection
+
+        sent = sender.send_batch([('spammer@email.em', RECIPIENTS, MESSAGE), (SENDER, RECIPIENTS, MESSAGE)])
+
+        assert_that(sent, is_([False, True]))
+        assert_that(connection.rset, called().times(1))
+
+
+class TestSendData(object):
+    def test_stuffs_dots_and_ends_lines_with_crlf_across_chunks(self):
+        chunks = [b'a\r', b'\n.b', b'.c\n', b'.d\r']
+
+        assert_that(b''.join(transparent(chunks)), is_(b'a\r\n..b.c\r\n..d\r\n'))
+
+    def test_does_not_stuff_dots_of_a_line_split_across_chunks(self):
+        message = Message.from_bytes(b'.' + b'x' * 99 + b'.y\n.z')
+
+        assert_that(b''.join(transparent(message.iter_chunks(size=100))),
+                    is_(b'..' + b'x' * 99 + b'.y\r\n..z'))
+
+    def test_ends_data_without_doubling_the_last_crlf(self):
+        connection = pipelining_connection([(250, b'OK')])
+
+        senddata(connection, Message.from_bytes(b'foo\n'))
+
+        assert_that(connection.send, called().with_args(b'foo\r\n.\r\n'))
+
+
+class TestSenderRetry(object):
+    def test_defers_messages_when_relay_server_is_unreachable(self):
+        with Spy(smtplib.SMTP) as connection:
+            connection.connect(ANY_ARG).raises(socket.error)
+        sender = Sender(ADDRESS)
+        sender.sender_class = lambda: connection
+        sender.retry = Spy(RetryLog)
+
+        sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(sender.retry.defer, called().with_args([(SENDER, RECIPIENTS, MESSAGE)]))
+
+    def test_defers_messages_refused_for_now_only(self):
+        connection = pipelining_connection([(451, b'Later'), (503, b'No'), (503, b'No'),
+                                            (550, b'No'), (503, b'No'), (503, b'No')])
+        sender = Sender(ADDRESS)
+        sender.sender_class = lambda: connection
+        sender.retry = Spy(RetryLog)
+
+        sender.send_batch([('later@email.em', RECIPIENTS, MESSAGE),
+                           ('spammer@email.em', RECIPIENTS, MESSAGE)])
+
+        assert_that(sender.retry.defer, called().with_args([('later@email.em', RECIPIENTS, MESSAGE)]))
+
+
+def balancer(*outcomes, **options):
+    """Balancer over upstreams answering every message with their outcome"""
+    balancer = Balancer([((IP, PORT + index), 1) for index in range(len(outcomes))], **options)
+    for upstream, outcome in zip(balancer.upstreams, outcomes):
+        address = upstream.sender.address
+        with Spy(Sender) as upstream.sender:
+            upstream.sender.attempt(ANY_ARG).returns([outcome])
+        upstream.sender.address = address
+    return balancer
+
+
+class TestBalancer(object):
+    def test_spreads_messages_across_idle_upstreams(self):
+        sender = balancer(True, True)
+
+        for _ in range(4):
+            sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        for upstream in sender.upstreams:
+            assert_that(upstream.sender.attempt, called().times(2))
+
+    def test_round_robin_follows_weights(self):
+        sender = balancer(True, True, balance='round-robin')
+        sender.upstreams[0].weight = 2
+
+        chosen = [sender.choose('', set()) for _ in range(3)]
+
+        assert_that(chosen.count(sender.upstreams[0]), is_(2))
+
+    def test_domain_sticks_to_one_upstream(self):
+        sender = balancer(True, True, True, balance='domain')
+
+        chosen = set(sender.choose('example.com', set()) for _ in range(10))
+
+        assert_that(chosen, has_length(1))
+
+    def test_tries_next_upstream_when_one_fails(self):
+        sender = balancer(None, True, balance='round-robin')
+        sender.retry = Spy(RetryLog)
+
+        sent = [sender.send(SENDER, RECIPIENTS, MESSAGE) for _ in range(2)]
+
+        assert_that(sent, is_([True, True]))
+        assert_that(sender.retry.defer, never(called()))
+
+    def test_ejects_upstreams_failing_max_failures_times(self):
+        sender = balancer(None, None, max_failures=2)
+
+        for _ in range(2):
+            sender.send(SENDER, RECIPIENTS, MESSAGE)
+
+        assert_that(all(upstream.ejected_until > 0 for upstream in sender.upstreams), is_(True))
+
+    def test_probe_puts_back_upstreams_answering_noop(self):
+        with Spy(smtplib.SMTP) as connection:
+            connection.noop().returns((250, b'OK'))
+        sender = Balancer([(ADDRESS, 1), ((IP, PORT + 1), 1)], check_interval=0.01)
+        sender.upstreams[0].ejected_until = time.time() + 60
+        for upstream in sender.upstreams:
+            upstream.sender.sender_class = lambda: connection
+
+        sender.start()
+        time.sleep(0.1)
+        sender.close()
+
+        assert_that(sender.upstreams[0].ejected_until, is_(0))
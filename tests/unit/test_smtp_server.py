@@ -1,16 +1,26 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import pstats
+import socket
+import tempfile
+
 from doublex import Spy, called
-from hamcrest import assert_that, has_property, has_item, is_
+from hamcrest import assert_that, has_property, has_item, is_, is_not, same_instance
 
-from nose.tools import nottest
+import pytest
 
-from hermes.smtp import Server
+from hermes.hooks import ExecutorHook, Executors
+from hermes.message import Message
+from hermes.metrics import Metrics
+from hermes.smtp import Server, BaseServer, Channel
 
 
 PORT = 8888
 LOCALHOST = '127.0.0.1'
 ADDRESS = (LOCALHOST, PORT)
+ARGS = [ADDRESS, 'email@email.em', ['email@email.em'], b'message']
 
 
 def server_args():
@@ -26,6 +36,16 @@ class TestServer(object):
 
         assert_that(server, has_property('hooks', has_item(hook)))
 
+    def test_shares_the_engine_independent_setup(self):
+        server = Server.create((LOCALHOST, 0), hooks=[], reuse_port=True,
+                               throttle_options={'window': 60})
+        reuses_port = server.socket.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT)
+        server.close()
+
+        assert_that(reuses_port, is_not(0))
+        assert_that(server.throttle, is_not(None))
+        assert_that(server.metrics.snapshot()['gauges'], has_item('relay_queue_depth'))
+
     def test_process_message_calls_hook(self):
         with Spy() as spy:
             server = Server.create(*server_args(), hooks=[spy.hook])
@@ -35,7 +55,7 @@ class TestServer(object):
 
         assert_that(spy.hook, is_(called()))
 
-    @nottest
+    @pytest.mark.skip(reason='hooks are not given keyword arguments')
     def test_process_message_calls_hook_with_same_args(self):
         args, kwargs = [1, 2], {'a': 1, 'b': 2}
         with Spy() as spy:
@@ -46,7 +66,7 @@ class TestServer(object):
 
         assert_that(spy.hook, is_(called().with_args(*args, **kwargs)))
 
-    @nottest
+    @pytest.mark.skip(reason='hooks are not given keyword arguments')
     def test_process_message_calls_all_hooks_with_same_args(self):
         args, kwargs = [1, 2], {'a': 1, 'b': 2}
 
@@ -60,3 +80,158 @@ class TestServer(object):
         server.process_message(*args, **kwargs)
 
         assert_that(spy.hook, is_(called().with_args(*args, **kwargs)))
+
+
+class TestReconfigure(object):
+    def test_next_messages_run_new_hooks(self):
+        with Spy() as old:
+            pass
+        with Spy() as new:
+            pass
+        server = BaseServer.create(ADDRESS, [old.hook])
+
+        server.reconfigure([new.hook])
+        server.process_message(*ARGS)
+
+        assert_that(old.hook, is_not(called()))
+        assert_that(new.hook, is_(called()))
+
+    def test_previous_hooks_are_closed_once_idle(self):
+        with Spy() as old:
+            pass
+        server = BaseServer.create(ADDRESS, [old])
+        previous = server.pipeline
+        previous.enter()
+
+        server.reconfigure([])
+        assert_that(old.close, is_not(called()))
+        previous.leave()
+        previous.wait_idle()
+        time.sleep(0.1)
+
+        assert_that(old.close, is_(called()))
+
+    def test_kept_hooks_are_not_closed(self):
+        with Spy() as kept:
+            pass
+        server = BaseServer.create(ADDRESS, [kept])
+
+        server.reconfigure([kept])
+        time.sleep(0.1)
+
+        assert_that(kept.close, is_not(called()))
+
+    def test_extensions_kept_on_a_new_executor_are_not_closed(self):
+        with Spy() as kept:
+            pass
+        server = BaseServer.create(ADDRESS, [ExecutorHook('kept', kept, Executors())])
+
+        server.reconfigure([ExecutorHook('kept', kept, Executors())])
+        time.sleep(0.1)
+
+        assert_that(kept.close, is_not(called()))
+
+    def test_keeps_sender_while_relay_settings_do_not_change(self):
+        server = BaseServer.create(ADDRESS, [], ADDRESS, relay_options=dict(pool_size=2))
+        sender = server.sender
+
+        server.reconfigure([], ADDRESS, relay_options=dict(pool_size=2))
+        assert_that(server.sender, is_(same_instance(sender)))
+
+        server.reconfigure([], ADDRESS, relay_options=dict(pool_size=4))
+        assert_that(server.sender, is_not(same_instance(sender)))
+        server.close_relay()
+
+
+class Slow(object):
+    name = 'slow'
+
+    def __call__(self, address, sender, recipients, message):
+        time.sleep(0.01)
+
+
+class TestProfiling(object):
+    def setup_method(self):
+        descriptor, self.path = tempfile.mkstemp(suffix='.prof')
+        os.close(descriptor)
+
+    def teardown_method(self):
+        os.remove(self.path)
+
+    def test_writes_profile_of_messages_with_hook_names(self):
+        server = BaseServer.create(ADDRESS, [Slow()])
+
+        server.toggle_profiling(self.path)
+        server.process_message(*ARGS)
+        server.toggle_profiling(self.path).join()
+
+        names = [name for _, _, name in pstats.Stats(self.path).stats]
+        assert_that(names, has_item('hook.slow'))
+        assert_that(names, has_item('process_message'))
+
+    def test_leaves_methods_untouched_once_stopped(self):
+        server = BaseServer.create(ADDRESS, [Slow()])
+
+        server.toggle_profiling(self.path)
+        server.toggle_profiling(self.path)
+
+        assert_that(vars(server), is_not(has_item('process_message')))
+        assert_that(vars(server), is_not(has_item('run_hook')))
+
+
+class Received(object):
+    """Server side of a Channel, keeping the messages it receives"""
+
+    def __init__(self, spool_threshold=2 ** 20):
+        self.spool_options = {'spool_threshold': spool_threshold}
+        self.metrics = Metrics()
+        self.draining = False
+        self.messages = []
+
+    def process_message(self, address, sender, recipients, message, **kwargs):
+        self.messages.append(message)
+
+    def count_drained_session(self, drained, abandoned):
+        pass
+
+
+class TestChannel(object):
+    def setup_method(self):
+        self.server = Received(spool_threshold=16)
+        self.connection, self.client = socket.socketpair()
+        self.channel = Channel(self.server, self.connection, ADDRESS, map={})
+        self.channel.smtp_HELO('client')
+        self.start_data()
+
+    def start_data(self):
+        self.channel.smtp_MAIL('FROM:<email@email.em>')
+        self.channel.smtp_RCPT('TO:<email@email.em>')
+        self.channel.smtp_DATA('')
+
+    def teardown_method(self):
+        self.channel.close()
+        self.client.close()
+
+    def receive(self, *pieces):
+        for piece in pieces:
+            self.channel.collect_incoming_data(piece)
+        self.channel.found_terminator()
+        return self.server.messages[-1]
+
+    def test_streams_data_into_a_spooled_message(self):
+        message = self.receive(b'Subject: hi\r\n', b'\r\n', b'x' * 100)
+
+        assert_that(message, is_(Message))
+        assert_that(message.spooled, is_(True))
+        assert_that(message.as_bytes(), is_(b'Subject: hi\n\n' + b'x' * 100))
+
+    def test_undoes_dot_stuffing_and_line_ends_split_across_data(self):
+        message = self.receive(b'a\r', b'\n.', b'.b\r\n.c.\r', b'\nd\r', b'e')
+
+        assert_that(message.as_bytes(), is_(b'a\n.b\nc.\nd\re'))
+
+    def test_resets_for_next_message(self):
+        self.receive(b'first')
+        self.start_data()
+
+        assert_that(self.receive(b'.second').as_bytes(), is_(b'second'))
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from concurrent import futures
+
+from doublex import Spy, called
+from hamcrest import assert_that, is_, is_not, none, has_key, has_length, starts_with
+
+from hermes.throttle import Throttle, DUPLICATE_REPLY
+from hermes.hooks import RejectMessage
+from hermes.smtp import BaseServer
+
+ADDRESS = ('127.0.0.1', 8888)
+SENDER = 'loop@example.com'
+RECIPIENTS = ['one@example.com', 'two@example.com']
+
+
+def message(number, date=0):
+    return u'Subject: {}\nDate: {}\n\nHello'.format(number, date)
+
+
+def accept(throttle, sender, recipients, message):
+    """Reply to a message, whose tokens are taken when it may go on"""
+    return throttle.check(sender, recipients, message)[0]
+
+
+class TestThrottle(object):
+    def test_refuses_senders_past_their_burst(self):
+        throttle = Throttle(sender_rate=0.001, sender_burst=2)
+
+        replies = [accept(throttle, SENDER, RECIPIENTS, message(number)) for number in range(3)]
+
+        assert_that(replies[:2], is_([None, None]))
+        assert_that(replies[2], starts_with('451'))
+
+    def test_refills_buckets_over_time(self):
+        throttle = Throttle(sender_rate=1000, sender_burst=1)
+
+        accept(throttle, SENDER, RECIPIENTS, message(1))
+        throttle.senders.table[SENDER] = (0, 0)  # emptied long ago
+
+        assert_that(accept(throttle, SENDER, RECIPIENTS, message(2)), is_(none()))
+
+    def test_refuses_recipients_past_their_burst_without_taking_sender_tokens(self):
+        throttle = Throttle(sender_rate=0.001, sender_burst=2, recipient_rate=0.001, recipient_burst=1)
+
+        accept(throttle, 'first@example.com', RECIPIENTS[:1], message(1))
+        reply = accept(throttle, SENDER, RECIPIENTS, message(2))
+
+        assert_that(reply, starts_with('451 Too many messages for one@example.com'))
+        assert_that(throttle.senders.table, is_not(has_key(SENDER)))
+
+    def test_refuses_duplicates_differing_in_date_only(self):
+        throttle = Throttle(window=60)
+
+        accept(throttle, SENDER, RECIPIENTS, message(1, date=1))
+
+        assert_that(accept(throttle, SENDER, RECIPIENTS, message(1, date=2)), is_(DUPLICATE_REPLY))
+        assert_that(accept(throttle, SENDER, RECIPIENTS[:1], message(1, date=2)), is_(none()))
+
+    def test_forgets_duplicates_after_window(self):
+        throttle = Throttle(window=60)
+
+        accept(throttle, SENDER, RECIPIENTS, message(1))
+        for key in throttle.recent.table:
+            throttle.recent.table[key] -= 61
+
+        assert_that(accept(throttle, SENDER, RECIPIENTS, message(1)), is_(none()))
+
+    def test_tables_keep_at_most_size_entries(self):
+        throttle = Throttle(sender_rate=1, recipient_rate=1, window=60, size=10)
+
+        for number in range(100):
+            accept(throttle, '{}@example.com'.format(number), ['{}@example.net'.format(number)],
+                           message(number))
+
+        assert_that(throttle.senders.table, has_length(10))
+        assert_that(throttle.recipients.table, has_length(10))
+        assert_that(throttle.recent.table, has_length(10))
+
+
+class TestThrottleConcurrency(object):
+    def test_concurrent_copies_of_a_message_pass_once(self):
+        throttle = Throttle(sender_rate=0.001, sender_burst=2, window=60)
+        start = threading.Barrier(10)
+
+        def send():
+            start.wait()
+            return accept(throttle, SENDER, RECIPIENTS, message(1))
+
+        with futures.ThreadPoolExecutor(10) as executor:
+            replies = list(executor.map(lambda _: send(), range(10)))
+
+        assert_that([reply for reply in replies if reply is None], has_length(1))
+
+    def test_release_gives_back_tokens_and_content(self):
+        throttle = Throttle(sender_rate=0.001, sender_burst=1, window=60)
+        reply, ticket = throttle.check(SENDER, RECIPIENTS, message(1))
+
+        throttle.release(ticket)
+
+        assert_that(accept(throttle, SENDER, RECIPIENTS, message(1)), is_(none()))
+
+
+class TestServerThrottle(object):
+    def test_throttled_messages_do_not_reach_the_hooks(self):
+        hooks = Spy()
+        server = BaseServer.create(ADDRESS, [hooks.hook], throttle_options=dict(window=60))
+
+        replies = [server.process_message(None, SENDER, RECIPIENTS, message(1)) for _ in range(2)]
+
+        assert_that(replies, is_([None, DUPLICATE_REPLY]))
+        assert_that(hooks.hook, called().times(1))
+
+    def test_messages_refused_later_are_not_duplicates_when_tried_again(self):
+        hook = Flaky()
+        server = BaseServer.create(ADDRESS, [hook], throttle_options=dict(window=60))
+
+        replies = [server.process_message(None, SENDER, RECIPIENTS, message(1)) for _ in range(3)]
+
+        assert_that(replies, is_(['451 Try again later', None, DUPLICATE_REPLY]))
+        assert_that(hook.calls, is_(2))
+
+    def test_no_throttle_when_disabled(self):
+        server = BaseServer.create(ADDRESS, [], throttle_options=dict(sender_rate=0, window=0))
+
+        assert_that(server.throttle, is_(none()))
+        assert_that(server.process_message(None, SENDER, RECIPIENTS, message(1)), is_(none()))
+
+
+class Flaky(object):
+    """Hook refusing the first message for now"""
+    calls = 0
+
+    def __call__(self, address, sender, recipients, message):
+        self.calls += 1
+        if self.calls == 1:
+            raise RejectMessage('451 Try again later')